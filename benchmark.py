@@ -0,0 +1,657 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import casadi as ca
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+import optimal_pacing as opt
+import route_store
+import server
+from simulator import create_initialization, resample_initialization
+
+# Athlete used for all benchmarks unless overridden on the command line
+athlete = {
+    'weight': 75,
+    'cp': 250,
+    'w_prime': 20000,
+    'max_power': 700
+}
+
+# Regression suite: a stage counts as slower than the baseline above REGRESSION_THRESHOLD, stages that
+# took less than MIN_STAGE_TIME in the baseline are too noisy to compare, and T has to match to T_TOLERANCE
+SUITE_STAGES = ('load', 'extend', 'initialization', 'construction', 'solve', 'plot')
+SUITE_BASELINE = 'benchmark_baseline.json'
+REGRESSION_THRESHOLD = 0.25
+MIN_STAGE_TIME = 0.1
+T_TOLERANCE = 1e-3
+
+# Historical plans that solves with these settings should reproduce to FIXTURE_TOLERANCE. optimal_pacing_reopt.json
+# holds the same plan as optimal_pacing_attempt.json
+FIXTURES_DIR = os.path.join('Experimental data and optimizations', 'Optimization results')
+FIXTURE_ATHLETE = {'weight': 75, 'cp': 290, 'w_prime': 25000, 'max_power': 670}
+FIXTURES = {
+    'optimal_pacing_attempt.json': ('Cobbled Climbs', 2, 'Euler', None),
+    'negative_split_pacing.json': ('Cobbled Climbs', 2, 'Euler', (90, 0))
+}
+FIXTURE_TOLERANCE = 0.01
+
+def load_routes():
+    with open('routes.json', 'r') as file:
+        return json.load(file)
+
+def create_initialization_casadi(time, x0, distance, elevation, params):
+    # The bisection over slope_const with a CasADi integrator that create_initialization replaced, kept to
+    # benchmark and test it against
+    # Mechanical model params
+    mass_rider = params.get("mass_rider")
+    mass_bike = params.get("mass_bike")
+    m = mass_bike + mass_rider
+    g = params.get("g")
+    mu = params.get("mu")
+    b0 = params.get("b0")
+    b1 = params.get("b1")
+    Iw = params.get("Iw")
+    r = params.get("r")
+    Cd = params.get("Cd")
+    rho = params.get("rho")
+    A = params.get("A")
+    eta = params.get("eta")
+
+    # Physiological model params
+    w_prime = params.get("w_prime")
+    cp = params.get("cp")
+
+    sigma = 2
+    smoothed_elev = gaussian_filter1d(elevation, sigma)
+
+    slope = opt.calculate_gradient(distance, smoothed_elev)
+
+    interpolated_slope = ca.interpolant('Slope', 'bspline', [distance], slope)
+    interpolated_friction = ca.interpolant('Friction', 'bspline', [distance], mu)
+    def system_dynamics(x, u):
+        return ca.vertcat(x[1], 
+                (1/x[1] * 1/(m + Iw/r**2)) * (eta*u - interpolated_friction(x[0])*m*g*x[1] - m*g*interpolated_slope(x[0])*x[1] - b0*x[1] - b1*x[1]**2 - 0.5*Cd*rho*A*x[1]**3),
+                opt.smooth_w_balance_ode_derivative(u, cp, x, w_prime)) 
+
+    tf = time[-1]
+    N = len(time)
+    t_grid = np.linspace(0,tf,N)
+
+    dt = tf/N  
+    t0 = 0
+    x = ca.MX.sym('x', 3) 
+    u = ca.MX.sym('u', 1)  
+    f = system_dynamics(x, u)  
+    ode = {'x': x, 'p': u, 'ode': f}  
+    F = ca.integrator('F', 'rk', ode, t0, dt)   
+
+    lower_bound = 0
+    upper_bound = 2500
+    while upper_bound - lower_bound > 50:  
+        slope_const = (upper_bound + lower_bound) / 2
+        X = np.zeros((3, N))
+        U = lambda pos: cp + slope_const*interpolated_slope(pos)
+        power = []
+
+        X[:,0] = x0
+        for k in range(N-1):
+            res = F(x0=X[:,k], p=U(X[0,k]))  
+            X[:,k+1] = res['xf'].full().flatten()
+            power.append(U(X[0,k]))  
+        
+        power = np.array(power).flatten()
+
+        if (X[2] < 1000).any():
+            upper_bound = slope_const
+        else:
+            lower_bound = slope_const
+
+        end_index = np.argwhere(np.array(X[0,:]) >= distance[-1])[0][0]
+    return X[:,:end_index], power[:end_index], t_grid[:end_index]
+
+def timed(fn, *args, repeats=1):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def bench_initialization(args):
+    routes = load_routes()
+    print(f"{'Route':<22}{'N':>6}{'CasADi [s]':>12}{'NumPy [s]':>12}{'Speedup':>9}{'T CasADi':>10}{'T NumPy':>9}")
+    for route_name, route in routes.items():
+        distance = route['distance']
+        elevation = route['elevation']
+        params = opt.model_params(athlete, route['friction'])
+        N = round(distance[-1]/5)
+        timegrid = np.linspace(0,round(distance[-1]/1000*150), N)
+        x0 = [distance[0], 1, params.get('w_prime')]
+
+        t_casadi, (_, _, t_grid_casadi) = timed(create_initialization_casadi, timegrid, x0, distance, elevation, params, repeats=args.repeats)
+        t_numpy, (_, _, t_grid_numpy) = timed(create_initialization, timegrid, x0, distance, elevation, params, repeats=args.repeats)
+        print(f"{route_name:<22}{N:>6}{t_casadi:>12.3f}{t_numpy:>12.3f}{t_casadi/t_numpy:>8.1f}x{t_grid_casadi[-1]:>10.1f}{t_grid_numpy[-1]:>9.1f}")
+
+def initial_guess(route, params, N=None):
+    # Same initialization and N as server.run_opt unless N is given
+    distance = route['distance']
+    timegrid = np.linspace(0,round(distance[-1]/1000*150), round(distance[-1]/5))
+    X, power, t_grid = create_initialization(timegrid, [distance[0], 1, params.get('w_prime')], distance, route['elevation'], params, slope=route['gradient'][2])
+    if N is None:
+        N = int(np.ceil((len(power)-1)/50)*50)
+    X, power, t_grid = resample_initialization(X, power, t_grid, N)
+    initialization = {
+        'pos_init': X[0],
+        'speed_init': X[1],
+        'w_bal_init': X[2],
+        'power_init': power,
+        'time_init': timegrid[-1],
+        'time_grid': t_grid
+    }
+    return N, initialization
+
+def solve_options(N, integration_method, **overrides):
+    # optimization_opts of a full-route solve with the server's settings, without its output
+    return {
+        "N": N,
+        "smooth_power_constraint": True,
+        "w_bal_model": "ODE",
+        "integration_method": integration_method,
+        "solver": "ipopt",
+        "negative_split": False,
+        "quiet": True,
+        **overrides
+    }
+
+def build_route_problem(route, route_name, num_laps, optimization_opts):
+    return opt.build_problem(route['distance'], route['elevation'], route['friction'], optimization_opts, interpolants=route_store.get_interpolants(route_name, num_laps, 2))
+
+def solve_with_stats(route, params, optimization_opts, initialization, problem):
+    # Full-route solve on problem. Returns the solution, None if IPOPT failed, and the solver stats
+    try:
+        sol = opt.solve_opt(route['distance'], route['elevation'], params, optimization_opts, initialization, problem=problem)[0]
+    except RuntimeError:
+        return None, problem['solver'].stats() if problem.get('compiled') else problem['opti'].stats()
+    return sol, sol.stats()
+
+def bench_formulation(args):
+    routes = args.routes or list(route_store.load_store().keys())
+    print(f"{'Route':<22}{'Formulation':<13}{'N':>6}{'Build [s]':>11}{'Iterations':>12}{'IPOPT [s]':>11}{'T [s]':>9}  Status")
+    for route_name in routes:
+        route = route_store.get_route(route_name, args.num_laps)
+        params = opt.model_params(athlete, route['friction'])
+        N, initialization = initial_guess(route, params)
+        for formulation in ('time', 'distance'):
+            optimization_opts = solve_options(N, args.integration_method, formulation=formulation)
+            build_time, problem = timed(build_route_problem, route, route_name, args.num_laps, optimization_opts)
+            sol, stats = solve_with_stats(route, params, optimization_opts, initialization, problem)
+            final_time = float('nan') if sol is None else sol.value(problem['T'])
+            print(f"{route_name:<22}{formulation:<13}{N:>6}{build_time:>11.2f}{stats['iter_count']:>12}{stats['t_wall_total']:>11.2f}{final_time:>9.1f}  {stats['return_status']}")
+
+def function_time(stats):
+    # Wall time IPOPT spent in the NLP function and derivative evaluations
+    return sum(value for key, value in stats.items() if key.startswith('t_wall_nlp_'))
+
+def bench_compiled(args):
+    routes = args.routes or list(route_store.load_store().keys())
+    print(f"{'Route':<22}{'Mode':<13}{'N':>6}{'Setup [s]':>11}{'Iterations':>12}{'IPOPT [s]':>11}{'NLP fn [s]':>12}{'T [s]':>9}  Status")
+    for route_name in routes:
+        route = route_store.get_route(route_name, args.num_laps)
+        params = opt.model_params(athlete, route['friction'])
+        N, initialization = initial_guess(route, params, args.N)
+        optimization_opts = solve_options(N, args.integration_method, formulation=args.formulation)
+        build = lambda: build_route_problem(route, route_name, args.num_laps, optimization_opts)
+        key = opt.problem_hash(route['distance'], route['elevation'], route['friction'], 2, N, args.integration_method, "ODE", False, args.formulation, True, "ipopt")
+
+        # Interpreted, compiled on a cache miss and compiled loaded from the disk cache
+        path = os.path.join(opt.COMPILED_DIR, key + '.so')
+        if os.path.exists(path):
+            os.remove(path)
+        modes = [
+            ('interpreted', build),
+            ('compile', lambda: opt.compiled_problem(key, build, optimization_opts)),
+            ('cached', lambda: opt.compiled_problem(key, build, optimization_opts))
+        ]
+        for mode, setup in modes:
+            setup_time, problem = timed(setup)
+            sol, stats = solve_with_stats(route, params, optimization_opts, initialization, problem)
+            final_time = float('nan') if sol is None else sol.value(problem['T'])
+            print(f"{route_name:<22}{mode:<13}{N:>6}{setup_time:>11.2f}{stats['iter_count']:>12}{stats['t_wall_total']:>11.2f}{function_time(stats):>12.2f}{final_time:>9.1f}  {stats['return_status']}")
+
+def construction_stats(route_name, num_laps, optimization_opts):
+    # Runs in a fresh process so ru_maxrss only covers this problem
+    route = route_store.get_route(route_name, num_laps)
+    interpolants = route_store.get_interpolants(route_name, num_laps, 2)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    build_time, problem = timed(opt.build_problem, route['distance'], route['elevation'], route['friction'], optimization_opts, 2, interpolants)
+    opti = problem['opti']
+    # IPOPT creates the Jacobian and Hessian functions when the solver is constructed
+    nlp = {'x': opti.x, 'p': opti.p, 'f': opti.f, 'g': opti.g}
+    solver_time, _ = timed(ca.nlpsol, 'solver', 'ipopt', nlp, {"expand": False})
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    return build_time, solver_time, peak/1024
+
+def bench_construction(args):
+    print(f"{'N':>7}{'Build [s]':>11}{'Solver [s]':>12}{'Peak [MB]':>11}")
+    context = multiprocessing.get_context('spawn')
+    for N in args.N:
+        optimization_opts = solve_options(N, args.integration_method, formulation=args.formulation, parallelization=args.parallelization)
+        with context.Pool(1) as pool:
+            build_time, solver_time, peak = pool.apply(construction_stats, (args.route, args.num_laps, optimization_opts))
+        print(f"{N:>7}{build_time:>11.2f}{solver_time:>12.2f}{peak:>11.0f}")
+
+def bench_adaptive(args):
+    routes = args.routes or list(route_store.load_store().keys())
+    print(f"{'Route':<22}{'Mode':<10}{'N':>7}{'Variables':>11}{'Iterations':>12}{'Wall [s]':>10}{'T [s]':>9}{'dT [s]':>8}{'Max dv':>8}{'Max dWbal':>10}")
+    for route_name in routes:
+        route = route_store.get_route(route_name, args.num_laps)
+        params = opt.model_params(athlete, route['friction'])
+        N, initialization = initial_guess(route, params)
+        optimization_opts = solve_options(N, args.integration_method, formulation=args.formulation)
+        interpolants = route_store.get_interpolants(route_name, args.num_laps, 2)
+        start = time.perf_counter()
+        problem = build_route_problem(route, route_name, args.num_laps, optimization_opts)
+        sol, stats = solve_with_stats(route, params, optimization_opts, initialization, problem)
+        uniform_time = time.perf_counter() - start
+        if sol is None:
+            print(f"{route_name:<22}{'uniform':<10}{N:>7}  failed: {stats['return_status']}")
+            continue
+        uniform_T = sol.value(problem['T'])
+        print(f"{route_name:<22}{'uniform':<10}{N:>7}{problem['opti'].nx:>11}{stats['iter_count']:>12}{uniform_time:>10.2f}{uniform_T:>9.1f}")
+
+        start = time.perf_counter()
+        sol, problem, levels = opt.solve_adaptive(route['distance'], route['elevation'], params, optimization_opts, initialization, route['gradient'][2], interpolants, args.levels, args.coarsening, args.fraction)
+        adaptive_time = time.perf_counter() - start
+        for level in levels:
+            print(f"{'':<22}{'level':<10}{level['N']:>7}{'':>11}{level['iterations']:>12}{level['setup_time'] + level['opt_time']:>10.2f}{level['T']:>9.1f}{'':>8}{level['max_defects'][1]:>8.3f}{level['max_defects'][2]:>10.2f}")
+        adaptive_T = sol.value(problem['T'])
+        print(f"{'':<22}{'adaptive':<10}{levels[-1]['N']:>7}{problem['opti'].nx:>11}{sum(level['iterations'] for level in levels):>12}{adaptive_time:>10.2f}{adaptive_T:>9.1f}{adaptive_T - uniform_T:>8.1f}")
+
+def bench_mpc(args):
+    # Reoptimize along the route from states of the full-route plan with a W'bal deficit, as the mod would
+    # mid-ride, with a receding horizon every step and with the whole remaining route every full_every steps
+    route_key = next(key for key, name in server.route_names.items() if name == args.route)
+    opt_config = {
+        'route': route_key,
+        'num_laps': args.num_laps,
+        'integration_method': args.integration_method,
+        'negative_split': False,
+        'formulation': args.formulation,
+        **athlete
+    }
+    route = route_store.get_route(args.route, args.num_laps)
+    start = time.perf_counter()
+    result = server.solve_run_opt(opt_config)
+    print(f"Full-route plan: {time.perf_counter() - start:.1f} s, T = {result['solution']['T']:.1f} s")
+    race_plan = {'route': args.route, 'num_laps': args.num_laps, 'solution': result['solution']}
+    plan = race_plan['solution']
+
+    print(f"{'Dist [m]':>9}{'Mode':>9}{'N':>7}{'Iterations':>12}{'Latency [s]':>13}{'Remaining T [s]':>17}")
+    latencies = {'horizon': [], 'full': []}
+    previous = None
+    for n, distance in enumerate(np.arange(args.step, route['distance'][-1] - args.step, args.step)):
+        speed = np.interp(distance, plan['pos'], plan['speed'])
+        w_bal = max(0, np.interp(distance, plan['pos'], plan['w_bal']) - args.deficit)
+        state = {**opt_config, 'distance': distance, 'speed': speed, 'w_bal': w_bal}
+        modes = [('horizon', {**state, 'horizon': args.horizon})]
+        if n % args.full_every == 0:
+            modes.append(('full', state))
+        for mode, config in modes:
+            start = time.perf_counter()
+            try:
+                reopt = server.solve_reoptimization(config, previous if mode == 'horizon' else None, race_plan)
+            except Exception as error:
+                print(f"{distance:>9.0f}{mode:>9}  failed: {error!r}")
+                continue
+            latency = time.perf_counter() - start
+            latencies[mode].append(latency)
+            stats = reopt['stats']
+            if mode == 'horizon':
+                previous = {'route': args.route, 'num_laps': args.num_laps, 'solution': reopt['solution']}
+            print(f"{distance:>9.0f}{mode:>9}{stats['N']:>7}{stats['iterations']:>12}{latency:>13.2f}{reopt['plan']['time'][-1]:>17.1f}")
+
+    for mode, values in latencies.items():
+        if values:
+            print(f"{mode}: {len(values)} solves, mean {np.mean(values):.2f} s, p95 {np.percentile(values, 95):.2f} s, worst {np.max(values):.2f} s")
+
+def bench_replay(args):
+    # One IPOPT solve against batched replays of scaled copies of its plan through the same model
+    import replay
+    route = route_store.get_route(args.route, args.num_laps)
+    params = opt.model_params(athlete, route['friction'])
+    N, initialization = initial_guess(route, params)
+    optimization_opts = solve_options(N, args.integration_method)
+    start = time.perf_counter()
+    problem = build_route_problem(route, args.route, args.num_laps, optimization_opts)
+    sol, stats = solve_with_stats(route, params, optimization_opts, initialization, problem)
+    solve_time = time.perf_counter() - start
+    if sol is None:
+        raise SystemExit(f"IPOPT failed: {stats['return_status']}")
+    T = sol.value(problem['T'])
+    plan = {'distance': sol.value(problem['X'][0,:]), 'power': sol.value(problem['U'])}
+    print(f"IPOPT: {solve_time:.2f} s, {stats['iter_count']} iterations, T = {T:.1f} s")
+
+    print(f"{'Plans':>7}{'Wall [s]':>10}{'Per plan [ms]':>15}{'T [s]':>9}{'Min Wbal [J]':>14}{'Best T [s]':>12}{'Exhausted':>11}")
+    for K in args.plans:
+        # Power scaled by 0.9 to 1.05, the unscaled plan first
+        scales = np.concatenate([[1], np.linspace(0.9, 1.05, K - 1)])
+        plans = [{**plan, 'power': plan['power']*scale} for scale in scales]
+        start = time.perf_counter()
+        result = replay.replay(plans, route['distance'], route['gradient'][2], params, dt=args.dt, substeps=args.substeps, horizon=1.5*T)
+        replay_time = time.perf_counter() - start
+        # Plans that take W'bal lower than the replayed optimal plan count as exhausted
+        feasible = result['min_w_bal'] >= result['min_w_bal'][0]
+        best = np.nanmin(result['T'][feasible]) if feasible.any() else np.nan
+        print(f"{K:>7}{replay_time:>10.2f}{replay_time/K*1000:>15.2f}{result['T'][0]:>9.1f}{result['min_w_bal'][0]:>14.0f}{best:>12.1f}{np.count_nonzero(~feasible):>11}")
+
+def bench_laps(args):
+    # Monolithic solve of the whole race against the lap decomposition of laps.py, with one pool process per lap
+    import laps
+    print(f"{'Laps':>5}{'Method':>14}{'T [s]':>10}{'Wall [s]':>10}{'Steps':>7}{'Critical path [s]':>19}  Status")
+    for num_laps in args.laps:
+        route = route_store.get_route(args.route, num_laps)
+        params = opt.model_params(athlete, route['friction'])
+        N, initialization = initial_guess(route, params)
+        optimization_opts = solve_options(N, args.integration_method)
+        start = time.perf_counter()
+        problem = build_route_problem(route, args.route, num_laps, optimization_opts)
+        sol, _ = solve_with_stats(route, params, optimization_opts, initialization, problem)
+        wall_time = time.perf_counter() - start
+        final_time = float('nan') if sol is None else sol.value(problem['T'])
+        print(f"{num_laps:>5}{'monolithic':>14}{final_time:>10.2f}{wall_time:>10.1f}{1:>7}{wall_time:>19.1f}  {'failed' if sol is None else 'ok'}")
+
+        with multiprocessing.get_context('spawn').Pool(min(num_laps, args.workers), laps.init_worker) as pool:
+            start = time.perf_counter()
+            race, steps = laps.solve_laps(args.route, num_laps, athlete, args.integration_method, map_fn=pool.map)
+            wall_time = time.perf_counter() - start
+        # Wall time with a process per lap: the slowest lap of every step, plus the work outside the pool
+        critical_path = wall_time - sum(step['wall'] - step['critical_path'] for step in steps)
+        status = 'ok' if steps[-1]['converged'] else 'not converged'
+        print(f"{num_laps:>5}{'decomposed':>14}{race['T']:>10.2f}{wall_time:>10.1f}{len(steps):>7}{critical_path:>19.1f}  {status}")
+
+def bench_portfolio(args):
+    # Reoptimizations from states of each route's full-route plan with a W'bal deficit, solved from every start
+    # of the server's portfolio one after the other. The single start is the server's default warm start, the
+    # portfolio's latency the fastest member that converged, as with a worker per member. Members are stopped
+    # by IPOPT at the deadline
+    routes = args.routes or sorted(set(server.route_names.values()))
+    print(f"{'Route':>20}{'Dist [m]':>10}" + ''.join(f"{start:>13}" for start, _ in server.PORTFOLIO) + f"{'Single T [s]':>14}{'Portfolio T [s]':>17}")
+    latencies = {}
+    for route_name in routes:
+        route_key = next(key for key, name in server.route_names.items() if name == route_name)
+        opt_config = {
+            'route': route_key,
+            'num_laps': args.num_laps,
+            'integration_method': args.integration_method,
+            'negative_split': False,
+            'quiet': True,
+            **athlete
+        }
+        route = route_store.get_route(route_name, args.num_laps)
+        plan = server.solve_run_opt(opt_config)['solution']
+        previous = {'route': route_name, 'num_laps': args.num_laps, 'solution': plan}
+        latencies[route_name] = {'single': [], 'portfolio': []}
+        for distance in np.linspace(0, route['distance'][-1], args.states + 2)[1:-1]:
+            state = {
+                **opt_config,
+                'distance': distance,
+                'speed': np.interp(distance, plan['pos'], plan['speed']),
+                'w_bal': max(0, np.interp(distance, plan['pos'], plan['w_bal']) - args.deficit)
+            }
+            members, _ = server.portfolio('reoptimization', state, (previous,))
+            results = {}
+            for config, *member_args in members:
+                config['ipopt_options'] = {**config['ipopt_options'], "max_wall_time": args.deadline, "print_level": 0, "sb": "yes"}
+                start = time.perf_counter()
+                try:
+                    reopt = server.solve_reoptimization(config, *member_args)
+                    # Problem construction is left out, a worker keeps its problems between requests
+                    T, setup_time = reopt['plan']['time'][-1], reopt['stats']['setup_time']
+                except RuntimeError:
+                    T, setup_time = None, 0
+                results[config['start']] = (time.perf_counter() - start - setup_time, T)
+            # Members that failed or ran out of time count as not converged
+            converged = {start: result for start, result in results.items() if result[1] is not None and result[0] <= args.deadline}
+            single = converged.get('previous')
+            fastest = min(converged.values(), default=None)
+            latencies[route_name]['single'].append(single[0] if single else None)
+            latencies[route_name]['portfolio'].append(fastest[0] if fastest else None)
+            cells = ''.join(f"{results[start][0]:>12.1f}{'' if start in converged else '!'}".rjust(13) for start, _ in server.PORTFOLIO)
+            single_T = f"{single[1]:.1f}" if single else 'failed'
+            portfolio_T = f"{fastest[1]:.1f}" if fastest else 'failed'
+            print(f"{route_name:>20}{distance:>10.0f}{cells}{single_T:>14}{portfolio_T:>17}")
+
+    def summary(values):
+        # Failed solves take the deadline in the percentiles
+        failed = sum(value is None for value in values)
+        values = [args.deadline if value is None else value for value in values]
+        return f"p50 {np.percentile(values, 50):>6.1f} s  p99 {np.percentile(values, 99):>6.1f} s  failed {failed/len(values):>4.0%}"
+
+    print(f"Latency, failed solves at the {args.deadline:.0f} s deadline (! above)")
+    for route_name, values in list(latencies.items()) + [('All routes', {mode: sum((v[mode] for v in latencies.values()), []) for mode in ('single', 'portfolio')})]:
+        for mode in ('single', 'portfolio'):
+            print(f"{route_name:>20}{mode:>11}  {summary(values[mode])}")
+
+def suite_case(route_name, num_laps, integration_method, athlete, negative_split=None):
+    # One pass through the server pipeline with every stage timed. Runs in a fresh process, so
+    # the route store is loaded from disk and ru_maxrss is the peak of this case alone
+    from optimization_plots import render_plan
+    times = {}
+    start = time.perf_counter()
+    route_store.load_store()
+    times['load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    route = route_store.get_route(route_name, num_laps)
+    times['extend'] = time.perf_counter() - start
+
+    params = opt.model_params(athlete, route['friction'])
+    start = time.perf_counter()
+    N, initialization = initial_guess(route, params)
+    times['initialization'] = time.perf_counter() - start
+
+    optimization_opts = solve_options(N, integration_method,
+        time_initial_guess=initialization['time_init'],
+        negative_split=negative_split is not None,
+        w_bal_start=negative_split[0]/100*athlete['w_prime'] if negative_split else 0,
+        w_bal_end=negative_split[1]/100*athlete['w_prime'] if negative_split else 0)
+    start = time.perf_counter()
+    problem = build_route_problem(route, route_name, num_laps, optimization_opts)
+    times['construction'] = time.perf_counter() - start
+
+    result = {'N': N, 'times': times}
+    sol, stats = solve_with_stats(route, params, optimization_opts, initialization, problem)
+    times['solve'] = stats['t_wall_total']
+    if sol is None:
+        return {**result, 'iterations': stats['iter_count'], 'status': stats['return_status'], 'T': None,
+            'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024}
+    T, U, X = problem['T'], problem['U'], problem['X']
+
+    opt_details = {"N": N, "w_bal_model": "ODE", "integration_method": integration_method, "iterations": stats['iter_count'], "opt_time": stats['t_wall_total']}
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        render_plan(os.path.join(directory, 'plot.png'), opt.extract_solution(sol, problem), route['distance'], route['elevation'], params, opt_details)
+        times['plot'] = time.perf_counter() - start
+    return {
+        **result,
+        'iterations': stats['iter_count'],
+        'status': stats['return_status'],
+        'T': float(sol.value(T)),
+        'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+        'plan': {'time': sol.value(problem['time']).tolist(), 'distance': sol.value(X[0,:]).tolist(), 'power': sol.value(U).tolist()}
+    }
+
+def run_case(*args):
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(suite_case, args)
+
+def compare(case, result, reference):
+    # Regressions of one case against its baseline entry, as messages
+    problems = []
+    if result['T'] is None:
+        return [f"{case}: solve failed with {result['status']}"]
+    if reference['T'] is not None and abs(result['T'] - reference['T']) > T_TOLERANCE*reference['T']:
+        problems.append(f"{case}: T {result['T']:.2f} s, baseline {reference['T']:.2f} s")
+    for stage in SUITE_STAGES:
+        before, after = reference['times'].get(stage), result['times'].get(stage)
+        if before is not None and after is not None and before >= MIN_STAGE_TIME and after > before*(1 + REGRESSION_THRESHOLD):
+            problems.append(f"{case}: {stage} {after:.2f} s, baseline {before:.2f} s")
+    if result['iterations'] > reference['iterations']*(1 + REGRESSION_THRESHOLD):
+        problems.append(f"{case}: {result['iterations']} iterations, baseline {reference['iterations']}")
+    if result['peak_mb'] > reference['peak_mb']*(1 + REGRESSION_THRESHOLD):
+        problems.append(f"{case}: peak {result['peak_mb']:.0f} MB, baseline {reference['peak_mb']:.0f} MB")
+    return problems
+
+def check_fixtures():
+    # Solve the settings of each historical plan and compare the final time and the power along the route
+    problems = []
+    print(f"{'Fixture':<30}{'T [s]':>9}{'Plan T [s]':>12}{'RMS P [W]':>11}")
+    for file_name, (route_name, num_laps, integration_method, negative_split) in FIXTURES.items():
+        with open(os.path.join(FIXTURES_DIR, file_name), 'r') as file:
+            fixture = json.load(file)
+        result = run_case(route_name, num_laps, integration_method, FIXTURE_ATHLETE, negative_split)
+        if result['T'] is None:
+            problems.append(f"{file_name}: solve failed with {result['status']}")
+            continue
+        plan = result['plan']
+        rms = np.sqrt(np.mean((np.interp(fixture['distance'], plan['distance'], plan['power']) - np.array(fixture['power']))**2))
+        print(f"{file_name:<30}{result['T']:>9.1f}{fixture['time'][-1]:>12.1f}{rms:>11.1f}")
+        if abs(result['T'] - fixture['time'][-1]) > FIXTURE_TOLERANCE*fixture['time'][-1]:
+            problems.append(f"{file_name}: T {result['T']:.1f} s, plan {fixture['time'][-1]:.1f} s")
+    return problems
+
+def bench_suite(args):
+    # Every route, lap count and integration method through the whole pipeline, compared with the baseline.
+    # Exits with status 1 if any case regressed
+    routes = args.routes or list(route_store.load_store().keys())
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+
+    header = ''.join(f"{stage.capitalize():>15}" for stage in SUITE_STAGES)
+    print(f"{'Case':<28}{'N':>7}{header}{'Iterations':>12}{'Peak [MB]':>11}{'T [s]':>9}")
+    results, problems = {}, []
+    for route_name in routes:
+        for num_laps in args.laps:
+            for integration_method in args.methods:
+                case = f"{route_name}/{num_laps}/{integration_method}"
+                result = run_case(route_name, num_laps, integration_method, athlete)
+                result.pop('plan', None)
+                results[case] = result
+                stages = ''.join(f"{result['times'].get(stage, float('nan')):>15.3f}" for stage in SUITE_STAGES)
+                print(f"{case:<28}{result['N']:>7}{stages}{result['iterations']:>12}{result['peak_mb']:>11.0f}{result['T'] if result['T'] is not None else float('nan'):>9.1f}", flush=True)
+                if case in baseline:
+                    problems += compare(case, result, baseline[case])
+                elif result['T'] is None:
+                    problems.append(f"{case}: solve failed with {result['status']}")
+    if not args.skip_fixtures:
+        problems += check_fixtures()
+
+    if args.update_baseline:
+        # Cases that were not run this time keep their old entries
+        previous = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r') as file:
+                previous = json.load(file)
+        with open(args.baseline, 'w') as file:
+            json.dump({**previous, **results}, file, indent=2)
+        print(f"Wrote {args.baseline}")
+    for problem in problems:
+        print(f"REGRESSION {problem}")
+    if problems:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for the optimal pacing pipeline")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    init_parser = subparsers.add_parser('initialization', help="CasADi bisection vs batched NumPy create_initialization")
+    init_parser.add_argument('--repeats', type=int, default=1)
+    init_parser.set_defaults(func=bench_initialization)
+
+    formulation_parser = subparsers.add_parser('formulation', help="Time-domain vs distance-domain NLP")
+    formulation_parser.add_argument('--routes', nargs='*')
+    formulation_parser.add_argument('--num-laps', type=int, default=1)
+    formulation_parser.add_argument('--integration-method', default='RK4', choices=['Euler', 'Midpoint', 'RK4'])
+    formulation_parser.set_defaults(func=bench_formulation)
+
+    compiled_parser = subparsers.add_parser('compiled', help="Interpreted MX vs compiled NLP functions")
+    compiled_parser.add_argument('--routes', nargs='*')
+    compiled_parser.add_argument('--num-laps', type=int, default=1)
+    compiled_parser.add_argument('--integration-method', default='RK4', choices=['Euler', 'Midpoint', 'RK4'])
+    compiled_parser.add_argument('--formulation', default='time', choices=['time', 'distance'])
+    compiled_parser.add_argument('--N', type=int, help="Number of intervals, by default as in the server")
+    compiled_parser.set_defaults(func=bench_compiled)
+
+    construction_parser = subparsers.add_parser('construction', help="Problem construction time and peak memory")
+    construction_parser.add_argument('--route', default='Downtown Titans')
+    construction_parser.add_argument('--num-laps', type=int, default=1)
+    construction_parser.add_argument('--N', type=int, nargs='*', default=[1000, 5000, 20000])
+    construction_parser.add_argument('--integration-method', default='RK4', choices=['Euler', 'Midpoint', 'RK4'])
+    construction_parser.add_argument('--formulation', default='time', choices=['time', 'distance'])
+    construction_parser.add_argument('--parallelization', default='serial', choices=['serial', 'unroll', 'thread'])
+    construction_parser.set_defaults(func=bench_construction)
+
+    adaptive_parser = subparsers.add_parser('adaptive', help="Uniform grid against coarse-to-fine refinement")
+    adaptive_parser.add_argument('--routes', nargs='*', help="Route names, all routes by default")
+    adaptive_parser.add_argument('--num-laps', type=int, default=1)
+    adaptive_parser.add_argument('--integration-method', default='RK4', choices=['Euler', 'Midpoint', 'RK4'])
+    adaptive_parser.add_argument('--formulation', default='time', choices=['time', 'distance'])
+    adaptive_parser.add_argument('--levels', type=int, default=3)
+    adaptive_parser.add_argument('--coarsening', type=int, default=4)
+    adaptive_parser.add_argument('--fraction', type=float, default=0.3)
+    adaptive_parser.set_defaults(func=bench_adaptive)
+
+    mpc_parser = subparsers.add_parser('mpc', help="Receding-horizon and full reoptimization latency along a route")
+    mpc_parser.add_argument('--route', default='Downtown Titans')
+    mpc_parser.add_argument('--num-laps', type=int, default=1)
+    mpc_parser.add_argument('--horizon', type=float, default=4000)
+    mpc_parser.add_argument('--step', type=float, default=500, help="Distance between reoptimizations")
+    mpc_parser.add_argument('--full-every', type=int, default=8, help="Also solve the whole remaining route every this many steps")
+    mpc_parser.add_argument('--deficit', type=float, default=2000, help="W'bal below the plan at each reoptimization")
+    mpc_parser.add_argument('--integration-method', default='Euler', choices=['Euler', 'Midpoint', 'RK4'])
+    mpc_parser.add_argument('--formulation', default='time', choices=['time', 'distance'])
+    mpc_parser.set_defaults(func=bench_mpc)
+
+    replay_parser = subparsers.add_parser('replay', help="Batched plan replays against an IPOPT solve")
+    replay_parser.add_argument('--route', default='Cobbled Climbs')
+    replay_parser.add_argument('--num-laps', type=int, default=2)
+    replay_parser.add_argument('--integration-method', default='RK4', choices=['Euler', 'Midpoint', 'RK4'])
+    replay_parser.add_argument('--plans', type=int, nargs='*', default=[1, 10, 100, 500])
+    replay_parser.add_argument('--dt', type=float, default=0.5)
+    replay_parser.add_argument('--substeps', type=int, default=2)
+    replay_parser.set_defaults(func=bench_replay)
+
+    laps_parser = subparsers.add_parser('laps', help="Monolithic multi-lap solve against the parallel lap decomposition")
+    laps_parser.add_argument('--route', default='Mech Isle Loop')
+    laps_parser.add_argument('--laps', type=int, nargs='*', default=[2, 4, 8])
+    laps_parser.add_argument('--integration-method', default='Euler', choices=['Euler', 'Midpoint', 'RK4'])
+    laps_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    laps_parser.set_defaults(func=bench_laps)
+
+    portfolio_parser = subparsers.add_parser('portfolio', help="Single-start against multistart portfolio reoptimization latency and failures")
+    portfolio_parser.add_argument('--routes', nargs='*', help="Route names, all routes by default")
+    portfolio_parser.add_argument('--num-laps', type=int, default=1)
+    portfolio_parser.add_argument('--states', type=int, default=4, help="Reoptimizations per route, evenly spaced")
+    portfolio_parser.add_argument('--deficit', type=float, default=3000, help="W'bal below the plan at each reoptimization")
+    portfolio_parser.add_argument('--deadline', type=float, default=60)
+    portfolio_parser.add_argument('--integration-method', default='Euler', choices=['Euler', 'Midpoint', 'RK4'])
+    portfolio_parser.set_defaults(func=bench_portfolio)
+
+    suite_parser = subparsers.add_parser('suite', help="Per-stage timings of every route, lap count and integration method against a baseline")
+    suite_parser.add_argument('--routes', nargs='*', help="Route names, all routes by default")
+    suite_parser.add_argument('--laps', type=int, nargs='*', default=[1, 3])
+    suite_parser.add_argument('--methods', nargs='*', default=['Euler', 'Midpoint', 'RK4'], choices=['Euler', 'Midpoint', 'RK4'])
+    suite_parser.add_argument('--baseline', default=SUITE_BASELINE)
+    suite_parser.add_argument('--update-baseline', action='store_true', help="Write the results as the new baseline instead of comparing")
+    suite_parser.add_argument('--skip-fixtures', action='store_true', help="Skip the historical plan checks")
+    suite_parser.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,239 @@
+import collections
+import itertools
+import multiprocessing
+import threading
+import time
+import traceback
+
+# Finished jobs kept for the status and result endpoints
+JOB_HISTORY = 256
+
+def worker_main(conn):
+    # Runs in a worker process. The process is kept between jobs so its problem caches stay warm
+    while True:
+        try:
+            fn, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send(('done', fn(*args)))
+        except Exception:
+            conn.send(('failed', traceback.format_exc()))
+
+class Job:
+    def __init__(self, job_id, kind, key, fn, args, alternatives=None, deadline=None):
+        self.id = job_id
+        self.kind = kind
+        self.key = key
+        self.fn = fn
+        self.args = args
+        # Argument tuples that are run at the same time on separate workers. The first to finish completes the
+        # job with its arguments in args, and the others are stopped. The job fails when all of them fail or
+        # none has finished deadline seconds after the first started
+        self.alternatives = alternatives or [args]
+        self.deadline = deadline
+        self.winner = None
+        self.failures = []
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        # Sessions waiting for this job, a job is cancelled when the last one is detached
+        self.sessions = set()
+        self.callbacks = []
+        # Running alternative of every worker the job is on
+        self.workers = {}
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def summary(self):
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'sessions': len(self.sessions),
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'error': self.error,
+            'alternatives': len(self.alternatives),
+            'winner': self.winner
+        }
+
+class Worker:
+    def __init__(self, queue):
+        self.queue = queue
+        self.start()
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def start(self):
+        self.conn, child = self.queue.context.Pipe()
+        self.process = self.queue.context.Process(target=worker_main, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        self.stopped = False
+
+    def loop(self):
+        while True:
+            job, index = self.queue.next_job(self)
+            try:
+                self.conn.send((job.fn, job.alternatives[index]))
+                status, value = self.conn.recv()
+            except (EOFError, OSError):
+                # The process was terminated to cancel the job, or it crashed
+                status, value = 'failed', 'Worker process exited'
+                self.stopped = True
+            except Exception:
+                # The job or its result could not be sent, e.g. it does not pickle. The pipe may hold part of a
+                # message, so the process is replaced
+                status, value = 'failed', traceback.format_exc()
+                self.stopped = True
+                self.process.terminate()
+            self.queue.finish(job, index, self, status, value)
+            # A worker can also be terminated after it has answered, until finish has taken it off the job
+            if self.stopped:
+                self.process.join()
+                self.start()
+
+    def cancel(self):
+        # Called with the queue lock held
+        self.stopped = True
+        self.process.terminate()
+
+class JobQueue:
+    # Runs solves in a bounded pool of worker processes. Submitting the same key while a job is
+    # queued or running shares that job, and cancelling a running job terminates its worker.
+    # on_complete is called with every job that finishes, is cancelled or fails
+    def __init__(self, workers, history=JOB_HISTORY, on_complete=None):
+        self.context = multiprocessing.get_context('spawn')
+        self.lock = threading.Condition()
+        self.pending = collections.deque()
+        self.jobs = collections.OrderedDict()
+        self.active = {}
+        self.history = history
+        self.on_complete = on_complete
+        self.ids = itertools.count(1)
+        self.workers = [Worker(self) for _ in range(workers)]
+
+    def submit(self, kind, key, fn, args, session=None, callback=None, alternatives=None, deadline=None):
+        # Returns the job and whether an identical job was already queued or running. With alternatives, a list of
+        # argument tuples, fn runs with all of them at once and the first to finish is the result, see Job
+        with self.lock:
+            job = self.active.get(key)
+            shared = job is not None
+            if not shared:
+                job = Job(str(next(self.ids)), kind, key, fn, args, alternatives, deadline)
+                self.jobs[job.id] = job
+                self.active[key] = job
+                self.pending.extend((job, index) for index in range(len(job.alternatives)))
+                self.lock.notify_all()
+            if session is not None:
+                job.sessions.add(session)
+            # A shared job keeps the callback of its first submission, which runs once for all of its sessions
+            if callback is not None and not shared:
+                job.callbacks.append(callback)
+            return job, shared
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def detach(self, job_id, session):
+        # Drop a session from a job, cancelling the job if no other session waits for it
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job.sessions.discard(session)
+            if job.sessions:
+                return
+        self.cancel(job_id)
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.done.is_set():
+                return False
+            if job.status == 'queued':
+                self.stop(job)
+                self.complete(job, 'cancelled')
+            else:
+                job.status = 'cancelling'
+                self.stop(job)
+            return True
+
+    def stop(self, job):
+        # Drop the job's queued alternatives and terminate the workers running the others. Called with the lock held
+        self.pending = collections.deque(entry for entry in self.pending if entry[0] is not job)
+        for worker in job.workers:
+            worker.cancel()
+
+    def expire(self, job):
+        with self.lock:
+            if job.done.is_set():
+                return
+            self.stop(job)
+            self.complete(job, 'failed', error=f'No result within the deadline of {job.deadline} s\n' + '\n'.join(job.failures))
+
+    def next_job(self, worker):
+        # The next (job, alternative index) for worker
+        with self.lock:
+            while not self.pending:
+                self.lock.wait()
+            job, index = self.pending.popleft()
+            if job.started is None:
+                job.status = 'running'
+                job.started = time.time()
+                if job.deadline is not None:
+                    timer = threading.Timer(job.deadline, self.expire, (job,))
+                    timer.daemon = True
+                    timer.start()
+            job.workers[worker] = index
+            return job, index
+
+    def finish(self, job, index, worker, status, value):
+        with self.lock:
+            del job.workers[worker]
+            if job.done.is_set():
+                # Another alternative has finished first, or the job has expired
+                return
+            if job.status == 'cancelling':
+                if not job.workers:
+                    self.complete(job, 'cancelled')
+            elif status == 'done':
+                job.winner = index
+                job.args = job.alternatives[index]
+                self.stop(job)
+                self.complete(job, 'done', result=value)
+            else:
+                job.failures.append(value)
+                if not job.workers and not any(entry[0] is job for entry in self.pending):
+                    self.complete(job, 'failed', error='\n'.join(job.failures))
+            callbacks = job.callbacks if job.status == 'done' else []
+        for callback in callbacks:
+            callback(job)
+
+    def complete(self, job, status, result=None, error=None):
+        # Called with the lock held
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished = time.time()
+        if self.active.get(job.key) is job:
+            del self.active[job.key]
+        job.done.set()
+        if self.on_complete is not None:
+            self.on_complete(job)
+        finished = [old for old in self.jobs.values() if old.done.is_set()]
+        for old in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[old.id]
+
+    def stats(self):
+        with self.lock:
+            statuses = collections.Counter(job.status for job in self.jobs.values())
+            return {
+                'workers': len(self.workers),
+                'pending': len(self.pending),
+                'statuses': dict(statuses)
+            }
@@ -0,0 +1,229 @@
+import argparse
+import multiprocessing
+import os
+import signal
+import time
+from functools import lru_cache
+import numpy as np
+import optimal_pacing as opt
+import route_store
+from simulator import create_initialization
+
+# Problem templates are shared between solves, so the intervals per lap are rounded up to a multiple of this
+N_BUCKET = 50
+# Coordination has converged when every lap solved and starts within these of the speed [m/s] and W'bal [J]
+# the lap before it ends with. It stops without converging after MAX_ITERATIONS steps
+SPEED_TOLERANCE = 0.05
+W_BAL_TOLERANCE = 50
+MAX_ITERATIONS = 30
+# Share of the way the end prices move towards the start multipliers of the next lap in one step
+PRICE_RELAXATION = 0.5
+# IPOPT options of the lap subproblems. A lap that fails keeps its solution of the step before
+LAP_IPOPT_OPTIONS = {"max_iter": 1000}
+
+def lap_bounds(route_name, num_laps):
+    # Index of the first and last route point of every lap. A lap ends where the next one starts
+    distance = route_store.get_route(route_name, num_laps)['distance']
+    lap_length = route_store.get_route(route_name, 1)['distance'].max()
+    ends = [int(np.argmin(np.abs(distance - lap*lap_length))) for lap in range(1, num_laps)]
+    return list(zip([0] + ends, ends + [len(distance) - 1]))
+
+def lap_route(route_name, num_laps, lap):
+    # Distance from the start of the lap, elevation, friction and gradient of one lap, cut from the whole
+    # route so the gradient near the lap ends is smoothed as in a solve of the whole route
+    route = route_store.get_route(route_name, num_laps)
+    start, end = lap_bounds(route_name, num_laps)[lap]
+    cut = slice(start, end + 1)
+    return route['distance'][cut] - route['distance'][start], route['elevation'][cut], route['friction'][cut], route['gradient'][2][cut]
+
+@lru_cache(maxsize=16)
+def get_lap_problem(route_name, num_laps, lap, N, integration_method, formulation):
+    # Every lap but the last is paid for the speed and W'bal it ends with, at the prices set by the coordination
+    distance, elevation, friction, slope = lap_route(route_name, num_laps, lap)
+    optimization_opts = {
+        "N": N,
+        "smooth_power_constraint": True,
+        "w_bal_model": "ODE",
+        "integration_method": integration_method,
+        "solver": "ipopt",
+        "negative_split": False,
+        "formulation": formulation,
+        "terminal_price": lap < num_laps - 1,
+        "ipopt_options": LAP_IPOPT_OPTIONS,
+        "quiet": True
+    }
+    return opt.build_problem(distance, elevation, friction, optimization_opts, interpolants=opt.create_interpolants(distance, slope, friction))
+
+def init_worker():
+    # Ctrl-C is handled in the main process, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def lap_initialization(distance, elevation, slope, params, x0, N, formulation):
+    # Simulated initialization of one lap from its own start state. Starting from the lap's speed and W'bal
+    # gives IPOPT a much better first guess than the simulation of the whole race cut at the lap
+    timegrid = np.linspace(0, round(distance[-1]/1000*150), round(distance[-1]/5))
+    X, power, t_grid = create_initialization(timegrid, x0, distance, elevation, params, slope=slope)
+    simulated = {'time': t_grid, 'pos': X[0], 'speed': X[1], 'w_bal': X[2], 'power': power, 'lam_g': {}}
+    return opt.shift_solution(simulated, 0, N, formulation, x0, params.get('w_prime'), distance[-1])
+
+def solve_lap(task):
+    # One lap from the start state of the task, with the task's prices on its end state. Runs in a pool process.
+    # The start multipliers are what the start state is worth to the lap and the laps after it, in seconds
+    # per m/s and per J
+    start = time.perf_counter()
+    problem = get_lap_problem(task['route'], task['num_laps'], task['lap'], task['N'], task['integration_method'], task['formulation'])
+    distance, elevation, friction, slope = lap_route(task['route'], task['num_laps'], task['lap'])
+    params = opt.model_params(task['athlete'], friction)
+    x0 = [0, *task['start']]
+    initialization = task['initialization']
+    if initialization is None:
+        initialization = lap_initialization(distance, elevation, slope, params, x0, task['N'], task['formulation'])
+    # Only the primal solution is reused. After a change of the start state or prices the old multipliers
+    # start IPOPT further from the solution than its own initialization does
+    initialization['lam_g'] = None
+    try:
+        sol, _, _, _, _ = opt.solve_problem(problem, x0, params, {"terminal_price": task['price']}, initialization)
+    except RuntimeError:
+        return {'lap': task['lap'], 'solution': None, 'wall': time.perf_counter() - start}
+    solution = opt.extract_solution(sol, problem)
+    lam_g = solution['lam_g']
+    return {
+        'lap': task['lap'],
+        'solution': solution,
+        'start_price': np.array([lam_g['speed_start'][0, 0], lam_g['w_bal_start'][0, 0]]),
+        'iterations': sol.stats()['iter_count'],
+        'wall': time.perf_counter() - start
+    }
+
+def race_initialization(route, params):
+    # Simulated initialization of the whole race, as the server starts a solve
+    distance = route['distance']
+    N = round(distance[-1]/5)
+    timegrid = np.linspace(0, round(distance[-1]/1000*150), N)
+    X, power, t_grid = create_initialization(timegrid, [distance[0], 1, params.get('w_prime')], distance, route['elevation'], params, slope=route['gradient'][2])
+    return {'time': t_grid, 'pos': X[0], 'speed': X[1], 'w_bal': X[2], 'power': power, 'lam_g': {}}
+
+def stitch(solutions, starts):
+    # One solution of the race from the lap solutions. A lap's first node replaces the last node of the lap before
+    parts = {name: [] for name in ('time', 'pos', 'speed', 'w_bal', 'power')}
+    elapsed = 0
+    for lap, (solution, start) in enumerate(zip(solutions, starts)):
+        cut = slice(0, None if lap == len(solutions) - 1 else -1)
+        parts['time'].append(solution['time'][cut] + elapsed)
+        parts['pos'].append(solution['pos'][cut] + start)
+        for name in ('speed', 'w_bal', 'power'):
+            parts[name].append(solution[name][cut])
+        elapsed += solution['T']
+    race = {name: np.concatenate(values) for name, values in parts.items()}
+    race['T'] = elapsed
+    race['lam_g'] = {}
+    return race
+
+def solve_laps(route_name, num_laps, athlete, integration_method="RK4", formulation="time", map_fn=map, log=None):
+    # Time-optimal race as one subproblem per lap, all solved in every coordination step with map_fn, e.g. a
+    # Pool's map. Every lap but the last minimizes its time less the value of its end speed and W'bal at a
+    # price, and starts from the state the lap before ended with in the step before. The prices move towards
+    # the start multipliers of the next lap, which are what its start state is worth to the rest of the race.
+    # When the lap boundaries agree, the laps together satisfy the optimality conditions of the whole race.
+    # Returns the joined race solution and the statistics of every step. Unless the last step has converged,
+    # the laps do not join up and the race is not a solution of the whole race
+    if num_laps < 2:
+        raise ValueError("Lap decomposition needs at least two laps")
+    route = route_store.get_route(route_name, num_laps)
+    params = opt.model_params(athlete, route['friction'])
+    starts = [route['distance'][start] for start, _ in lap_bounds(route_name, num_laps)]
+
+    initialization = race_initialization(route, params)
+    N = int(np.ceil((len(initialization['power']) - 1)/num_laps/N_BUCKET)*N_BUCKET)
+    # Start speed and W'bal of every lap, from the simulation of the race until the laps have end states
+    states = np.array([[1, athlete['w_prime']]] + [[np.interp(start, initialization['pos'], initialization['speed']), np.interp(start, initialization['pos'], initialization['w_bal'])] for start in starts[1:]])
+    lower = np.array([1, 0])
+    upper = np.array([25, athlete['w_prime']])
+    tolerance = np.array([SPEED_TOLERANCE, W_BAL_TOLERANCE])
+    # Price of the end state of every lap but the last. The first step only finds them
+    prices = np.zeros((num_laps - 1, 2))
+
+    results = [None]*num_laps
+    steps = []
+    for iteration in range(MAX_ITERATIONS):
+        tasks = []
+        for lap in range(num_laps):
+            # Later steps start from the lap's last solution, moved to the new start state. The laps of the first
+            # step ended as if their end state were worth nothing, so the second step starts from a simulation again
+            lap_init = None
+            if iteration > 1 and results[lap] is not None:
+                lap_init = opt.shift_solution(results[lap]['solution'], 0, N, formulation, [0, *states[lap]], athlete['w_prime'])
+            tasks.append({
+                'route': route_name,
+                'num_laps': num_laps,
+                'lap': lap,
+                'N': N,
+                'integration_method': integration_method,
+                'formulation': formulation,
+                'athlete': athlete,
+                'start': tuple(states[lap]),
+                'price': tuple(prices[lap]) if lap < num_laps - 1 else None,
+                'initialization': lap_init
+            })
+        start = time.perf_counter()
+        step_results = list(map_fn(solve_lap, tasks))
+        wall = time.perf_counter() - start
+        failed = [result['lap'] for result in step_results if result['solution'] is None]
+        if failed and iteration == 0:
+            raise RuntimeError(f"Laps {failed} failed to solve")
+        results = [result if result['solution'] is not None else results[result['lap']] for result in step_results]
+
+        end_states = np.array([[result['solution']['speed'][-1], result['solution']['w_bal'][-1]] for result in results])
+        mismatch = np.abs(end_states[:-1] - states[1:]).max(axis=0)
+        converged = iteration > 0 and not failed and bool(np.all(mismatch < tolerance))
+        step = {
+            'iteration': iteration,
+            'T': sum(result['solution']['T'] for result in results),
+            'wall': wall,
+            # Wall time of the step with one process per lap
+            'critical_path': max(result['wall'] for result in step_results),
+            'iterations': [result.get('iterations') for result in step_results],
+            'failed': failed,
+            'mismatch': mismatch,
+            'converged': converged
+        }
+        steps.append(step)
+        if log is not None:
+            log(step)
+        if converged:
+            break
+
+        start_prices = np.array([result['start_price'] for result in results[1:]])
+        if iteration == 0:
+            # The laps ended as if their end state were worth nothing, so only the prices are kept
+            prices = start_prices
+        else:
+            prices = prices + PRICE_RELAXATION*(start_prices - prices)
+            states[1:] = np.clip(end_states[:-1], lower, upper)
+    return stitch([result['solution'] for result in results], starts), steps
+
+def main(args):
+    athlete = {'weight': args.weight, 'cp': args.cp, 'w_prime': args.w_prime, 'max_power': args.max_power}
+    def log(step):
+        print(f"Step {step['iteration']}: T {step['T']:.2f} s in {step['wall']:.1f} s, IPOPT iterations {step['iterations']}, "
+              f"boundary mismatch {step['mismatch'][0]:.3f} m/s and {step['mismatch'][1]:.0f} J", flush=True)
+    start = time.perf_counter()
+    with multiprocessing.get_context('spawn').Pool(min(args.workers, args.num_laps), init_worker) as pool:
+        race, steps = solve_laps(args.route, args.num_laps, athlete, args.integration_method, args.formulation, pool.map, log)
+    wall_time = time.perf_counter() - start
+    critical_path = wall_time - sum(step['wall'] - step['critical_path'] for step in steps)
+    status = "" if steps[-1]['converged'] else ", not converged"
+    print(f"T {race['T']:.2f} s in {wall_time:.1f} s and {len(steps)} steps{status}, {critical_path:.1f} s with one process per lap")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Multi-lap race solved as one optimization per lap")
+    parser.add_argument('--route', default='Mech Isle Loop', help="Route name")
+    parser.add_argument('--num-laps', type=int, default=2)
+    parser.add_argument('--weight', type=float, default=75)
+    parser.add_argument('--cp', type=float, default=290)
+    parser.add_argument('--w-prime', type=float, default=25000)
+    parser.add_argument('--max-power', type=float, default=670)
+    parser.add_argument('--integration-method', default='RK4', choices=['Euler', 'Midpoint', 'RK4'])
+    parser.add_argument('--formulation', default='time', choices=['time'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    main(parser.parse_args())
@@ -0,0 +1,139 @@
+import bisect
+import collections
+import threading
+import time
+import numpy as np
+
+# Requests kept per kind for the rolling summaries
+METRICS_HISTORY = 512
+# Histogram upper bounds, in seconds for the latencies
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+ITERATION_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# IPOPT callbacks timed by CasADi. The rest of the IPOPT wall time is spent in IPOPT itself,
+# mostly in the linear solver, and is reported as ipopt_internal
+SOLVER_FUNCTIONS = ('nlp_f', 'nlp_g', 'nlp_grad_f', 'nlp_jac_g', 'nlp_hess_l')
+
+def solver_metrics(stats):
+    # The parts of sol.stats() that are kept, from an Opti or a compiled solve
+    functions = {name: {'wall': stats.get(f't_wall_{name}', 0.0), 'calls': stats.get(f'n_call_{name}', 0)} for name in SOLVER_FUNCTIONS}
+    total = stats.get('t_wall_total')
+    if total is not None:
+        functions['ipopt_internal'] = {'wall': max(0.0, total - sum(function['wall'] for function in functions.values())), 'calls': stats['iter_count']}
+    return {
+        'iterations': stats['iter_count'],
+        'return_status': stats['return_status'],
+        'success': bool(stats['success']),
+        'wall_total': total,
+        'functions': functions
+    }
+
+def problem_dimensions(problem, N):
+    if problem.get('compiled'):
+        x, lam_g = problem['symbols']
+        return {'N': N, 'variables': x.size1(), 'constraints': lam_g.size1()}
+    return {'N': N, 'variables': problem['opti'].nx, 'constraints': problem['opti'].ng}
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+class Metrics:
+    # Rolling per-request records for the JSON summaries, and histograms and counters since startup
+    # for Prometheus. Label sets are tuples of (name, value) pairs
+    def __init__(self, history=METRICS_HISTORY):
+        self.lock = threading.Lock()
+        self.records = collections.defaultdict(lambda: collections.deque(maxlen=history))
+        self.histograms = {}
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.started = time.time()
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        # Called with the lock held
+        key = (name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(buckets)
+        self.histograms[key].observe(value)
+
+    def record(self, kind, outcome, latency, stages=None, solver=None, dimensions=None):
+        # One finished request. stages are wall times in seconds, solver is from solver_metrics
+        record = {'time': time.time(), 'outcome': outcome, 'latency': latency, 'stages': stages or {}, 'solver': solver, 'dimensions': dimensions}
+        with self.lock:
+            self.records[kind].append(record)
+            self.counters[('pacing_requests_total', (('kind', kind), ('outcome', outcome)))] += 1
+            self.observe('pacing_request_latency_seconds', (('kind', kind), ('outcome', outcome)), latency)
+            for stage, seconds in (stages or {}).items():
+                self.observe('pacing_stage_seconds', (('kind', kind), ('stage', stage)), seconds)
+            if solver is not None:
+                self.counters[('pacing_solver_status_total', (('kind', kind), ('status', solver['return_status'])))] += 1
+                self.observe('pacing_solver_iterations', (('kind', kind),), solver['iterations'], ITERATION_BUCKETS)
+                for function, values in solver['functions'].items():
+                    self.observe('pacing_solver_function_seconds', (('kind', kind), ('function', function)), values['wall'])
+            if dimensions is not None:
+                for name, value in dimensions.items():
+                    self.gauges[(f'pacing_problem_{name}', (('kind', kind),))] = value
+
+    def summary(self):
+        # Latency percentiles per kind and stage over the rolling window, with the latest records
+        def percentiles(values):
+            values = np.array(values, dtype=float)
+            return {'count': len(values), 'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+                'p95': float(np.percentile(values, 95)), 'max': float(values.max())}
+
+        with self.lock:
+            records = {kind: list(values) for kind, values in self.records.items()}
+        summary = {'uptime': time.time() - self.started, 'kinds': {}}
+        for kind, values in records.items():
+            stages = collections.defaultdict(list)
+            functions = collections.defaultdict(list)
+            for record in values:
+                for stage, seconds in record['stages'].items():
+                    stages[stage].append(seconds)
+                if record['solver'] is not None:
+                    for function, function_values in record['solver']['functions'].items():
+                        functions[function].append(function_values['wall'])
+            solved = [record['solver'] for record in values if record['solver'] is not None]
+            summary['kinds'][kind] = {
+                'outcomes': dict(collections.Counter(record['outcome'] for record in values)),
+                'latency': percentiles([record['latency'] for record in values]),
+                'stages': {stage: percentiles(seconds) for stage, seconds in stages.items()},
+                'solver_functions': {function: percentiles(seconds) for function, seconds in functions.items()},
+                'iterations': percentiles([solver['iterations'] for solver in solved]) if solved else None,
+                'return_statuses': dict(collections.Counter(solver['return_status'] for solver in solved)),
+                'recent': values[-10:]
+            }
+        return summary
+
+    def prometheus(self):
+        # Prometheus text exposition format
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}' if pairs else ''
+
+        lines = []
+        with self.lock:
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                lines.append(f'# TYPE {name} counter')
+                lines += [f'{name}{label_text(labels)} {value}' for (counter, labels), value in sorted(self.counters.items()) if counter == name]
+            for name in sorted({name for name, _ in self.gauges}):
+                lines.append(f'# TYPE {name} gauge')
+                lines += [f'{name}{label_text(labels)} {value}' for (gauge, labels), value in sorted(self.gauges.items()) if gauge == name]
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (histogram_name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{label_text(labels, [("le", bound)])} {cumulative}')
+                    lines.append(f'{name}_sum{label_text(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{label_text(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
@@ -1,36 +1,34 @@
+import hashlib
+import json
+import os
+import subprocess
+import time
 import casadi as ca
 import numpy as np
 from scipy.ndimage import gaussian_filter1d
 
 def calculate_gradient(distance, elevation):
-    gradient = []
-    for i in range(len(distance)-1):
-        delta_elevation = elevation[i] - elevation[i+1]
-        delta_distance = distance[i] - distance[i+1]
-        if delta_distance != 0:
-            gradient.append(delta_elevation/delta_distance)
-        else:
-            gradient.append(0)
-    gradient.append(0)
+    delta_elevation = np.diff(np.asarray(elevation, dtype=float))
+    delta_distance = np.diff(np.asarray(distance, dtype=float))
+    gradient = np.zeros(len(delta_distance)+1)
+    nonzero = delta_distance != 0
+    gradient[:-1][nonzero] = delta_elevation[nonzero]/delta_distance[nonzero]
     return gradient
 
 def extend_route(distance, elevation, friction, num_laps):
-    new_elevation = []
-    new_distance = []
-    new_friction = []
-    for i in range(num_laps):
-        new_elevation.extend(elevation)
-        new_friction.extend(friction)
-        new_distance.extend([elem + i*max(distance) for elem in distance])
-    elevation = new_elevation
-    distance = new_distance
-    friction = new_friction
-    for i in range(len(distance)-10):
-        if distance[i+1] - distance[i] < 0.6:
-            distance.pop(i+1)
-            elevation.pop(i+1)
-            friction.pop(i+1)
-    return new_distance, new_elevation, new_friction
+    distance = np.asarray(distance, dtype=float)
+    lap_length = distance.max()
+    new_distance = (distance + lap_length*np.arange(num_laps)[:,None]).flatten()
+    new_elevation = np.tile(np.asarray(elevation, dtype=float), num_laps)
+    new_friction = np.tile(np.asarray(friction, dtype=float), num_laps)
+
+    # A point within 0.6 m of the point before it is dropped, unless that point was dropped itself. In a run of
+    # such points every other one is dropped, counting from the run's first point, as the original loop did
+    spaced = np.concatenate([[True], np.diff(new_distance) >= 0.6])
+    index = np.arange(len(new_distance))
+    run_start = np.maximum.accumulate(np.where(spaced, index, 0))
+    keep = spaced | ((index - run_start) % 2 == 0)
+    return new_distance[keep], new_elevation[keep], new_friction[keep]
 
 def smooth_w_balance_ode_derivative(u, cp, x, w_prime, smoothness=10):
     transition = 0.5 + 0.5*ca.tanh((u - cp)/smoothness)
@@ -38,7 +36,9 @@ def smooth_w_balance_ode_derivative(u, cp, x, w_prime, smoothness=10):
     return (1-transition)*(1-x[2]/w_prime)*(cp-u) + transition*(cp-u)
 
 def moving_avg(x, window_size):
-    return np.convolve(x, np.ones(window_size), 'valid') / window_size
+    # Differences of the running sum, the same values as a 'valid' convolution with a box of window_size
+    total = np.concatenate([[0], np.cumsum(x, dtype=float)])
+    return (total[window_size:] - total[:-window_size]) / window_size
 
 def normalized_power(power):
     ma = moving_avg(power, 30)
@@ -46,219 +46,833 @@ def normalized_power(power):
     avg = np.mean(ma_r)
     return np.power(avg, 1/4)
 
-def solve_opt(distance, elevation, params, optimization_opts, initialization):
+# Athlete and mechanical model params that are opti.parameters in a problem template
+MODEL_PARAMS = ['mass_rider', 'mass_bike', 'g', 'b0', 'b1', 'Iw', 'r', 'Cd', 'rho', 'A', 'eta', 'w_prime', 'cp', 'alpha']
+
+def model_params(opt_config, friction):
+    # Rider and bike model of every solve, correction, lap solve and replay. opt_config needs the athlete's
+    # weight, cp, w_prime and max_power
+    return {
+        'mass_rider': opt_config['weight'],
+        'mass_bike': 8.4,
+        'g': 9.81,
+        'mu': friction,
+        'b0': 0.091,
+        'b1': 0.0087,
+        'Iw': 0.14,
+        'r': 0.33,
+        'Cd': 0.7,
+        'rho': 1.2,
+        'A': 0.4,
+        'eta': 1,
+        'w_prime': opt_config['w_prime'],
+        'cp': opt_config['cp'],
+        'alpha': (opt_config['max_power']-opt_config['cp'])/opt_config['w_prime']
+    }
+
+def create_interpolants(distance, slope, mu):
+    interpolated_slope = ca.interpolant('Slope', 'bspline', [distance], slope)
+    interpolated_friction = ca.interpolant('Friction', 'bspline', [distance], mu)
+    return interpolated_slope, interpolated_friction
+
+def distance_grid(start, end, N, first_step=0.1, growth=1.3):
+    # Position grid for the distance formulation. Steps grow geometrically from first_step
+    # so the acceleration from a standing start is resolved, then stay uniform to the finish
+    ramp = []
+    step = first_step
+    while step < (end - start - sum(ramp))/(N - len(ramp)) and len(ramp) < N//4:
+        ramp.append(step)
+        step *= growth
+    uniform = np.full(N - len(ramp), (end - start - sum(ramp))/(N - len(ramp)))
+    return start + np.concatenate([[0], np.cumsum(np.concatenate([ramp, uniform]))])
+
+def solver_options(optimization_opts):
+    p_opts = {"expand": False}
+    s_opts = {"max_iter": 20000}
+    if optimization_opts.get("quiet"):
+        p_opts.update({"print_time": False, "record_time": True})
+        s_opts.update({"print_level": 0, "sb": "yes"})
+    if optimization_opts.get("warm_start"):
+        # Start IPOPT from the provided primal-dual point instead of pushing it into the interior
+        s_opts.update({
+            "warm_start_init_point": "yes",
+            "warm_start_bound_push": 1e-3,
+            "warm_start_bound_frac": 1e-3,
+            "warm_start_slack_bound_push": 1e-3,
+            "warm_start_slack_bound_frac": 1e-3,
+            "warm_start_mult_bound_push": 1e-3,
+            "mu_init": 1e-2
+        })
+    # Any other IPOPT options, which take precedence over the ones above
+    s_opts.update(optimization_opts.get("ipopt_options") or {})
+    return p_opts, s_opts
+
+def build_problem(distance, elevation, mu, optimization_opts, sigma=2, interpolants=None):
     N = optimization_opts.get("N")
+    formulation = optimization_opts.get("formulation", "time")
+    # Optional node locations as fractions of the final time (time formulation) or of the route (distance formulation)
+    grid = optimization_opts.get("grid")
     opti = ca.Opti()
     X = opti.variable(3, N+1)
-    pos = X[0,:]
+    U = opti.variable(1,N+1)
+    if formulation == "time":
+        T = opti.variable()
+        pos = X[0,:]
+        pos_grid = None
+        if grid is None:
+            grid = np.linspace(0, 1, N+1)
+        time = T*ca.DM(grid).T
+    elif formulation == "distance":
+        # Position is the independent variable on a fixed grid and the first state is time
+        if grid is None:
+            pos_grid = distance_grid(distance[0], distance[-1], N)
+        else:
+            pos_grid = distance[0] + np.asarray(grid)*(distance[-1] - distance[0])
+        time = X[0,:]
+        T = time[-1]
+        pos = ca.DM(pos_grid).T
+    else:
+        raise ValueError()
     speed = X[1,:]
     w_bal = X[2,:]
-    U = opti.variable(1,N+1)
-    T = opti.variable()
+
+    # Model params and boundary states are set per solve
+    p = {name: opti.parameter() for name in MODEL_PARAMS}
+    X0 = opti.parameter(3)
+    # In the time formulation the start position X0[0] and the end position are parameters, so one problem
+    # serves every reoptimization and window of the route. The position grid of the distance formulation is fixed
+    pos_end = opti.parameter() if formulation == "time" else None
+
+    # The integration step is a Function of one interval that is mapped over all N intervals,
+    # the model params are inputs so the step does not depend on the opti parameters
+    q = ca.MX.sym('q', len(MODEL_PARAMS))
+    model = dict(zip(MODEL_PARAMS, ca.vertsplit(q)))
 
     # Mechanical model params
-    mass_rider = params.get("mass_rider")
-    mass_bike = params.get("mass_bike")
-    m = mass_bike + mass_rider
-    g = params.get("g")
-    mu = params.get("mu")
-    b0 = params.get("b0")
-    b1 = params.get("b1")
-    Iw = params.get("Iw")
-    r = params.get("r")
-    Cd = params.get("Cd")
-    rho = params.get("rho")
-    A = params.get("A")
-    eta = params.get("eta")
+    m = model['mass_bike'] + model['mass_rider']
+    g = model['g']
+    b0 = model['b0']
+    b1 = model['b1']
+    Iw = model['Iw']
+    r = model['r']
+    Cd = model['Cd']
+    rho = model['rho']
+    A = model['A']
+    eta = model['eta']
 
     # Physiological model params
-    w_prime = params.get("w_prime")
-    cp = params.get("cp")
-
-    sigma = 2
-    smoothed_elev = gaussian_filter1d(elevation, sigma)
+    w_prime = model['w_prime']
+    cp = model['cp']
 
-    slope = calculate_gradient(distance, smoothed_elev)
-    interpolated_slope = ca.interpolant('Slope', 'bspline', [distance], slope)
-    interpolated_friction = ca.interpolant('Friction', 'bspline', [distance], mu)
+    if interpolants is None:
+        smoothed_elev = gaussian_filter1d(elevation, sigma)
+        slope = calculate_gradient(distance, smoothed_elev)
+        interpolants = create_interpolants(distance, slope, mu)
+    interpolated_slope, interpolated_friction = interpolants
 
+    acceleration = lambda v,u,slope,friction: (1/v * 1/(m + Iw/r**2)) * (eta*u - friction*m*g*v - m*g*slope*v - b0*v - b1*v**2 - 0.5*Cd*rho*A*v**3)
     if optimization_opts.get("w_bal_model") == "ODE":  
-        f = lambda x,u: ca.vertcat(x[1], 
-                    (1/x[1] * 1/(m + Iw/r**2)) * (eta*u - interpolated_friction(x[0])*m*g*x[1] - m*g*interpolated_slope(x[0])*x[1] - b0*x[1] - b1*x[1]**2 - 0.5*Cd*rho*A*x[1]**3),
-                    smooth_w_balance_ode_derivative(u, cp, x, w_prime))     
+        w_bal_derivative = lambda x,u: smooth_w_balance_ode_derivative(u, cp, x, w_prime)
     elif optimization_opts.get("w_bal_model") == "Simple":
-        f = lambda x,u: ca.vertcat(x[1], 
-                    (1/x[1] * 1/(m + Iw/r**2)) * (eta*u - interpolated_friction(x[0])*m*g*x[1] - m*g*interpolated_slope(x[0])*x[1] - b0*x[1] - b1*x[1]**2 - 0.5*Cd*rho*A*x[1]**3), 
-                    -(u-cp))
+        w_bal_derivative = lambda x,u: -(u-cp)
     else:
         raise ValueError()
 
-    dt = T/N
+    xk = ca.MX.sym('x', 3)
+    uk = ca.MX.sym('u')
+    hk = ca.MX.sym('h')
+    # Gradient (row 0) and friction (row 1) at the start, midpoint and end of the interval
+    terrain = ca.MX.sym('terrain', 2, 3)
+    if formulation == "time":
+        h = T*ca.DM(np.diff(grid)).T
+        terrain_nodes = ca.DM.zeros(2, 3)
+        f = lambda x,u,j: ca.vertcat(x[1], 
+                    acceleration(x[1], u, interpolated_slope(x[0]), interpolated_friction(x[0])),
+                    w_bal_derivative(x, u))
+    else:
+        # Gradient and friction are constants on the nodes and interval midpoints, j indexes them
+        steps = np.diff(pos_grid)
+        h = ca.DM(steps).T
+        half_grid = np.zeros(2*N+1)
+        half_grid[0::2] = pos_grid
+        half_grid[1::2] = pos_grid[:-1] + steps/2
+        slope_half = np.array(interpolated_slope.map(2*N+1)(half_grid)).flatten()
+        friction_half = np.array(interpolated_friction.map(2*N+1)(half_grid)).flatten()
+        half_nodes = (2*np.arange(N)[:,None] + np.arange(3)).flatten()
+        terrain_nodes = ca.DM(np.vstack([slope_half[half_nodes], friction_half[half_nodes]]))
+        f = lambda x,u,j: ca.vertcat(1, 
+                    acceleration(x[1], u, terrain[0,j], terrain[1,j]),
+                    w_bal_derivative(x, u))/x[1]
+
     if optimization_opts.get("integration_method") == "Euler":
-        for k in range(N):
-            x_next = X[:,k] + dt*f(X[:,k], U[:,k])
-            opti.subject_to(X[:,k+1] == x_next)
+        x_next = xk + hk*f(xk, uk, 0)
     elif optimization_opts.get("integration_method") == "Midpoint":
-        for k in range(N):
-            k1 = f(X[:,k], U[:,k])
-            x_next = X[:,k] + dt*f(X[:,k] + dt/2*k1, U[:,k])
-            opti.subject_to(X[:,k+1] == x_next)
+        k1 = f(xk, uk, 0)
+        x_next = xk + hk*f(xk + hk/2*k1, uk, 1)
     elif optimization_opts.get("integration_method") == "RK4":
-        for k in range(N): 
-            k1 = f(X[:,k], U[:,k])
-            k2 = f(X[:,k] + dt/2*k1, U[:,k])
-            k3 = f(X[:,k] + dt/2*k2, U[:,k])
-            k4 = f(X[:,k] + dt*k3, U[:,k])
-            x_next = X[:,k] + dt/6*(k1+2*k2+2*k3+k4)
-            opti.subject_to(X[:,k+1] == x_next)
+        k1 = f(xk, uk, 0)
+        k2 = f(xk + hk/2*k1, uk, 1)
+        k3 = f(xk + hk/2*k2, uk, 1)
+        k4 = f(xk + hk*k3, uk, 2)
+        x_next = xk + hk/6*(k1+2*k2+2*k3+k4)
     else:
         raise ValueError()
+    step = ca.Function('step', [xk, uk, hk, terrain, q], [x_next])
+    if formulation == "distance":
+        # Without interpolant calls the step is a plain scalar expression and is cheaper as SX
+        step = step.expand()
+
+    parallelization = optimization_opts.get("parallelization", "serial")
+    if parallelization == "thread":
+        step_map = step.map(N, "thread", optimization_opts.get("threads", os.cpu_count()))
+    elif parallelization in ("serial", "unroll"):
+        step_map = step.map(N, parallelization)
+    else:
+        raise ValueError()
+
+    # Constraints are added through subject_to so their multipliers can be located in lam_g
+    layout = []
+    def subject_to(name, constraint, nodes):
+        ng = opti.ng
+        opti.subject_to(constraint)
+        layout.append((name, (opti.ng - ng)//nodes, nodes))
+
+    # One defect constraint for all intervals, h and terrain_nodes are repeated if not given per interval
+    x_next = step_map(X[:,:-1], U[:,:-1], h, terrain_nodes, ca.vertcat(*p.values()))
+    subject_to('dynamics', X[:,1:] == x_next, N)
     
+    objective = T
     if optimization_opts.get("smooth_power_constraint"):
-        opti.minimize(T + 0.00005 * ca.sumsqr(U[:,1:] - U[:,:-1])) 
-    else:
-        opti.minimize(T) 
+        objective = objective + 0.00005 * ca.sumsqr(U[:,1:] - U[:,:-1])
+    terminal_price = None
+    if optimization_opts.get('terminal_price'):
+        # For one lap of a race, the speed and W'bal at its end are worth the time they save on the laps
+        # after it, in seconds per m/s and per J
+        terminal_price = opti.parameter(2)
+        objective = objective - terminal_price[0]*speed[-1] - terminal_price[1]*w_bal[-1]
+    opti.minimize(objective)
 
 
     # Max power constraint params
-    alpha = params.get("alpha")
+    alpha = p['alpha']
+    cp = p['cp']
+    w_prime = p['w_prime']
     U_max = alpha*w_bal + cp
 
     # Set the path constraints
-    opti.subject_to(U <= U_max)
-    opti.subject_to(U >= 0)
-    opti.subject_to(opti.bounded(0, w_bal, w_prime))
-    opti.subject_to(opti.bounded(1, speed, 25))
+    subject_to('power_max', U <= U_max, N+1)
+    subject_to('power_min', U >= 0, N+1)
+    subject_to('w_bal', opti.bounded(0, w_bal, w_prime), N+1)
+    subject_to('speed', opti.bounded(1, speed, 25), N+1)
 
+    w_bal_bounds = None
     if optimization_opts.get('negative_split'):
-        w_bal_start = optimization_opts.get("w_bal_start")
-        w_bal_end = optimization_opts.get("w_bal_end")
-        x = ca.linspace(0,T,N+1)
-        opti.subject_to(w_bal > (w_bal_end-w_bal_start)/T *ca.transpose(x) + w_bal_start)
+        w_bal_start = opti.parameter()
+        w_bal_end = opti.parameter()
+        subject_to('negative_split', w_bal > (w_bal_end-w_bal_start)/T *time + w_bal_start, N+1)
+        w_bal_bounds = (w_bal_start, w_bal_end)
 
-    # Set boundary conditions
-    opti.subject_to(pos[0]==distance[0]) 
-    opti.subject_to(speed[0]==1) 
-    opti.subject_to(pos[-1]==distance[-1])
-    opti.subject_to(w_bal[0]==w_prime)
+    w_bal_terminal = None
+    if optimization_opts.get('terminal_w_bal'):
+        # For a window of the route, W'bal at its end has to cover what the rest of the route needs
+        w_bal_terminal = opti.parameter()
+        subject_to('w_bal_terminal', w_bal[-1] >= w_bal_terminal, 1)
 
-    opti.subject_to(opti.bounded(0, T, distance[-1]/1000*180)) 
+    # Set boundary conditions
+    if formulation == "time":
+        subject_to('pos_start', pos[0]==X0[0], 1)
+        subject_to('speed_start', speed[0]==X0[1], 1)
+        subject_to('pos_end', pos[-1]==pos_end, 1)
+        length = pos_end - X0[0]
+    else:
+        subject_to('time_start', time[0]==0, 1)
+        subject_to('speed_start', speed[0]==X0[1], 1)
+        length = distance[-1] - distance[0]
+    subject_to('w_bal_start', w_bal[0]==X0[2], 1)
 
-    # Provide an initial guess
-    opti.set_initial(T, initialization.get('time_init'))
-    opti.set_initial(pos, initialization.get('pos_init'))
-    opti.set_initial(speed, initialization.get('speed_init'))
-    opti.set_initial(w_bal, initialization.get('w_bal_init'))
-    opti.set_initial(U, initialization.get('power_init'))
+    subject_to('time', opti.bounded(0, T, length/1000*180), 1)
 
-    p_opts = {"expand": False}
-    s_opts = {"max_iter": 20000}
+    p_opts, s_opts = solver_options(optimization_opts)
     opti.solver(optimization_opts.get('solver'), p_opts, s_opts) 
-    sol = opti.solve()
-    return sol, opti, T, U, X
 
+    return {
+        'opti': opti,
+        'N': N,
+        'formulation': formulation,
+        'layout': layout,
+        'states': X,
+        'X': ca.vertcat(pos, speed, w_bal),
+        'U': U,
+        'T': T,
+        'time': time,
+        'pos_grid': pos_grid,
+        'grid': None if formulation == "distance" else np.asarray(grid),
+        'params': p,
+        'X0': X0,
+        'pos_end': pos_end,
+        'route_end': distance[-1],
+        'w_bal_bounds': w_bal_bounds,
+        'w_bal_terminal': w_bal_terminal,
+        'terminal_price': terminal_price,
+        'lam_g': opti.lam_g
+    }
+
+def initial_guess(problem, initialization):
+    # Initial guess for the raw states, power and (time formulation) final time
+    if problem['formulation'] == "time":
+        states = np.vstack([initialization.get('pos_init'), initialization.get('speed_init'), initialization.get('w_bal_init')])
+        return states, np.asarray(initialization.get('power_init')), initialization.get('time_init')
+
+    # Map the initial guess from its own samples onto the position grid
+    pos_init = np.asarray(initialization.get('pos_init'))
+    time_grid = initialization.get('time_grid', np.linspace(0, initialization.get('time_init'), len(pos_init)))
+    pos_grid = problem['pos_grid']
+    states = np.vstack([
+        np.interp(pos_grid, pos_init, time_grid),
+        np.interp(pos_grid, pos_init, initialization.get('speed_init')),
+        np.interp(pos_grid, pos_init, initialization.get('w_bal_init'))
+    ])
+    return states, np.interp(pos_grid, pos_init, initialization.get('power_init')), None
+
+def solve_problem(problem, X0, params, optimization_opts, initialization):
+    if problem.get('compiled'):
+        return solve_compiled(problem, X0, params, optimization_opts, initialization)
+
+    opti = problem['opti']
+    X = problem['states']
+    U = problem['U']
+    T = problem['T']
+
+    for name, param in problem['params'].items():
+        opti.set_value(param, params.get(name))
+    opti.set_value(problem['X0'], X0)
+    if problem['pos_end'] is not None:
+        opti.set_value(problem['pos_end'], optimization_opts.get("end_distance", problem['route_end']))
+    if problem['w_bal_bounds'] is not None:
+        opti.set_value(problem['w_bal_bounds'][0], optimization_opts.get("w_bal_start"))
+        opti.set_value(problem['w_bal_bounds'][1], optimization_opts.get("w_bal_end"))
+    if problem['w_bal_terminal'] is not None:
+        opti.set_value(problem['w_bal_terminal'], optimization_opts.get("w_bal_terminal"))
+    if problem['terminal_price'] is not None:
+        opti.set_value(problem['terminal_price'], optimization_opts.get("terminal_price"))
 
-def reoptimize(distance, elevation, X0, params, optimization_opts, initialization):
-    N = optimization_opts.get("N")
-    opti = ca.Opti()
-    X = opti.variable(3, N+1)
-    pos = X[0,:]
-    speed = X[1,:]
-    w_bal = X[2,:]
-    U = opti.variable(1,N+1)
-    T = opti.variable()
+    # Provide an initial guess
+    states, power, time_init = initial_guess(problem, initialization)
+    opti.set_initial(X, states)
+    opti.set_initial(U, power)
+    if time_init is not None:
+        opti.set_initial(T, time_init)
+    if initialization.get('lam_g') is not None:
+        opti.set_initial(opti.lam_g, join_multipliers(problem, initialization.get('lam_g')))
 
-    # Mechanical model params
-    mass_rider = params.get("mass_rider")
-    mass_bike = params.get("mass_bike")
-    m = mass_bike + mass_rider
-    g = params.get("g")
-    mu = params.get("mu")
-    b0 = params.get("b0")
-    b1 = params.get("b1")
-    Iw = params.get("Iw")
-    r = params.get("r")
-    Cd = params.get("Cd")
-    rho = params.get("rho")
-    A = params.get("A")
-    eta = params.get("eta")
+    sol = opti.solve()
+    return sol, opti, T, U, problem['X']
+
+COMPILED_DIR = 'compiled'
+# Part of the key of compiled problems, changed when build_problem changes their parameters or layout
+COMPILED_VERSION = 2
+
+def problem_hash(*parts):
+    # Cache key of a compiled problem from the CasADi version, the route arrays and the structural options
+    digest = hashlib.sha1(f'{ca.__version__} {COMPILED_VERSION}'.encode())
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(np.ascontiguousarray(part, dtype=float).tobytes())
+        else:
+            digest.update(repr(part).encode())
+    # The key names the generated C file, which has to be a valid identifier
+    return 'nlp_' + digest.hexdigest()
+
+def symbol_indices(symbol, expr):
+    # Position of the entries of expr (column-major) in the symbol vector
+    indices = ca.Function('indices', [symbol], [ca.vec(expr)])(np.arange(symbol.size1()))
+    return np.array(indices).flatten().astype(int).tolist()
+
+def compile_problem(problem, path, compiler="cc", flags=("-fPIC", "-shared", "-O1")):
+    # Generate C for the NLP functions and derivatives of a problem built by build_problem and
+    # compile it into path.so, with the layout needed to load it again in path.json
+    opti = problem['opti']
+    nlp = {'x': opti.x, 'p': opti.p, 'f': opti.f, 'g': opti.g}
+    # The integration step is mapped over the intervals, so the generated code loops over one step
+    # function instead of growing with N. Expanding to SX would unroll it again
+    solver = ca.nlpsol('solver', 'ipopt', nlp, {"expand": False})
+    bounds = ca.Function('bounds', [opti.p], [opti.lbg, opti.ubg])
+
+    directory, name = os.path.split(path)
+    codegen = ca.CodeGenerator(name + '.c')
+    # The NLP itself and the derivative functions IPOPT evaluates
+    codegen.add(solver.oracle())
+    for function in solver.get_function():
+        codegen.add(solver.get_function(function))
+    codegen.add(bounds)
+    codegen.generate(os.path.join(directory, ''))
+
+    x_index = {
+        'states': symbol_indices(opti.x, problem['states']),
+        'U': symbol_indices(opti.x, problem['U'])
+    }
+    if problem['formulation'] == "time":
+        x_index['T'] = symbol_indices(opti.x, problem['T'])
+    p_index = {name: symbol_indices(opti.p, param) for name, param in problem['params'].items()}
+    p_index['X0'] = symbol_indices(opti.p, problem['X0'])
+    if problem['pos_end'] is not None:
+        p_index['pos_end'] = symbol_indices(opti.p, problem['pos_end'])
+    if problem['w_bal_bounds'] is not None:
+        p_index['w_bal_bounds'] = symbol_indices(opti.p, ca.vertcat(*problem['w_bal_bounds']))
+    if problem['w_bal_terminal'] is not None:
+        p_index['w_bal_terminal'] = symbol_indices(opti.p, problem['w_bal_terminal'])
+    if problem['terminal_price'] is not None:
+        p_index['terminal_price'] = symbol_indices(opti.p, problem['terminal_price'])
+    meta = {
+        'N': problem['N'],
+        'formulation': problem['formulation'],
+        'layout': problem['layout'],
+        'route_end': float(problem['route_end']),
+        'pos_grid': None if problem['pos_grid'] is None else problem['pos_grid'].tolist(),
+        'grid': None if problem['grid'] is None else problem['grid'].tolist(),
+        'nx': opti.nx,
+        'np': opti.np,
+        'ng': opti.ng,
+        'x_index': x_index,
+        'p_index': p_index
+    }
+    with open(path + '.json', 'w') as file:
+        json.dump(meta, file)
+
+    # The library is written under a temporary name so a half-written file is never loaded
+    subprocess.run([compiler, *flags, path + '.c', '-o', path + '.tmp.so'], check=True)
+    os.replace(path + '.tmp.so', path + '.so')
+    os.remove(path + '.c')
+    return path
+
+def load_compiled_problem(path, optimization_opts):
+    with open(path + '.json', 'r') as file:
+        meta = json.load(file)
+    N = meta['N']
+    p_opts, s_opts = solver_options(optimization_opts)
+    p_opts.pop("expand")
+    solver = ca.nlpsol('solver', optimization_opts.get('solver'), path + '.so', {**p_opts, optimization_opts.get('solver'): s_opts})
+
+    # Symbolic stand-ins for the primal and dual solution so results are read as in an Opti problem
+    x = ca.SX.sym('x', meta['nx'])
+    lam_g = ca.SX.sym('lam_g', meta['ng'])
+    states = ca.reshape(x[meta['x_index']['states']], 3, N+1)
+    U = x[meta['x_index']['U']].T
+    if meta['formulation'] == "time":
+        T = x[meta['x_index']['T']]
+        pos = states[0,:]
+        # Libraries compiled before the grid option have a uniform grid
+        grid = np.array(meta.get('grid') or np.linspace(0, 1, N+1))
+        time = T*ca.DM(grid).T
+        pos_grid = None
+    else:
+        time = states[0,:]
+        T = time[-1]
+        pos_grid = np.array(meta['pos_grid'])
+        pos = ca.DM(pos_grid).T
+
+    return {
+        'compiled': True,
+        'solver': solver,
+        'bounds': ca.external('bounds', path + '.so'),
+        'N': N,
+        'formulation': meta['formulation'],
+        'layout': [tuple(group) for group in meta['layout']],
+        'route_end': meta['route_end'],
+        'x_index': meta['x_index'],
+        'p_index': meta['p_index'],
+        'symbols': (x, lam_g),
+        'states': states,
+        'X': ca.vertcat(pos, states[1,:], states[2,:]),
+        'U': U,
+        'T': T,
+        'time': time,
+        'pos_grid': pos_grid,
+        'grid': grid if meta['formulation'] == "time" else None,
+        'lam_g': lam_g
+    }
+
+def compiled_problem(key, build, optimization_opts, directory=COMPILED_DIR):
+    # Load the compiled problem cached under key, building and compiling it first on a miss
+    path = os.path.join(directory, key)
+    if not os.path.exists(path + '.so'):
+        os.makedirs(directory, exist_ok=True)
+        compile_problem(build(), path)
+    return load_compiled_problem(path, optimization_opts)
+
+class CompiledSolution:
+    # Stands in for OptiSol with the value() and stats() used by the server and the plots
+    def __init__(self, problem, result, stats):
+        self.problem = problem
+        self.result = result
+        self.solver_stats = stats
+
+    def value(self, expr):
+        x, lam_g = self.problem['symbols']
+        value = ca.Function('value', [x, lam_g], [ca.SX(expr)])(self.result['x'], self.result['lam_g'])
+        value = np.array(value).squeeze()
+        return float(value) if value.ndim == 0 else value
+
+    def stats(self):
+        return self.solver_stats
+
+def solve_compiled(problem, X0, params, optimization_opts, initialization):
+    p_index = problem['p_index']
+    p = np.zeros(sum(len(indices) for indices in p_index.values()))
+    for name in MODEL_PARAMS:
+        p[p_index[name]] = params.get(name)
+    p[p_index['X0']] = X0
+    if 'pos_end' in p_index:
+        p[p_index['pos_end']] = optimization_opts.get("end_distance", problem['route_end'])
+    if 'w_bal_bounds' in p_index:
+        p[p_index['w_bal_bounds']] = [optimization_opts.get("w_bal_start"), optimization_opts.get("w_bal_end")]
+    if 'w_bal_terminal' in p_index:
+        p[p_index['w_bal_terminal']] = optimization_opts.get("w_bal_terminal")
+    if 'terminal_price' in p_index:
+        p[p_index['terminal_price']] = optimization_opts.get("terminal_price")
+
+    x_index = problem['x_index']
+    states, power, time_init = initial_guess(problem, initialization)
+    x0 = np.zeros(problem['symbols'][0].size1())
+    x0[x_index['states']] = states.flatten(order='F')
+    x0[x_index['U']] = power
+    if time_init is not None:
+        x0[x_index['T']] = time_init
+    lbg, ubg = problem['bounds'](p)
+    args = {'x0': x0, 'p': p, 'lbg': lbg, 'ubg': ubg}
+    if initialization.get('lam_g') is not None:
+        args['lam_g0'] = join_multipliers(problem, initialization.get('lam_g'))
+
+    solver = problem['solver']
+    result = solver(**args)
+    stats = solver.stats()
+    if not stats['success']:
+        raise RuntimeError(f"Compiled solve failed: {stats['return_status']}")
+    return CompiledSolution(problem, result, stats), solver, problem['T'], problem['U'], problem['X']
+
+def split_multipliers(problem, lam_g):
+    # Multipliers per constraint group, shaped (rows, nodes)
+    lam_g = np.array(lam_g).flatten()
+    groups = {}
+    offset = 0
+    for name, rows, nodes in problem['layout']:
+        groups[name] = lam_g[offset:offset+rows*nodes].reshape(nodes, rows).T
+        offset += rows*nodes
+    return groups
+
+def join_multipliers(problem, groups):
+    lam_g = []
+    for name, rows, nodes in problem['layout']:
+        values = groups.get(name)
+        if values is None or values.shape != (rows, nodes):
+            values = np.zeros((rows, nodes))
+        lam_g.append(values.T.flatten())
+    return np.concatenate(lam_g)
+
+def extract_solution(sol, problem):
+    # Primal and dual solution in route coordinates
+    T = sol.value(problem['T'])
+    X = sol.value(problem['X'])
+    return {
+        'time': sol.value(problem['time']),
+        'pos': X[0],
+        'speed': X[1],
+        'w_bal': X[2],
+        'power': sol.value(problem['U']),
+        'T': T,
+        'lam_g': split_multipliers(problem, sol.value(problem['lam_g']))
+    }
+
+def shift_solution(solution, start_distance, N, formulation="time", x0=None, w_prime=None, end_distance=None):
+    # Cut a stored solution at start_distance (and end_distance, by default its end) and resample it
+    # onto the N+1 nodes of that part of the route, on the time grid or the position grid depending
+    # on the formulation. If the start state x0 is given, the speed and W'bal guesses are shifted to
+    # start from it, with the offset fading out towards the end
+    time = solution['time']
+    N_old = len(time)-1
+    if end_distance is None:
+        end_distance = solution['pos'][-1]
+    t_start = np.interp(start_distance, solution['pos'], time)
+    T = np.interp(end_distance, solution['pos'], time) - t_start
+    if formulation == "time":
+        t_new = t_start + np.linspace(0, T, N+1)
+    else:
+        t_new = np.interp(distance_grid(start_distance, end_distance, N), solution['pos'], time)
 
-    # Physiological model params
-    w_prime = params.get("w_prime")
+    lam_g = {}
+    for name, values in solution['lam_g'].items():
+        nodes = values.shape[1]
+        if nodes == 1:
+            lam_g[name] = values
+        else:
+            t_old = time[:nodes]
+            t_nodes = t_new[:N+1-(N_old+1-nodes)]
+            lam_g[name] = np.array([np.interp(t_nodes, t_old, row) for row in values])
+
+    speed = np.interp(t_new, time, solution['speed'])
+    w_bal = np.interp(t_new, time, solution['w_bal'])
+    if x0 is not None:
+        fade = np.linspace(1, 0, N+1)
+        speed = np.clip(speed + fade*(x0[1] - speed[0]), 1, 25)
+        w_bal = np.clip(w_bal + fade*(x0[2] - w_bal[0]), 0, w_prime)
+
+    return {
+        'pos_init': np.interp(t_new, time, solution['pos']) - start_distance,
+        'speed_init': speed,
+        'w_bal_init': w_bal,
+        'power_init': np.interp(t_new, time, solution['power']),
+        'time_init': T,
+        'time_grid': t_new - t_start,
+        'lam_g': lam_g
+    }
+
+def solve_opt(distance, elevation, params, optimization_opts, initialization, problem=None):
+    if problem is None:
+        problem = build_problem(distance, elevation, params.get("mu"), optimization_opts, sigma=2)
+    X0 = [distance[0], 1, params.get("w_prime")]
+    return solve_problem(problem, X0, params, optimization_opts, initialization)
+
+
+def reoptimize(distance, elevation, X0, params, optimization_opts, initialization, problem=None):
+    if problem is None:
+        problem = build_problem(distance, elevation, params.get("mu"), optimization_opts, sigma=4)
+    return solve_problem(problem, X0, params, optimization_opts, initialization)
+
+def interval_defects(solution, distance, slope, params, w_bal_model="ODE", substeps=8):
+    # Difference between each solved interval end state and a finer RK4 integration of the interval
+    # on the full route gradient, with the interval's power held constant as in the problem
+    from simulator import smooth_w_balance_derivative
+    m = params.get("mass_bike") + params.get("mass_rider")
+    g = params.get("g")
+    friction = params.get("mu")
     cp = params.get("cp")
+    w_prime = params.get("w_prime")
 
-    sigma = 4
-    smoothed_elev = gaussian_filter1d(elevation, sigma)
-
-    slope = calculate_gradient(distance, smoothed_elev)
-    interpolated_slope = ca.interpolant('Slope', 'bspline', [distance], slope)
-    interpolated_friction = ca.interpolant('Friction', 'bspline', [distance], mu)
-
-    if optimization_opts.get("w_bal_model") == "ODE":  
-        f = lambda x,u: ca.vertcat(x[1], 
-                    (1/x[1] * 1/(m + Iw/r**2)) * (eta*u - interpolated_friction(x[0])*m*g*x[1] - m*g*interpolated_slope(x[0])*x[1] - b0*x[1] - b1*x[1]**2 - 0.5*Cd*rho*A*x[1]**3),
-                    smooth_w_balance_ode_derivative(u, cp, x, w_prime))     
-    elif optimization_opts.get("w_bal_model") == "Simple":
-        f = lambda x,u: ca.vertcat(x[1], 
-                    (1/x[1] * 1/(m + Iw/r**2)) * (eta*u - interpolated_friction(x[0])*m*g*x[1] - m*g*interpolated_slope(x[0])*x[1] - b0*x[1] - b1*x[1]**2 - 0.5*Cd*rho*A*x[1]**3), 
-                    -(u-cp))
-    else:
-        raise ValueError()
-
-    dt = T/N
-    if optimization_opts.get("integration_method") == "Euler":
-        for k in range(N):
-            x_next = X[:,k] + dt*f(X[:,k], U[:,k])
-            opti.subject_to(X[:,k+1] == x_next)
-    elif optimization_opts.get("integration_method") == "Midpoint":
-        for k in range(N):
-            k1 = f(X[:,k], U[:,k])
-            x_next = X[:,k] + dt*f(X[:,k] + dt/2*k1, U[:,k])
-            opti.subject_to(X[:,k+1] == x_next)
-    elif optimization_opts.get("integration_method") == "RK4":
-        for k in range(N): 
-            k1 = f(X[:,k], U[:,k])
-            k2 = f(X[:,k] + dt/2*k1, U[:,k])
-            k3 = f(X[:,k] + dt/2*k2, U[:,k])
-            k4 = f(X[:,k] + dt*k3, U[:,k])
-            x_next = X[:,k] + dt/6*(k1+2*k2+2*k3+k4)
-            opti.subject_to(X[:,k+1] == x_next)
+    def dynamics(x, u):
+        v = x[1]
+        resistance = (np.interp(x[0], distance, friction) + np.interp(x[0], distance, slope))*m*g*v + params.get("b0")*v + params.get("b1")*v**2 + 0.5*params.get("Cd")*params.get("rho")*params.get("A")*v**3
+        if w_bal_model == "ODE":
+            w_bal_derivative = smooth_w_balance_derivative(u, cp, x[2], w_prime)
+        else:
+            w_bal_derivative = -(u - cp)
+        return np.array([v, (params.get("eta")*u - resistance)/(v*(m + params.get("Iw")/params.get("r")**2)), w_bal_derivative])
+
+    x = np.array([solution['pos'][:-1], solution['speed'][:-1], solution['w_bal'][:-1]], dtype=float)
+    u = np.asarray(solution['power'][:-1], dtype=float)
+    h = np.diff(solution['time'])/substeps
+    for _ in range(substeps):
+        k1 = dynamics(x, u)
+        k2 = dynamics(x + h/2*k1, u)
+        k3 = dynamics(x + h/2*k2, u)
+        k4 = dynamics(x + h*k3, u)
+        x = x + h/6*(k1 + 2*k2 + 2*k3 + k4)
+    return np.abs(x - np.array([solution['pos'][1:], solution['speed'][1:], solution['w_bal'][1:]]))
+
+# Largest position [m], speed [m/s] and W'bal [J] integration defects of an interval that is not split
+DEFECT_TOLERANCE = np.array([[0.5], [0.1], [10]])
+# Adaptive refinement stops before its last level once a level changes the final time by less than this many
+# seconds from the level before, with defects within DEFECT_TOLERANCE. In `benchmark.py adaptive` the finished
+# adaptive and uniform solutions of the routes differ by up to 0.8 s
+ADAPTIVE_T_TOLERANCE = 0.5
+
+def refine_grid(grid, solution, distance, slope, fraction=0.3, defects=None):
+    # Split the intervals where the power, speed, W'bal or the gradient change the most in two. Each indicator
+    # is the interval's share of the total, and the fraction of intervals with the largest one are split.
+    # Intervals with integration defects above DEFECT_TOLERANCE are split as well
+    variation = np.concatenate([[0], np.cumsum(np.abs(np.diff(slope)))])
+    terrain = np.diff(np.interp(solution['pos'], distance, variation))
+    indicators = [np.abs(np.diff(solution[name])) for name in ('power', 'speed', 'w_bal')] + [terrain]
+    indicator = np.max([values/max(values.sum(), 1e-12) for values in indicators], axis=0)
+    split = indicator >= np.quantile(indicator, 1 - fraction)
+    if defects is not None:
+        split |= (defects > DEFECT_TOLERANCE).any(axis=0)
+    midpoints = (grid[:-1] + grid[1:])[split]/2
+    return np.sort(np.concatenate([grid, midpoints]))
+
+def resample_solution(solution, grid, formulation):
+    # Initialization for a new grid from a solution, by interpolating in time. Multipliers per node are
+    # interpolated the same way if the solution has them
+    if formulation == "time":
+        t_new = grid*solution['T']
     else:
-        raise ValueError()
-    
-    if optimization_opts.get("smooth_power_constraint"):
-        opti.minimize(T + 0.00005 * ca.sumsqr(U[:,1:] - U[:,:-1])) 
+        pos = solution['pos'][0] + grid*(solution['pos'][-1] - solution['pos'][0])
+        t_new = np.interp(pos, solution['pos'], solution['time'])
+    lam_g = None
+    if solution.get('lam_g') is not None:
+        N_old = len(solution['time'])-1
+        lam_g = {}
+        for name, values in solution['lam_g'].items():
+            nodes = values.shape[1]
+            if nodes == 1:
+                lam_g[name] = values
+            else:
+                t_nodes = t_new[:len(t_new)-(N_old+1-nodes)]
+                lam_g[name] = np.array([np.interp(t_nodes, solution['time'][:nodes], row) for row in values])
+    return {
+        'pos_init': np.interp(t_new, solution['time'], solution['pos']),
+        'speed_init': np.interp(t_new, solution['time'], solution['speed']),
+        'w_bal_init': np.interp(t_new, solution['time'], solution['w_bal']),
+        'power_init': np.interp(t_new, solution['time'], solution['power']),
+        'time_init': solution['T'],
+        'time_grid': t_new,
+        'lam_g': lam_g
+    }
+
+def solve_adaptive(distance, elevation, params, optimization_opts, initialization, slope, interpolants=None, levels=3, coarsening=4, fraction=0.3):
+    # Solve on a grid coarsening times coarser than optimization_opts["N"], then refine it levels times
+    # where the solution or the terrain changes fast, warm starting each level from the previous one.
+    # Refinement stops early when the final time has settled, see ADAPTIVE_T_TOLERANCE.
+    # If the last level still has defects above DEFECT_TOLERANCE the coarse levels have led it into a
+    # discretization artifact, and the problem is solved once more on the uniform grid.
+    # Returns the last solution and problem and the N, iterations and timings per level
+    formulation = optimization_opts.get("formulation", "time")
+    N = max(optimization_opts.get("N")//coarsening, 1)
+    if formulation == "time":
+        grid = np.linspace(0, 1, N+1)
     else:
-        opti.minimize(T) 
-
-
-    # Max power constraint params
-    alpha = params.get("alpha")
-    U_max = alpha*w_bal + cp
-
-    # Set the path constraints
-    opti.subject_to(U <= U_max)
-    opti.subject_to(U >= 0)
-    opti.subject_to(opti.bounded(0, w_bal, w_prime))
-    opti.subject_to(opti.bounded(1, speed, 25))
-
-    # Set boundary conditions
-    opti.subject_to(pos[0]==X0[0]) 
-    opti.subject_to(speed[0]==X0[1]) 
-    opti.subject_to(pos[-1]==distance[-1])
-    opti.subject_to(w_bal[0]==X0[2])
-
-    opti.subject_to(opti.bounded(0, T, distance[-1]/1000*180)) 
-
-    # Provide an initial guess
-    opti.set_initial(T, initialization.get('time_init'))
-    opti.set_initial(pos, initialization.get('pos_init'))
-    opti.set_initial(speed, initialization.get('speed_init'))
-    opti.set_initial(w_bal, initialization.get('w_bal_init'))
-    opti.set_initial(U, initialization.get('power_init'))
- 
-    p_opts = {"expand": False}
-    s_opts = {"max_iter": 20000}
-    opti.solver(optimization_opts.get('solver'), p_opts, s_opts) 
-    sol = opti.solve()
-    return sol, opti, T, U, X
\ No newline at end of file
+        grid = (distance_grid(distance[0], distance[-1], N) - distance[0])/(distance[-1] - distance[0])
+    time_grid = initialization['time_grid']
+    uniform_initialization = initialization
+    initialization = resample_solution({
+        'time': time_grid,
+        'pos': initialization['pos_init'],
+        'speed': initialization['speed_init'],
+        'w_bal': initialization['w_bal_init'],
+        'power': initialization['power_init'],
+        'T': time_grid[-1]
+    }, grid, formulation)
+
+    level_stats = []
+    def solve_level(opts, initialization):
+        start = time.perf_counter()
+        problem = build_problem(distance, elevation, params.get("mu"), opts, sigma=2, interpolants=interpolants)
+        setup_time = time.perf_counter() - start
+        sol = solve_opt(distance, elevation, params, opts, initialization, problem=problem)[0]
+        solution = extract_solution(sol, problem)
+        stats = sol.stats()
+        defects = interval_defects(solution, distance, slope, params, optimization_opts.get("w_bal_model"))
+        level_stats.append({
+            'N': opts["N"],
+            'iterations': stats['iter_count'],
+            'opt_time': stats['t_wall_total'],
+            'setup_time': setup_time,
+            'T': float(solution['T']),
+            'max_defects': defects.max(axis=1).tolist()
+        })
+        return sol, problem, solution, defects
+
+    for level in range(levels+1):
+        # Levels after the first start from the previous primal-dual solution
+        opts = {**optimization_opts, "N": len(grid)-1, "grid": grid, "warm_start": level > 0}
+        sol, problem, solution, defects = solve_level(opts, initialization)
+        settled = level > 0 and abs(level_stats[-1]['T'] - level_stats[-2]['T']) < ADAPTIVE_T_TOLERANCE
+        if level == levels or (settled and not (defects > DEFECT_TOLERANCE).any()):
+            break
+        grid = refine_grid(grid, solution, distance, slope, fraction, defects)
+        initialization = resample_solution(solution, grid, formulation)
+    if (defects > DEFECT_TOLERANCE).any():
+        sol, problem = solve_level(optimization_opts, uniform_initialization)[:2]
+    return sol, problem, level_stats
+
+# Inequality constraints are active at a solution where their multiplier is above this and above their slack
+ACTIVE_MULTIPLIER = 1e-6
+# Outputs of solution_sensitivity, in this order
+SENSITIVITY_OUTPUTS = ('time', 'pos', 'speed', 'w_bal', 'power')
+# Largest power [W], speed [m/s] and W'bal [J] bound violations of a corrected solution
+BOUND_TOLERANCE = np.array([5, 0.1, 10])
+
+def kkt_functions(problem):
+    # Hessian of the Lagrangian, constraint Jacobian, constraint bounds, their derivatives in the parameters
+    # and the derivatives of the solution outputs, as one Function built on first use and kept with the problem
+    if 'kkt' not in problem:
+        opti = problem['opti']
+        x, p, lam_g = opti.x, opti.p, opti.lam_g
+        hessian, gradient = ca.hessian(opti.f + ca.dot(lam_g, opti.g), x)
+        X = problem['X']
+        outputs = ca.vertcat(*[ca.vec(expr) for expr in (problem['time'], X[0,:], X[1,:], X[2,:], problem['U'])])
+        problem['kkt'] = ca.Function('kkt', [x, p, lam_g], [
+            hessian, ca.jacobian(opti.g, x), ca.jacobian(gradient, p), ca.jacobian(opti.g, p),
+            opti.lbg, opti.ubg, ca.jacobian(opti.lbg, p), ca.jacobian(opti.ubg, p),
+            ca.jacobian(outputs, x), ca.jacobian(outputs, p)
+        ])
+    return problem['kkt']
+
+def solution_sensitivity(sol, problem):
+    # Derivatives of a solution in its start speed and W'bal, from one factorization of the KKT system of the
+    # constraints that are active at the solution. Returns a (5, nodes, 2) array with the derivatives of the
+    # SENSITIVITY_OUTPUTS at every node in the two, or None if the KKT system is singular.
+    # Only for problems built with build_problem, not compiled ones
+    from scipy.sparse import bmat
+    from scipy.sparse.linalg import splu
+    opti = problem['opti']
+    x = sol.value(opti.x)
+    p = sol.value(opti.p)
+    lam_g = np.atleast_1d(sol.value(opti.lam_g))
+    H, J, Lxp, Gp, lbg, ubg, Lbp, Ubp, Ox, Op = kkt_functions(problem)(x, p, lam_g)
+    lbg, ubg = np.array(lbg).flatten(), np.array(ubg).flatten()
+    g = sol.value(opti.g)
+    slack = np.minimum(np.abs(g - lbg), np.abs(ubg - g))
+    active = (lbg == ubg) | ((np.abs(lam_g) > ACTIVE_MULTIPLIER) & (slack < np.abs(lam_g)))
+    # The speed and W'bal bounds at the first node are set by the start constraints when they are active
+    offset = 0
+    for name, rows, nodes in problem['layout']:
+        if name in ('speed', 'w_bal'):
+            active[offset:offset+rows] = False
+        offset += rows*nodes
+    active = np.flatnonzero(active)
+    # Constraints with a positive multiplier are at their upper bound, the others at their lower bound
+    upper = lam_g[active] > 0
+    columns = symbol_indices(opti.p, problem['X0'])[1:]
+    J_active = J.sparse()[active]
+    bound_p = np.where(upper[:,None], Ubp.sparse()[active][:, columns].toarray(), Lbp.sparse()[active][:, columns].toarray())
+    kkt = bmat([[H.sparse(), J_active.T], [J_active, None]], format='csc')
+    rhs = -np.vstack([Lxp.sparse()[:, columns].toarray(), Gp.sparse()[active][:, columns].toarray() - bound_p])
+    try:
+        dx = splu(kkt).solve(rhs)[:len(x)]
+    except RuntimeError:
+        return None
+    outputs = Ox.sparse() @ dx + Op.sparse()[:, columns].toarray()
+    return outputs.reshape(len(SENSITIVITY_OUTPUTS), -1, 2)
+
+def correct_solution(solution, distance, w_bal):
+    # First-order update of a solution with a 'sensitivity' for a rider at distance with a W'bal off the solution.
+    # By the principle of optimality the corrected solution after distance is the part of the solution from the
+    # start W'bal that passes through the rider's W'bal. A speed off the solution is not corrected, it settles
+    # within seconds and the start speed that would lead to it is poorly determined. The sensitivities are at
+    # fixed times and are converted to fixed positions, so the corrected solution keeps the solution's positions.
+    # Returns the corrected solution from distance on, with the time from distance
+    sensitivity = np.asarray(solution['sensitivity'])[:, :, 1]
+    pos = np.asarray(solution['pos'])
+    time = np.asarray(solution['time'])
+    at_position = {}
+    for i, name in enumerate(SENSITIVITY_OUTPUTS):
+        rate = np.ones_like(time) if name == 'time' else np.gradient(np.asarray(solution[name], dtype=float), time)
+        at_position[name] = sensitivity[i] - rate/np.asarray(solution['speed'])*sensitivity[1]
+    # Start W'bal deviation that moves the solution through the rider's W'bal at distance
+    shift = (w_bal - np.interp(distance, pos, solution['w_bal']))/np.interp(distance, pos, at_position['w_bal'])
+    after = pos > distance
+    corrected = {'pos': np.concatenate([[distance], pos[after]])}
+    for name in ('time', 'speed', 'w_bal', 'power'):
+        values = np.asarray(solution[name], dtype=float) + shift*at_position[name]
+        corrected[name] = np.concatenate([[np.interp(distance, pos, values)], values[after]])
+    corrected['time'] = corrected['time'] - corrected['time'][0]
+    corrected['T'] = corrected['time'][-1]
+    corrected['lam_g'] = {}
+    return corrected
+
+def correction_error(corrected, solution, distance, slope, params, w_bal_model="ODE"):
+    # Predicted error of a solution corrected from solution, as the largest integration defect it adds to those
+    # of the same intervals of solution in units of DEFECT_TOLERANCE, or its largest bound violation in units of
+    # BOUND_TOLERANCE. The first-order update is accurate where this is below 1
+    defects = interval_defects(corrected, distance, slope, params, w_bal_model)
+    first = int(np.searchsorted(solution['pos'], corrected['pos'][0], side='right')) - 1
+    reference = interval_defects(solution, distance, slope, params, w_bal_model)[:, first:]
+    defect_error = ((defects - reference)/DEFECT_TOLERANCE).max()
+    power, speed, w_bal = corrected['power'], corrected['speed'], corrected['w_bal']
+    violations = [
+        np.maximum(-power, power - (params.get("cp") + params.get("alpha")*w_bal)),
+        np.maximum(1 - speed, speed - 25),
+        np.maximum(-w_bal, w_bal - params.get("w_prime"))
+    ]
+    bound_error = max((values/tolerance).max() for values, tolerance in zip(violations, BOUND_TOLERANCE))
+    return float(max(defect_error, bound_error))
@@ -1,18 +1,14 @@
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import datetime
 from optimal_pacing import normalized_power
 import numpy as np
 
-def plot_optimization_results(sol, U, X, T, distance, elevation, params, opt_details, streamlit=False):
+def draw_plan(fig, pos, optimal_power, velocity, w_bal, optimal_time, distance, elevation, params, opt_details):
     cp = params.get("cp")
     alpha = params.get("alpha")
-    optimal_power = sol.value(U)
-    optimal_time = sol.value(T)
-    pos = sol.value(X[0,:])
-    velocity = sol.value(X[1,:])
-    w_bal = sol.value(X[2,:])
     max_power = alpha*w_bal + cp
-    fig, ax = plt.subplots(3,1, figsize=(15,10))
+    ax = fig.subplots(3,1)
 
     ax[0].set_title(f"The optimal time is {str(datetime.timedelta(seconds=round(optimal_time)))}")
     ax[0].set_ylabel("Power [W]")
@@ -57,9 +53,19 @@ def plot_optimization_results(sol, U, X, T, distance, elevation, params, opt_det
     ax3_twin.legend(["Elevation Profile"], loc='lower left')
 
     fig.text(0.5, 0.04, f"Integration method: {opt_details.get('integration_method')}, points = {len(distance)}, N = {opt_details.get('N')}, W'balance model: {opt_details.get('w_bal_model')}, iterations: {opt_details.get('iterations')}, time: {str(datetime.timedelta(seconds=round(opt_details.get('opt_time'))))}", horizontalalignment="center")
-    fig.text(0.4, 0.02, f"Avg power: {round(np.mean(sol.value(U)))}W, Normalized Power: {round(normalized_power(sol.value(U)))}W")
+    fig.text(0.4, 0.02, f"Avg power: {round(np.mean(optimal_power))}W, Normalized Power: {round(normalized_power(optimal_power))}W")
+
+def plot_optimization_results(sol, U, X, T, distance, elevation, params, opt_details, streamlit=False):
+    fig = plt.figure(figsize=(15,10))
+    draw_plan(fig, sol.value(X[0,:]), sol.value(U), sol.value(X[1,:]), sol.value(X[2,:]), sol.value(T), distance, elevation, params, opt_details)
 
     if streamlit:
         return fig
     else:
         plt.savefig('opt_plot.png')
+
+def render_plan(path, solution, distance, elevation, params, opt_details):
+    # Draws a solution from extract_solution into a png without pyplot, so it works from any thread and without a display
+    fig = Figure(figsize=(15,10))
+    draw_plan(fig, solution['pos'], solution['power'], solution['speed'], solution['w_bal'], solution['T'], distance, elevation, params, opt_details)
+    fig.savefig(path, format='png')
@@ -23,9 +23,7 @@ let target_power_data = [];
 let prev_power_data = [];
 let power_color_data = [];
 let athlete_ftp;
-let last_reopt = 0;
-let reopt_count = 0;
-let reoptimizing = false;
+let telemetry_samples = [];
 
 const power_zones = [
     {zone: 'Z1', from: 0, to: 0.5999},
@@ -95,9 +93,69 @@ function render() {
 
 }
 
+let plan_version = null;
+let plan_stream_open = false;
+let message_timeout;
+
+function set_plan(plan, version) {
+    plan.distance = plan.distance.map(element => element + lead_in);
+    opt_results = plan;
+    plan_version = version;
+    target_power_data = [];
+    power_color_data = [];
+    document.getElementById('message_box').innerHTML = 'Reoptimized!';
+    clearTimeout(message_timeout);
+    message_timeout = setTimeout(() => {
+        document.getElementById('message_box').innerHTML = '';
+    }, 5000);
+}
+
+async function fetch_plan() {
+    // The browser revalidates with the plan's ETag, so an unchanged plan is not downloaded again
+    const response = await fetch('http://localhost:5000/plan', {cache: 'no-cache'});
+    if (!response.ok) {
+        return;
+    }
+    const version = Number(response.headers.get('X-Plan-Version'));
+    if (version !== plan_version) {
+        set_plan(await response.json(), version);
+    }
+}
+
+function apply_plan_event(event) {
+    const update = JSON.parse(event.data);
+    if (update.version === plan_version) {
+        return;
+    }
+    if (update.plan !== undefined && update.base === plan_version) {
+        // Only the end of the plan from update.start has changed
+        const plan = {};
+        for (const name of ['power', 'time', 'w_bal']) {
+            plan[name] = opt_results[name].slice(0, update.start).concat(update.plan[name]);
+        }
+        plan.distance = opt_results.distance.slice(0, update.start).map(element => element - lead_in).concat(update.plan.distance);
+        set_plan(plan, update.version);
+    } else {
+        fetch_plan().catch(error => console.error('Error:', error));
+    }
+}
+
+const plan_events = new EventSource('http://localhost:5000/plan/events?diff=suffix');
+plan_events.addEventListener('open', () => {
+    plan_stream_open = true;
+});
+plan_events.addEventListener('error', () => {
+    plan_stream_open = false;
+});
+plan_events.addEventListener('plan', apply_plan_event);
+
 let cache = null;
 
 async function check_json_change() {
+    // Fallback for a server without the plan events, or while the event stream is reconnecting
+    if (plan_stream_open) {
+        return;
+    }
     const response = await fetch('src/optimal_power.json');
     const data = await response.json();
     data.distance = data.distance.map(element => element + lead_in)
@@ -106,6 +164,7 @@ async function check_json_change() {
 
     opt_results = data;
     cache = opt_results;
+    plan_version = null;
     document.getElementById('message_box').innerHTML = 'Reoptimized!';
     target_power_data = [];
     power_color_data = [];
@@ -153,6 +212,46 @@ async function check_run_opt_button() {
 
 setInterval(check_run_opt_button, 3000)
 
+async function send_telemetry() {
+    // The server tracks the ride and starts a reoptimization when W'bal is far from the plan
+    if (telemetry_samples.length === 0) {
+        return;
+    }
+    const samples = telemetry_samples;
+    telemetry_samples = [];
+    const ride = {
+        route: settings.route,
+        cp: settings.cp,
+        w_prime: settings.w_prime,
+        num_laps: settings.num_laps,
+        weight: settings.weight,
+        max_power: settings.max_power,
+        integration_method: settings.integration_method,
+        negative_split: settings.negative_split,
+        bound_start: settings.bound_start,
+        bound_end: settings.bound_end,
+        reoptimization: settings.reoptimization,
+        samples: samples
+    };
+    try {
+        const response = await fetch('http://localhost:5000/telemetry', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(ride),
+        });
+        const data = await response.json();
+        if (data.reoptimization !== undefined) {
+            console.log('Need to reoptimize!', data.reoptimization);
+        }
+    } catch (error) {
+        console.error('Error:', error);
+    }
+}
+
+setInterval(send_telemetry, 1000)
+
 function get_target_power(distance, distance_arr, power_arr) {
     let start = 0;
     let end = distance_arr.length - 1;
@@ -381,45 +480,14 @@ export async function main() {
         }
         chart.setOption(chart_options, true);
         
-        if (settings.reoptimization === true && watching.state.distance > 1000 && Math.abs(watching.wBal-target_wbal)>3000 && !reoptimizing && (watching.state.distance-last_reopt)>1000 && watching.state.distance < opt_results.distance[opt_results.distance.length-1] && watching.state.speed > 10) {
-            console.log("Need to reoptimize!");
-            reoptimizing = true;
-            last_reopt = watching.state.distance
-            reopt_count = reopt_count + 1;
-            let opt_config = {
-                route: settings.route,
-                cp: settings.cp,
-                w_prime: settings.w_prime,
-                num_laps: settings.num_laps,
-                weight: settings.weight,
-                max_power: settings.max_power,
-                integration_method: settings.integration_method,
-                negative_split: settings.negative_split,
-                bound_start: settings.bound_start,
-                bound_end: settings.bound_end,
-                distance: watching.state.distance - lead_in,
-                speed: watching.state.speed/3.6,
-                w_bal: watching.wBal,
-                reopt_count: reopt_count
-            };
-            fetch('http://localhost:5000/reoptimization', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify(opt_config),
-            })
-            .then(response => response.json())
-            .then(data => {
-                console.log('Success:', data);
-                if (data.result === 'Success') {
-                    reoptimizing = false;
-                }
-            })
-            .catch((error) => {
-                console.error('Error:', error);
-            });
-    }    
+        telemetry_samples.push({
+            time: Date.now()/1000,
+            power: watching.state.power,
+            speed: watching.state.speed/3.6,
+            distance: watching.state.distance - lead_in,
+            w_bal: watching.wBal
+        });
+
     document.getElementById('startButton').addEventListener('click', function() {
     lead_in = athlete_distance[athlete_distance.length -1] + 5;
     opt_results.distance = opt_results.distance.map(element => element + lead_in);
@@ -0,0 +1,83 @@
+import json
+import os
+import threading
+import uuid
+import numpy as np
+
+PLAN_FIELDS = ('power', 'time', 'distance', 'w_bal')
+# Plans of these kinds start at the rider's position and replace the end of the current plan
+SUFFIX_KINDS = ('reoptimization', 'correction')
+# Seconds between SSE comments on an idle stream, so closed connections are noticed
+HEARTBEAT = 15
+
+class PlanStore:
+    # The latest pacing plan, with a version that increases with every new plan. The plan is serialized
+    # once per version, and mirrored to path for clients that read the file
+    def __init__(self, path=None):
+        self.condition = threading.Condition()
+        self.path = path
+        # Versions restart from 0 with the server, the epoch tells the versions of different runs apart
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.route = None
+        self.plan = None
+        self.body = None
+        self.update = None
+
+    def etag(self, version):
+        return f'{self.epoch}-{version}'
+
+    def parse_etag(self, etag):
+        # The version of an ETag or event ID from this run, 0 otherwise
+        epoch, _, version = (etag or '').partition('-')
+        return int(version) if epoch == self.epoch and version.isdigit() else 0
+
+    def publish(self, plan, kind, route=None):
+        # route is (route name, number of laps). A plan of SUFFIX_KINDS on the route of the current plan is
+        # merged into it from its first distance, with its times continuing from the current plan's
+        with self.condition:
+            current = self.plan
+            start = None
+            if (kind in SUFFIX_KINDS and current is not None and route is not None and route == self.route
+                    and current['distance'][0] < plan['distance'][0] <= current['distance'][-1]):
+                start = int(np.searchsorted(current['distance'], plan['distance'][0]))
+                t_start = np.interp(plan['distance'][0], current['distance'], current['time'])
+                suffix = {name: list(plan[name]) for name in PLAN_FIELDS}
+                suffix['time'] = (np.asarray(plan['time']) - plan['time'][0] + t_start).tolist()
+                plan = {name: current[name][:start] + suffix[name] for name in PLAN_FIELDS}
+            self.version += 1
+            self.route = route
+            self.plan = {name: list(plan[name]) for name in PLAN_FIELDS}
+            self.body = json.dumps(self.plan)
+            notice = {'version': self.version, 'etag': self.etag(self.version), 'kind': kind, 'points': len(self.plan['power'])}
+            self.update = {
+                'base': self.version - 1,
+                'notice': json.dumps(notice),
+                'diff': None if start is None else json.dumps({**notice, 'base': self.version - 1, 'start': start, 'plan': suffix})
+            }
+            if self.path is not None:
+                with open(self.path + '.tmp', 'w') as file:
+                    file.write(self.body)
+                os.replace(self.path + '.tmp', self.path)
+            self.condition.notify_all()
+            return self.version
+
+    def get(self):
+        # (version, ETag, serialized plan), the plan is None before the first publish
+        with self.condition:
+            return self.version, self.etag(self.version), self.body
+
+    def events(self, version=0, diff=False, heartbeat=HEARTBEAT):
+        # Server-sent events for the plans after version. A client that is more than one version behind
+        # only gets the latest. With diff, a client that has the previous version gets the replaced part of a
+        # merged plan and the index it starts at, the others only get the version and fetch the plan
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.version > version, heartbeat)
+                current, update = self.version, self.update
+            if current <= version:
+                yield ': heartbeat\n\n'
+                continue
+            data = update['diff'] if diff and update['diff'] is not None and update['base'] == version else update['notice']
+            yield f'id: {self.etag(current)}\nevent: plan\ndata: {data}\n\n'
+            version = current
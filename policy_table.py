@@ -0,0 +1,222 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import time
+from functools import lru_cache
+import numpy as np
+from solution_cache import solution_key
+
+TABLES_DIR = 'policy_tables'
+# Resolution of the stored plans
+TABLE_STEP = 5
+TABLE_CACHE_SIZE = 8
+
+def table_params(opt_config, route_names):
+    # The request fields that determine a reoptimized plan, reoptimizations always use Euler without negative split
+    return {
+        'route': route_names[opt_config['route']],
+        'num_laps': opt_config['num_laps'],
+        'weight': opt_config['weight'],
+        'cp': opt_config['cp'],
+        'w_prime': opt_config['w_prime'],
+        'max_power': opt_config['max_power'],
+        'formulation': opt_config.get('formulation', 'time')
+    }
+
+def table_path(params, directory=TABLES_DIR):
+    return os.path.join(directory, solution_key(params) + '.npz')
+
+@lru_cache(maxsize=TABLE_CACHE_SIZE)
+def load_table(path, mtime):
+    # mtime is part of the cache key so a rebuilt table is reloaded
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+def find_table(params, directory=TABLES_DIR):
+    path = table_path(params, directory)
+    if not os.path.exists(path):
+        return None
+    return load_table(path, os.path.getmtime(path))
+
+def axis_weights(grid, value):
+    # Indices and weights of the two grid points around value, or None outside the grid
+    if value < grid[0] or value > grid[-1]:
+        return None
+    if len(grid) == 1:
+        return [(0, 1.0)]
+    i = min(np.searchsorted(grid, value, side='right') - 1, len(grid) - 2)
+    frac = (value - grid[i])/(grid[i+1] - grid[i])
+    return [(i, 1 - frac), (i+1, frac)]
+
+def lookup(table, distance, speed, w_bal):
+    # Plan from distance to the finish, interpolated from the plans that start at the surrounding
+    # grid states. Plans that failed to solve or start after distance are left out of the average,
+    # None if the state is outside the table or no plan covers it
+    axes = [axis_weights(table['distances'], distance), axis_weights(table['speeds'], speed), axis_weights(table['w_bals'], w_bal)]
+    if any(axis is None for axis in axes):
+        return None
+    pos = table['pos']
+    keep = pos >= distance
+    values = {name: np.zeros(np.count_nonzero(keep)) for name in ('power', 'w_bal', 'dt')}
+    total = np.zeros(np.count_nonzero(keep))
+    total_dt = np.zeros(np.count_nonzero(keep))
+    for i, wi in axes[0]:
+        for j, wj in axes[1]:
+            for k, wk in axes[2]:
+                weight = wi*wj*wk
+                if weight == 0:
+                    continue
+                power = table['power'][i,j,k,keep].astype(float)
+                w = table['w_bal'][i,j,k,keep].astype(float)
+                dt = np.diff(table['time'][i,j,k,keep].astype(float), prepend=np.nan)
+                valid = ~np.isnan(power)
+                values['power'][valid] += weight*power[valid]
+                values['w_bal'][valid] += weight*w[valid]
+                valid_dt = valid & ~np.isnan(dt)
+                values['dt'][valid_dt] += weight*dt[valid_dt]
+                total_dt[valid_dt] += weight
+                total[valid] += weight
+    if not (total > 0).all():
+        return None
+    dt = np.zeros_like(total)
+    dt[1:] = values['dt'][1:]/total_dt[1:]
+    return {
+        'power': (values['power']/total).tolist(),
+        'time': np.cumsum(dt).tolist(),
+        'distance': pos[keep].tolist(),
+        'w_bal': (values['w_bal']/total).tolist()
+    }
+
+def solve_state(opt_config):
+    # Cold reoptimization from one grid state, the same solve the server runs without a previous solution
+    import server
+    try:
+        result = server.solve_reoptimization(opt_config, None)
+    except Exception as error:
+        print(f"Failed at {opt_config['distance']:.0f} m, {opt_config['speed']} m/s, {opt_config['w_bal']:.0f} J: {error!r}")
+        return None
+    return result['plan']
+
+def build_table(opt_config, distances, speeds, w_bals, workers=os.cpu_count(), directory=TABLES_DIR):
+    import route_store
+    import server
+    params = table_params(opt_config, server.route_names)
+    route = route_store.get_route(params['route'], params['num_laps'])
+    pos = np.arange(route['distance'][0], route['distance'][-1], TABLE_STEP)
+    states = [(d, v, w) for d in distances for v in speeds for w in w_bals]
+    configs = [{**opt_config, 'distance': d, 'speed': v, 'w_bal': w} for d, v, w in states]
+
+    shape = (len(distances), len(speeds), len(w_bals), len(pos))
+    arrays = {name: np.full(shape, np.nan, dtype=np.float32) for name in ('power', 'w_bal', 'time')}
+    start = time.perf_counter()
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        for n, plan in enumerate(pool.imap(solve_state, configs)):
+            i, j, k = np.unravel_index(n, shape[:3])
+            if plan is None:
+                continue
+            # Resampled onto the table positions from the start of the plan
+            plan_pos = np.array(plan['distance'])
+            covered = pos >= plan_pos[0]
+            for name, field in (('power', 'power'), ('w_bal', 'w_bal'), ('time', 'time')):
+                arrays[name][i,j,k,covered] = np.interp(pos[covered], plan_pos, plan[field])
+    build_time = time.perf_counter() - start
+
+    os.makedirs(directory, exist_ok=True)
+    path = table_path(params, directory)
+    np.savez_compressed(path, params=json.dumps(params), pos=pos, distances=np.asarray(distances, dtype=float),
+        speeds=np.asarray(speeds, dtype=float), w_bals=np.asarray(w_bals, dtype=float), **arrays)
+    failed = np.count_nonzero(np.isnan(arrays['power'][...,-1]))
+    print(f"Solved {len(states)} states in {build_time:.0f} s, {failed} failed. Wrote {path} ({os.path.getsize(path)/2**20:.1f} MB)")
+    return path
+
+def request_config(args):
+    return {
+        'route': args.route,
+        'num_laps': args.num_laps,
+        'weight': args.weight,
+        'cp': args.cp,
+        'w_prime': args.w_prime,
+        'max_power': args.max_power,
+        'formulation': args.formulation
+    }
+
+def build(args):
+    import route_store
+    import server
+    opt_config = request_config(args)
+    route = route_store.get_route(server.route_names[args.route], args.num_laps)
+    end = route['distance'][-1]
+    distances = np.arange(args.distance_step, end - args.distance_step/2, args.distance_step)
+    w_bals = np.linspace(args.w_bal_min, 1, args.w_bal_points)*args.w_prime
+    build_table(opt_config, distances, args.speeds, w_bals, args.workers)
+
+def plan_errors(plan, reference):
+    # Final time difference, RMS power and max W'bal difference over the positions both plans cover
+    pos = np.array(plan['distance'])
+    ref_pos = np.array(reference['distance'])
+    common = pos[(pos >= ref_pos[0]) & (pos <= ref_pos[-1])]
+    power = np.interp(common, pos, plan['power']) - np.interp(common, ref_pos, reference['power'])
+    w_bal = np.interp(common, pos, plan['w_bal']) - np.interp(common, ref_pos, reference['w_bal'])
+    return plan['time'][-1] - reference['time'][-1], np.sqrt(np.mean(power**2)), np.abs(w_bal).max()
+
+def report(args):
+    # Accuracy and latency of table lookups against live solves, from the start states of recorded reoptimizations
+    import server
+    opt_config = request_config(args)
+    params = table_params(opt_config, server.route_names)
+    table = find_table(params)
+    if table is None:
+        raise SystemExit(f"No table for {params}, build it first")
+
+    print(f"{'Case':<10}{'Dist [m]':>9}{'v [m/s]':>8}{'Wbal [J]':>9}{'Live [s]':>9}{'Table [ms]':>11}{'dT [s]':>8}{'RMS P [W]':>10}{'Max dWbal':>10}{'dT ref [s]':>11}")
+    for path in sorted(glob.glob(os.path.join(args.cases, '*.json'))):
+        with open(path, 'r') as file:
+            reference = json.load(file)
+        # The recorded plans start at the measured state, the speed is taken from their first interval
+        distance = reference['distance'][0]
+        speed = (reference['distance'][1] - distance)/(reference['time'][1] - reference['time'][0])
+        w_bal = reference['w_bal'][0]
+        state = {**opt_config, 'distance': distance, 'speed': speed, 'w_bal': w_bal}
+
+        start = time.perf_counter()
+        plan = lookup(table, distance, speed, w_bal)
+        table_time = time.perf_counter() - start
+        start = time.perf_counter()
+        live = solve_state(state)
+        live_time = time.perf_counter() - start
+        name = os.path.splitext(os.path.basename(path))[0]
+        prefix = f"{name:<10}{distance:>9.0f}{speed:>8.2f}{w_bal:>9.0f}{live_time:>9.2f}{table_time*1000:>11.2f}"
+        if plan is None or live is None:
+            print(prefix + ('  outside the table' if plan is None else '  live solve failed'))
+            continue
+        dT, rms_power, max_w_bal = plan_errors(plan, live)
+        dT_ref = plan_errors(plan, reference)[0]
+        print(prefix + f"{dT:>8.1f}{rms_power:>10.1f}{max_w_bal:>10.0f}{dT_ref:>11.1f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precomputed reoptimization plans over a grid of start states")
+    parser.add_argument('--route', default='cobbled_climbs', help="Route key as sent by the mod")
+    parser.add_argument('--num-laps', type=int, default=2)
+    parser.add_argument('--weight', type=float, default=75)
+    parser.add_argument('--cp', type=float, default=290)
+    parser.add_argument('--w-prime', type=float, default=25000)
+    parser.add_argument('--max-power', type=float, default=670)
+    parser.add_argument('--formulation', default='time', choices=['time', 'distance'])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help="Solve the grid of start states and write the table")
+    build_parser.add_argument('--distance-step', type=float, default=1000)
+    build_parser.add_argument('--speeds', type=float, nargs='*', default=[6, 8, 10, 12])
+    build_parser.add_argument('--w-bal-min', type=float, default=0.1, help="Lowest W'bal as a fraction of W'")
+    build_parser.add_argument('--w-bal-points', type=int, default=5)
+    build_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    build_parser.set_defaults(func=build)
+
+    report_parser = subparsers.add_parser('report', help="Compare table lookups with live solves")
+    report_parser.add_argument('--cases', default=os.path.join('Experimental data and optimizations', 'Reoptimizations'))
+    report_parser.set_defaults(func=report)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,189 @@
+import argparse
+import glob
+import json
+import os
+import time
+import xml.etree.ElementTree as ET
+import numpy as np
+import optimal_pacing as opt
+import route_store
+from simulator import simulate
+
+TIME_TRIALS_DIR = os.path.join('Experimental data and optimizations', 'Time trials')
+PLANS_DIR = os.path.join('Experimental data and optimizations', 'Optimization results')
+# Trackpoint fields read from TCX files, by local tag name. Missing values are nan
+TCX_FIELDS = {
+    'DistanceMeters': 'distance',
+    'AltitudeMeters': 'altitude',
+    'LatitudeDegrees': 'latitude',
+    'LongitudeDegrees': 'longitude',
+    'Value': 'heart_rate',
+    'Cadence': 'cadence',
+    'Speed': 'speed',
+    'Watts': 'power'
+}
+# Resolution of the power lookup tables, in metres
+PLAN_STEP = 1.0
+# Lowest speed of a replay in m/s, the lower speed bound of the optimization
+MIN_SPEED = 1
+
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+def parse_time(text):
+    return np.datetime64(text.rstrip('Z'), 'ms')
+
+def read_tcx(path):
+    # Trackpoints of a TCX file as arrays, with time in seconds from the first trackpoint and the index
+    # of the lap of every trackpoint. The file is parsed incrementally and each trackpoint is freed once read
+    columns = {name: [] for name in ('time', 'lap', *TCX_FIELDS.values())}
+    lap = -1
+    for event, element in ET.iterparse(path, events=('start', 'end')):
+        name = local_name(element.tag)
+        if event == 'start':
+            lap += name == 'Lap'
+            continue
+        if name == 'Trackpoint':
+            values = {}
+            for child in element.iter():
+                child_name = local_name(child.tag)
+                if child_name == 'Time':
+                    values['time'] = parse_time(child.text)
+                elif child_name in TCX_FIELDS and child.text:
+                    values[TCX_FIELDS[child_name]] = float(child.text)
+            if 'time' in values:
+                columns['time'].append(values.pop('time'))
+                columns['lap'].append(lap)
+                for field in TCX_FIELDS.values():
+                    columns[field].append(values.get(field, np.nan))
+            element.clear()
+        elif name in ('Track', 'Lap'):
+            element.clear()
+    ride = {name: np.array(values, dtype=float) for name, values in columns.items() if name != 'time'}
+    ride['lap'] = ride['lap'].astype(int)
+    times = np.array(columns['time'], dtype='datetime64[ms]')
+    ride['time'] = (times - times[0]).astype(float)/1000 if len(times) else np.zeros(0)
+    return ride
+
+def ride_plan(ride, route_length, lap=-1):
+    # The recorded power from the start of lap as a plan over the route, with the speed at the start of
+    # lap, and the recorded time to cover route_length from there, or None if the ride stops before
+    laps = np.unique(ride['lap'])
+    keep = ride['lap'] >= laps[lap]
+    distance = ride['distance'][keep] - ride['distance'][keep][0]
+    ride_time = ride['time'][keep] - ride['time'][keep][0]
+    T = float(np.interp(route_length, distance, ride_time)) if distance[-1] >= route_length else None
+    end = np.searchsorted(distance, route_length, side='right')
+    return {
+        'speed': float(np.nan_to_num(ride['speed'][keep][0], nan=1)),
+        'power': np.nan_to_num(ride['power'][keep][:end]).tolist(),
+        'time': ride_time[:end].tolist(),
+        'distance': distance[:end].tolist()
+    }, T
+
+def power_table(plans, start, end, step=PLAN_STEP):
+    # Power of every plan on a uniform distance grid, as a (K, M) array. The power of a plan point is held
+    # until its next point, as the power of an interval is held in the problem
+    grid = np.arange(start, end + step, step)
+    table = np.zeros((len(plans), len(grid)))
+    for i, plan in enumerate(plans):
+        distance = np.asarray(plan['distance'], dtype=float)
+        power = np.asarray(plan['power'], dtype=float)
+        index = np.clip(np.searchsorted(distance, grid, side='right') - 1, 0, len(power) - 1)
+        table[i] = power[index]
+    return table
+
+def replay(plans, distance, slope, params, speed=1, w_bal=None, dt=0.5, substeps=2, horizon=None, step=PLAN_STEP):
+    # Forward simulates the K plans from distance[0] with the model of solve_opt, all plans in one batch.
+    # A plan is a dict with 'distance' and 'power', speed is the start speed of all plans or one per plan.
+    # Returns the finish times, nan for plans that do not finish within horizon seconds, and the position
+    # and W'bal traces on the time grid, nan after the finish
+    distance = np.asarray(distance, dtype=float)
+    K = len(plans)
+    if horizon is None:
+        # Plans with times finish close to their own final time, the others get a slow average speed
+        times = [plan['time'][-1] for plan in plans if len(plan.get('time', []))]
+        horizon = 1.5*max(times) if times else (distance[-1] - distance[0])/3
+    N = int(np.ceil(horizon/dt)) + 1
+    table = power_table(plans, distance[0], distance[-1], step)
+    rows = np.arange(K)
+
+    def power_fn(pos):
+        index = np.clip(((pos - distance[0])/step).astype(int), 0, table.shape[1] - 1)
+        return table[rows, index]
+
+    x0 = np.zeros((3, K))
+    x0[0] = distance[0]
+    x0[1] = speed
+    x0[2] = params.get('w_prime') if w_bal is None else w_bal
+    # simulate takes steps of time[-1]/N
+    X, power = simulate(np.linspace(0, N*dt, N), x0, distance, slope, params.get('mu'), params, power_fn, substeps=substeps, stop_distance=distance[-1], min_speed=MIN_SPEED)
+    t = dt*np.arange(X.shape[2])
+    pos, w_bal_trace = X[0], X[2].copy()
+
+    finished = (pos >= distance[-1]).any(axis=1)
+    T = np.full(K, np.nan)
+    for i in np.flatnonzero(finished):
+        k = np.argmax(pos[i] >= distance[-1])
+        T[i] = t[k-1] + dt*(distance[-1] - pos[i, k-1])/(pos[i, k] - pos[i, k-1])
+        w_bal_trace[i, k+1:] = np.nan
+    return {
+        'T': T,
+        'time': t,
+        'pos': pos,
+        'w_bal': w_bal_trace,
+        'power': power,
+        'min_w_bal': np.nanmin(w_bal_trace, axis=1)
+    }
+
+def compare(args):
+    # Replays the recorded rides and the stored plans over the route and prints their finish times
+    import server
+    route = route_store.get_route(server.route_names[args.route], args.num_laps)
+    distance = route['distance']
+    params = opt.model_params(vars(args), route['friction'])
+    names, plans, recorded = [], [], []
+    for path in args.tcx:
+        start = time.perf_counter()
+        ride = read_tcx(path)
+        plan, T = ride_plan(ride, distance[-1] - distance[0], args.lap)
+        print(f"Read {os.path.basename(path)}: {len(ride['time'])} trackpoints in {(time.perf_counter() - start)*1000:.0f} ms")
+        plan['distance'] = (np.array(plan['distance']) + distance[0]).tolist()
+        names.append(os.path.splitext(os.path.basename(path))[0])
+        plans.append(plan)
+        recorded.append(T)
+    for path in args.plans:
+        with open(path, 'r') as file:
+            plan = json.load(file)
+        names.append(os.path.splitext(os.path.basename(path))[0])
+        plans.append(plan)
+        recorded.append(plan['time'][-1])
+    if not plans:
+        raise SystemExit("No rides or plans to replay")
+
+    start = time.perf_counter()
+    # Rides start at their recorded speed, plans from standing as they were optimized
+    speed = [plan.get('speed', args.start_speed) for plan in plans]
+    result = replay(plans, distance, route['gradient'][2], params, speed, dt=args.dt, substeps=args.substeps)
+    replay_time = time.perf_counter() - start
+    print(f"{'Plan':<45}{'Recorded T [s]':>15}{'Replay T [s]':>13}{'Min Wbal [J]':>13}")
+    for name, T, replay_T, min_w_bal in zip(names, recorded, result['T'], result['min_w_bal']):
+        recorded_text = f"{T:>15.1f}" if T is not None else f"{'-':>15}"
+        print(f"{name:<45}{recorded_text}{replay_T:>13.1f}{min_w_bal:>13.0f}")
+    print(f"Replayed {len(plans)} plans in {replay_time:.2f} s")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded rides and pacing plans through the model")
+    parser.add_argument('--route', default='cobbled_climbs', help="Route key as sent by the mod")
+    parser.add_argument('--num-laps', type=int, default=2)
+    parser.add_argument('--weight', type=float, default=75)
+    parser.add_argument('--cp', type=float, default=290)
+    parser.add_argument('--w-prime', type=float, default=25000)
+    parser.add_argument('--max-power', type=float, default=670)
+    parser.add_argument('--tcx', nargs='*', default=sorted(glob.glob(os.path.join(TIME_TRIALS_DIR, '*.tcx'))))
+    parser.add_argument('--plans', nargs='*', default=sorted(glob.glob(os.path.join(PLANS_DIR, '*.json'))), help="Plan files with distance, power and time")
+    parser.add_argument('--lap', type=int, default=-1, help="Lap of the rides where the route starts, the last by default")
+    parser.add_argument('--start-speed', type=float, default=1, help="Start speed of the plans in m/s, the optimizations start at 1 m/s")
+    parser.add_argument('--dt', type=float, default=0.5)
+    parser.add_argument('--substeps', type=int, default=2)
+    compare(parser.parse_args())
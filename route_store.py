@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+import time
+from functools import lru_cache
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+import optimal_pacing as opt
+
+ROUTES_JSON = 'routes.json'
+ROUTES_STORE = 'routes.npz'
+# Gaussian smoothing used by solve_opt/create_initialization (2) and reoptimize (4)
+SIGMAS = (2, 4)
+
+def route_gradients(distance, elevation, sigmas=SIGMAS):
+    return {sigma: opt.calculate_gradient(distance, gaussian_filter1d(elevation, sigma)) for sigma in sigmas}
+
+def build_store(routes_path=ROUTES_JSON, store_path=ROUTES_STORE):
+    with open(routes_path, 'r') as file:
+        routes_dict = json.load(file)
+
+    arrays = {}
+    for route_name, route in routes_dict.items():
+        distance = np.ascontiguousarray(route['distance'], dtype=float)
+        elevation = np.ascontiguousarray(route['elevation'], dtype=float)
+        arrays[f'{route_name}__distance'] = distance
+        arrays[f'{route_name}__elevation'] = elevation
+        arrays[f'{route_name}__friction'] = np.ascontiguousarray(route['friction'], dtype=float)
+        for sigma, gradient in route_gradients(distance, elevation).items():
+            arrays[f'{route_name}__gradient_{sigma}'] = gradient
+    np.savez(store_path, **arrays)
+    return store_path
+
+@lru_cache(maxsize=1)
+def load_store(routes_path=ROUTES_JSON, store_path=ROUTES_STORE):
+    # Rebuild the store if it is missing or older than routes.json
+    if not os.path.exists(store_path) or os.path.getmtime(store_path) < os.path.getmtime(routes_path):
+        build_store(routes_path, store_path)
+
+    routes = {}
+    with np.load(store_path) as store:
+        for key in store.files:
+            route_name, field = key.split('__')
+            routes.setdefault(route_name, {'gradient': {}})
+            if field.startswith('gradient_'):
+                routes[route_name]['gradient'][int(field[len('gradient_'):])] = store[key]
+            else:
+                routes[route_name][field] = store[key]
+    return routes
+
+@lru_cache(maxsize=32)
+def get_route(route_name, num_laps=1):
+    route = load_store()[route_name]
+    if num_laps == 1:
+        return route
+
+    # Extended routes are cached per (route, num_laps) and smoothed over the concatenated profile
+    distance, elevation, friction = opt.extend_route(route['distance'], route['elevation'], route['friction'], num_laps)
+    return {
+        'distance': distance,
+        'elevation': elevation,
+        'friction': friction,
+        'gradient': route_gradients(distance, elevation)
+    }
+
+@lru_cache(maxsize=32)
+def get_interpolants(route_name, num_laps, sigma):
+    # Interpolants of the full route, which reoptimizations share as they solve in route coordinates
+    route = get_route(route_name, num_laps)
+    return opt.create_interpolants(route['distance'], route['gradient'][sigma], route['friction'])
+
+def timings(args):
+    route_name = args.route
+    start = time.perf_counter()
+    with open(ROUTES_JSON, 'r') as file:
+        routes_dict = json.load(file)
+    route = routes_dict[route_name]
+    slope = opt.calculate_gradient(route['distance'], gaussian_filter1d(route['elevation'], 2))
+    opt.create_interpolants(route['distance'], slope, route['friction'])
+    json_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    load_store()
+    startup_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    get_route(route_name)
+    get_interpolants(route_name, 1, 2)
+    first_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    get_route(route_name)
+    get_interpolants(route_name, 1, 2)
+    request_time = time.perf_counter() - start
+
+    print(f"Parse routes.json, gradient and interpolants: {json_time*1000:.1f} ms per request")
+    print(f"Route store startup: {startup_time*1000:.1f} ms")
+    print(f"Route store first use of {route_name}: {first_time*1000:.1f} ms")
+    print(f"Route store per request: {request_time*1000:.3f} ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert routes.json into a preprocessed route store")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help="Write routes.json to routes.npz")
+    build_parser.add_argument('--routes', default=ROUTES_JSON)
+    build_parser.add_argument('--store', default=ROUTES_STORE)
+    build_parser.set_defaults(func=lambda args: print(f"Wrote {build_store(args.routes, args.store)}"))
+
+    timings_parser = subparsers.add_parser('timings', help="Compare JSON parsing with the route store")
+    timings_parser.add_argument('--route', default='Downtown Titans')
+    timings_parser.set_defaults(func=timings)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,12 +1,28 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
+import collections
+import concurrent.futures
 import json
+import os
+import shutil
+import threading
+from functools import lru_cache
+import time
+import jobs
+import laps
+import metrics
 import optimal_pacing as opt
+import plan_store
+import policy_table
+import route_store
+import solution_cache
+import telemetry
 from simulator import *
 from optimization_plots import *
 
 app = Flask(__name__)
-CORS(app)
+# The plan version is read by the overlay, which runs on another origin
+CORS(app, expose_headers=['ETag', 'X-Plan-Version'])
 
 route_names = {
     'mech_isle_loop': 'Mech Isle Loop',
@@ -17,46 +33,407 @@ route_names = {
     'two_bridges_loop': 'Downtown Titans'
 }
 
-@app.route('/runopt', methods=['POST'])
-def run_opt():
-    opt_config = request.get_json()
-    route_name = route_names[opt_config['route']]
-    num_laps = opt_config['num_laps']
-    routes_dict = {}
-    with open('routes.json', 'r') as file:
-        routes_dict = json.load(file)
+# Problem templates are shared between requests, so N is rounded up to a multiple of this
+N_BUCKET = 50
+PROBLEM_CACHE_SIZE = 16
 
-    distance = routes_dict[route_name]['distance']
-    elevation = routes_dict[route_name]['elevation']
-    friction = routes_dict[route_name]['friction']
+# Receding-horizon reoptimizations solve the whole remaining route if less than this is left after the window
+MIN_TAIL = 500
 
-    if num_laps != 1:
-        distance, elevation, friction = opt.extend_route(distance, elevation, friction, num_laps)
-    
-    # Params
-    params = {
-        'mass_rider': opt_config['weight'],
-        'mass_bike': 8.4,
-        'g': 9.81,
-        'mu': friction,
-        'b0': 0.091,
-        'b1': 0.0087,
-        'Iw': 0.14,
-        'r': 0.33,
-        'Cd': 0.7,
-        'rho': 1.2,
-        'A': 0.4,
-        'eta': 1,
-        'w_prime': opt_config['w_prime'],
+# Solves run in this many worker processes
+JOB_WORKERS = os.cpu_count()
+# Reoptimizations due from telemetry wait while this many jobs are queued
+REOPT_BACKLOG = JOB_WORKERS
+
+# The latest plan of any session is also written here, where the overlay used to poll for it
+PLAN_FILE = 'pages/src/optimal_power.json'
+
+# A reoptimization with "correction": true is answered with the first-order correction of the session's plan
+# when its predicted error, see optimal_pacing.correction_error, is below this
+CORRECTION_MAX_ERROR = 1
+
+# With "portfolio": true a solve runs as these members at once, each a start and IPOPT options, and the first
+# to converge is the result. 'previous' starts from the cached or previous solution as a single solve does and is
+# left out without one, the others from simulations with the slope constants in START_SLOPE_CONSTS
+PORTFOLIO = (
+    ('previous', {}),
+    ('simulated', {}),
+    ('moderate', {"mu_strategy": "adaptive"}),
+    ('constant_cp', {})
+)
+# See simulator.create_initialization. 'simulated' keeps the most aggressive feasible pacing, 'moderate' at most
+# half of it and 'constant_cp' rides at CP
+START_SLOPE_CONSTS = {
+    'simulated': np.linspace(0, 2500, 51),
+    'moderate': np.linspace(0, 1250, 26),
+    'constant_cp': np.array([0.0])
+}
+# A portfolio that has not converged this many seconds after its first member started fails, and its members
+# are stopped. A request can set its own "deadline"
+PORTFOLIO_DEADLINE = {'runopt': 300, 'reoptimization': 60}
+
+# Rendered plots of stored solutions, the oldest are removed above PLOT_CACHE_SIZE
+PLOTS_DIR = 'plots'
+PLOT_CACHE_SIZE = 64
+
+# Last solution per session, used to warm start reoptimizations
+last_solutions = {}
+# Last full-route solution per session, the reference for receding-horizon reoptimizations
+race_plans = {}
+# Latest job per (kind, session)
+session_jobs = {}
+# Live ride tracker per session
+trackers = {}
+# Plan store per session, see get_plan_store
+plan_stores = {}
+plan_stores_lock = threading.Lock()
+reopt_stats = {'warm': [], 'cold': [], 'warm_compiled': [], 'cold_compiled': []}
+# Lookup times of reoptimizations answered from a policy table, and requests outside the table
+table_stats = {'hits': [], 'fallbacks': 0}
+# Times and predicted errors of plan corrections, and corrections rejected for a reoptimization
+correction_stats = {'hits': [], 'errors': [], 'rejected': 0}
+# Latency, outcome and winning start of every portfolio solve, per route
+portfolio_stats = collections.defaultdict(list)
+
+def bucket_N(N):
+    return int(np.ceil(N/N_BUCKET)*N_BUCKET)
+
+def problem_route(route_name, num_laps, window=None):
+    # Distance, elevation and friction a problem is built on. Time-formulation problems cover the whole route and
+    # get the start and end positions per solve. The position grid of the distance formulation is part of the
+    # problem, so it is built on window, the start and end index of the part of the route it solves
+    route = route_store.get_route(route_name, num_laps)
+    distance, elevation, friction = route['distance'], route['elevation'], route['friction']
+    if window is None:
+        return distance, elevation, friction
+    start_index, end_index = window
+    return distance[start_index:end_index], elevation[start_index:end_index], friction[start_index:end_index]
+
+def compiled_key(route_name, num_laps, sigma, window, optimization_opts):
+    # Name of a compiled problem in the 'compiled' folder, from its route and the options that change the NLP
+    return opt.problem_hash(*problem_route(route_name, num_laps, window), sigma, *(optimization_opts.get(name) for name in
+        ('N', 'integration_method', 'w_bal_model', 'negative_split', 'formulation', 'smooth_power_constraint', 'solver', 'terminal_w_bal')))
+
+@lru_cache(maxsize=PROBLEM_CACHE_SIZE)
+def get_problem(route_name, num_laps, N, integration_method, formulation="time", solver="ipopt", w_bal_model="ODE", negative_split=False, warm_start=False, smooth_power_constraint=True, terminal_w_bal=False, sigma=2, window=None, compiled=False, quiet=False, ipopt_options=()):
+    # One problem per route and structure, which every solve on the route shares. The start and end of a solve
+    # are parameters, see build_problem, so window is only given for the distance formulation, see problem_route.
+    # Full-route solves use the gradient smoothed with sigma 2 and reoptimizations with sigma 4. With
+    # terminal_w_bal, W'bal at the end gets a lower bound. ipopt_options are (name, value) pairs, so they can be
+    # part of the cache key
+    optimization_opts = {
+        "N": N,
+        "smooth_power_constraint": smooth_power_constraint,
+        "w_bal_model": w_bal_model,
+        "integration_method": integration_method,
+        "solver": solver,
+        "negative_split": negative_split,
+        "warm_start": warm_start,
+        "formulation": formulation,
+        "terminal_w_bal": terminal_w_bal,
+        "quiet": quiet,
+        "ipopt_options": dict(ipopt_options)
+    }
+    dist, elev, mu = problem_route(route_name, num_laps, window)
+    build = lambda: opt.build_problem(dist, elev, mu, optimization_opts, sigma=sigma, interpolants=route_store.get_interpolants(route_name, num_laps, sigma))
+    if compiled:
+        # Compiled problems are kept on disk, so they survive restarts and evictions from this cache
+        problem = opt.compiled_problem(compiled_key(route_name, num_laps, sigma, window, optimization_opts), build, optimization_opts)
+    else:
+        problem = build()
+    # An Opti instance can only run one solve at a time
+    problem['lock'] = threading.Lock()
+    return problem
+
+def solve_cached(solve, problem, *args):
+    with problem['lock']:
+        return solve(*args, problem=problem)
+
+def get_session(opt_config):
+    return opt_config.get('session', request.remote_addr)
+
+def store_solution(session, route_name, num_laps, solution):
+    last_solutions[session] = {
+        'route': route_name,
+        'num_laps': num_laps,
+        'solution': solution
+    }
+
+@lru_cache(maxsize=1)
+def get_job_queue():
+    # Created on first use, so the worker processes that import this module do not start their own pool
+    return jobs.JobQueue(JOB_WORKERS, on_complete=record_unsolved)
+
+@lru_cache(maxsize=1)
+def get_metrics():
+    return metrics.Metrics()
+
+def record_unsolved(job):
+    # Failed and cancelled jobs, finished jobs are recorded by publish
+    if job.status != 'done':
+        get_metrics().record(job.kind, job.status, job.finished - job.submitted)
+        record_portfolio(job, None)
+
+def record_portfolio(job, start):
+    if len(job.alternatives) > 1:
+        opt_config = job.args[0]
+        portfolio_stats[route_names[opt_config['route']]].append({
+            'kind': job.kind,
+            'outcome': job.status,
+            'latency': job.finished - job.submitted,
+            'start': start
+        })
+
+def job_key(kind, opt_config):
+    # Requests that only differ in the session or the client's counters share a solve
+    config = {key: value for key, value in opt_config.items() if key not in ('session', 'reopt_count')}
+    return kind + ':' + json.dumps(config, sort_keys=True)
+
+def publish(job):
+    # Runs in the parent process when a job finishes
+    start = time.perf_counter()
+    result = job.result
+    opt_config = job.args[0]
+    for session in job.sessions:
+        store_solution(session, route_names[opt_config['route']], opt_config['num_laps'], result['solution'])
+        if job.kind == 'runopt':
+            race_plans[session] = last_solutions[session]
+    if job.kind == 'reoptimization':
+        solve_stats = result['stats']
+        mode = ('warm' if solve_stats['warm_start'] else 'cold') + ('_compiled' if solve_stats['compiled'] else '')
+        reopt_stats[mode].append(solve_stats)
+        print(f"Reoptimization ({mode}): {solve_stats['iterations']} iterations, {solve_stats['opt_time']:.2f} s, setup {solve_stats['setup_time']:.2f} s")
+    elif job.kind == 'runopt':
+        get_solution_cache().put(cache_params(opt_config), result['solution'], result['stats'])
+        get_plot_executor().submit(publish_plot, solution_cache.solution_key(cache_params(opt_config)))
+    write_plan(result['plan'], job.kind, (route_names[opt_config['route']], opt_config['num_laps']), list(job.sessions))
+    stages = {'queue': job.started - job.submitted, **result['stats']['stages'], 'publish': time.perf_counter() - start}
+    get_metrics().record(job.kind, 'solved', time.time() - job.submitted, stages, result['stats']['solver'], result['stats']['dimensions'])
+    record_portfolio(job, result['stats']['start'])
+
+@lru_cache(maxsize=1)
+def get_plot_executor():
+    # Plots are rendered one at a time in a background thread, after the plan has been published
+    return concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+def plot_path(result_id):
+    return os.path.join(PLOTS_DIR, result_id + '.png')
+
+def render_plot(result_id):
+    # Path of the plot of the stored solution result_id, rendered on first use. None if the solution is not stored
+    path = plot_path(result_id)
+    if os.path.exists(path):
+        return path
+    stored = get_solution_cache().get_key(result_id)
+    if stored is None:
+        return None
+    start = time.perf_counter()
+    params, solution, stats = stored
+    route = route_store.get_route(params['route'], params['num_laps'])
+    plot_params = {'cp': params['cp'], 'alpha': (params['max_power'] - params['cp'])/params['w_prime']}
+    os.makedirs(PLOTS_DIR, exist_ok=True)
+    # Solutions stored before the plot details were kept only have the solve stats
+    render_plan(path + '.tmp', solution, route['distance'], route['elevation'], plot_params, stats.get('details', stats))
+    os.replace(path + '.tmp', path)
+    plots = sorted(os.listdir(PLOTS_DIR), key=lambda name: os.path.getmtime(os.path.join(PLOTS_DIR, name)))
+    for name in plots[:-PLOT_CACHE_SIZE]:
+        os.remove(os.path.join(PLOTS_DIR, name))
+    render_time = time.perf_counter() - start
+    get_metrics().record('plot', 'rendered', render_time, {'render': render_time})
+    return path
+
+def publish_plot(result_id):
+    # The latest optimization's plot is also kept as opt_plot.png, where the mod has always written it
+    path = render_plot(result_id)
+    if path is not None:
+        shutil.copyfile(path, 'opt_plot.png.tmp')
+        os.replace('opt_plot.png.tmp', 'opt_plot.png')
+
+@lru_cache(maxsize=1)
+def get_file_store():
+    # The single plan mirrored to PLAN_FILE. Starts from the file, so the last plan before a restart is kept
+    store = plan_store.PlanStore(PLAN_FILE)
+    if os.path.exists(PLAN_FILE):
+        with open(PLAN_FILE, 'r') as file:
+            store.publish(json.load(file), 'file')
+    return store
+
+def get_plan_store(session):
+    # Plans of one session, so a rider's reoptimizations are only merged into and pushed with their own plan
+    with plan_stores_lock:
+        store = plan_stores.get(session)
+        if store is None:
+            store = plan_stores[session] = plan_store.PlanStore()
+        return store
+
+def write_plan(plan, kind, route, sessions):
+    # Publishes the plan to each of the sessions. The merged plan of the last of them is written to PLAN_FILE
+    merged = None
+    for session in sessions:
+        store = get_plan_store(session)
+        store.publish(plan, kind, route)
+        merged = store.plan
+    if merged is not None:
+        get_file_store().publish(merged, 'file', route)
+
+@lru_cache(maxsize=1)
+def get_solution_cache():
+    return solution_cache.SolutionCache()
+
+def cache_params(opt_config):
+    # The request fields that determine a full-route solution
+    negative_split = bool(opt_config['negative_split'])
+    return {
+        'route': route_names[opt_config['route']],
+        'num_laps': opt_config['num_laps'],
+        'weight': opt_config['weight'],
         'cp': opt_config['cp'],
-        'alpha': (opt_config['max_power']-opt_config['cp'])/opt_config['w_prime']
+        'w_prime': opt_config['w_prime'],
+        'max_power': opt_config['max_power'],
+        'integration_method': opt_config['integration_method'],
+        'negative_split': negative_split,
+        'bound_start': opt_config['bound_start'] if negative_split else None,
+        'bound_end': opt_config['bound_end'] if negative_split else None,
+        'formulation': opt_config.get('formulation', 'time'),
+        'adaptive': bool(opt_config.get('adaptive', False)),
+        'decomposed': bool(opt_config.get('decomposed', False))
+    }
+
+def add_sensitivity(opt_config, solution, sol, problem, stages):
+    # With "correction": true the derivatives of the solution in its start state are kept with it, for
+    # correct_plan. Compiled problems have no Opti to differentiate
+    if not opt_config.get('correction') or opt_config.get('compiled'):
+        return
+    start = time.perf_counter()
+    sensitivity = opt.solution_sensitivity(sol, problem)
+    if sensitivity is not None:
+        solution['sensitivity'] = sensitivity
+    stages['sensitivity'] = time.perf_counter() - start
+
+def portfolio(kind, opt_config, args):
+    # Arguments of the members of a portfolio solve, see PORTFOLIO. args are the solve's other arguments,
+    # the solutions a 'previous' start needs
+    members = [({**opt_config, 'start': start, 'ipopt_options': options}, *args) for start, options in PORTFOLIO
+        if start != 'previous' or any(arg is not None for arg in args)]
+    return members, opt_config.get('deadline', PORTFOLIO_DEADLINE[kind])
+
+def initial_start(opt_config, previous):
+    # The start of a solve from PORTFOLIO, by default 'previous'. previous is whether there is a solution to start
+    # from, without one 'previous' falls back to 'simulated'
+    initial = opt_config.get('start', 'previous')
+    if initial not in dict(PORTFOLIO):
+        raise ValueError(f"Unknown start {initial}, the starts are {', '.join(dict(PORTFOLIO))}")
+    if initial == 'previous' and not previous:
+        return 'simulated'
+    return initial
+
+def submit(kind, fn, opt_config, *args, **fields):
+    # fields are added to the response
+    session = get_session(opt_config)
+    queue = get_job_queue()
+    alternatives, deadline = portfolio(kind, opt_config, args) if opt_config.get('portfolio') else (None, None)
+    job, shared = queue.submit(kind, job_key(kind, opt_config), fn, (opt_config, *args), session, publish, alternatives, deadline)
+    # A new reoptimization preempts the one the session is still waiting for
+    previous = session_jobs.get((kind, session))
+    if kind == 'reoptimization' and previous is not None and previous != job.id:
+        queue.detach(previous, session)
+    session_jobs[(kind, session)] = job.id
+    return jsonify({'result': 'Submitted', 'job_id': job.id, 'shared': shared, 'status': job.status, **fields}), 202
+
+def solve_decomposed(opt_config, stages):
+    # Full-route solve of a multi-lap race as one optimization per lap, see laps.solve_laps. It is slower than one
+    # optimization of the race, so it is only used with "decomposed": true. Job workers are daemonic processes,
+    # which cannot start a pool, so the laps of a step are solved one after another. Returns None if the laps
+    # have not converged, and the race is solved as one optimization instead
+    if opt_config['negative_split'] or opt_config.get('formulation', 'time') != 'time':
+        raise ValueError("The lap decomposition solves the time formulation without a negative split")
+    start = time.perf_counter()
+    race, steps = laps.solve_laps(route_names[opt_config['route']], opt_config['num_laps'], opt_config, opt_config['integration_method'])
+    if not steps[-1]['converged']:
+        stages['decomposition'] = time.perf_counter() - start
+        return None
+    stages['solve'] = time.perf_counter() - start
+    iterations = sum(sum(count for count in step['iterations'] if count is not None) for step in steps)
+    opt_details = {
+        "N": len(race['power']) - 1,
+        "w_bal_model": "ODE",
+        "integration_method": opt_config['integration_method'],
+        "iterations": iterations,
+        "opt_time": stages['solve'],
+        "negative_split": False,
+        "formulation": "time",
+        "compiled": False,
+        "setup_time": 0,
+        "levels": None,
+        "steps": len(steps)
+    }
+    plan = {
+        'power': race['power'].tolist(),
+        'time': race['time'].tolist(),
+        'distance': race['pos'].tolist(),
+        'w_bal': race['w_bal'].tolist()
+    }
+    return {
+        'plan': plan,
+        'solution': race,
+        'stats': {
+            'iterations': iterations,
+            'opt_time': stages['solve'],
+            'setup_time': 0,
+            'warm_start': False,
+            'start': 'simulated',
+            'levels': None,
+            'details': opt_details,
+            'stages': stages,
+            'solver': None,
+            'dimensions': None
+        }
     }
 
-    N = round(distance[-1]/5)
-    timegrid = np.linspace(0,round(distance[-1]/1000*150), N)
+def solve_run_opt(opt_config, nearest=None):
+    # Full-route solve, initialized from the cached solution nearest if given. opt_config['start'] can choose a
+    # start from PORTFOLIO instead. Runs in a job worker process
+    stages = {}
+    start = time.perf_counter()
+    route_name = route_names[opt_config['route']]
+    num_laps = opt_config['num_laps']
+    route = route_store.get_route(route_name, num_laps)
+    distance, elevation, friction = route['distance'], route['elevation'], route['friction']
+    stages['route'] = time.perf_counter() - start
+    
+    params = opt.model_params(opt_config, friction)
+    if opt_config.get('decomposed'):
+        result = solve_decomposed(opt_config, stages)
+        if result is not None:
+            return result
+
+    formulation = opt_config.get('formulation', 'time')
+    start = time.perf_counter()
+    x0 = [distance[0], 1, params.get('w_prime')]
+    initial = initial_start(opt_config, nearest is not None)
+    warm_start = initial == 'previous'
+    if not warm_start:
+        N = round(distance[-1]/5)
+        timegrid = np.linspace(0,round(distance[-1]/1000*150), N)
 
-    X, power, t_grid = create_initialization(timegrid, [distance[0], 1, params.get('w_prime')], distance, elevation, params)
-    N = len(power)-1
+        X, power, t_grid = create_initialization(timegrid, x0, distance, elevation, params, START_SLOPE_CONSTS[initial], slope=route['gradient'][2])
+        N = bucket_N(len(power)-1)
+        X, power, t_grid = resample_initialization(X, power, t_grid, N)
+        initialization = {
+            'pos_init': X[0],
+            'speed_init': X[1],
+            'w_bal_init': X[2],
+            'power_init': power,
+            'time_init': timegrid[-1],
+            'time_grid': t_grid
+        }
+    else:
+        # Start from the closest cached solution, with W'bal shifted to start at this athlete's W'
+        N = bucket_N(len(nearest['power'])-1)
+        initialization = opt.shift_solution(nearest, distance[0], N, formulation, x0, params.get('w_prime'))
+        initialization['pos_init'] = initialization['pos_init'] + distance[0]
+        initialization['lam_g'] = None
+    stages['initialization'] = time.perf_counter() - start
     if opt_config['negative_split'] == False:
         w_bal_start = 0
         w_bal_end = 0
@@ -66,134 +443,498 @@ def run_opt():
 
     optimization_opts = {
         "N": N,
-        "time_initial_guess": t_grid[-1],
+        "time_initial_guess": initialization['time_init'],
         "smooth_power_constraint": True,
         "w_bal_model": "ODE",
         "integration_method": opt_config['integration_method'],
         "solver": "ipopt",
         "negative_split": opt_config['negative_split'],
         "w_bal_start": w_bal_start,
-        "w_bal_end": w_bal_end
+        "w_bal_end": w_bal_end,
+        "formulation": formulation,
+        "compiled": opt_config.get('compiled', False),
+        "quiet": opt_config.get('quiet', False),
+        "ipopt_options": opt_config.get('ipopt_options', {})
     }
-    
-    initialization = {
-        'pos_init': X[0],
-        'speed_init': X[1],
-        'w_bal_init': X[2],
-        'power_init': power,
-        'time_init': timegrid[-1],
-    }
-    sol, opti, T, U, X = opt.solve_opt(distance, elevation, params, optimization_opts, initialization)
-    stats = sol.stats()
+
+    levels = None
+    if opt_config.get('adaptive'):
+        # Coarse-to-fine solve, the grids differ per request so the problems are not cached or compiled
+        start = time.perf_counter()
+        interpolants = route_store.get_interpolants(route_name, num_laps, 2)
+        sol, problem, levels = opt.solve_adaptive(distance, elevation, params, optimization_opts, initialization, route['gradient'][2], interpolants)
+        T, U, X = problem['T'], problem['U'], problem['X']
+        N = levels[-1]['N']
+        iterations = sum(level['iterations'] for level in levels)
+        opt_time = sum(level['opt_time'] for level in levels)
+        setup_time = sum(level['setup_time'] for level in levels)
+        stages['solve'] = time.perf_counter() - start - setup_time
+    else:
+        start = time.perf_counter()
+        problem = get_problem(route_name, num_laps, N, optimization_opts.get("integration_method"), optimization_opts.get("formulation"), w_bal_model=optimization_opts.get("w_bal_model"), negative_split=optimization_opts.get("negative_split"), compiled=optimization_opts.get("compiled"), quiet=optimization_opts.get("quiet"), ipopt_options=tuple(sorted(optimization_opts["ipopt_options"].items())))
+        setup_time = time.perf_counter() - start
+        start = time.perf_counter()
+        sol, opti, T, U, X = solve_cached(opt.solve_opt, problem, distance, elevation, params, optimization_opts, initialization)
+        stages['solve'] = time.perf_counter() - start
+        stats = sol.stats()
+        iterations = stats['iter_count']
+        opt_time = stats['t_wall_total']
     opt_details = {
         "N": N,
         "w_bal_model": optimization_opts.get("w_bal_model"),
         "integration_method": optimization_opts.get("integration_method"),
         "time_init_guess": optimization_opts.get("time_initial_guess"),
-        "iterations": stats['iter_count'],
-        "opt_time": stats['t_wall_total'],
+        "iterations": iterations,
+        "opt_time": opt_time,
         "negative_split": optimization_opts.get("negative_split"),
         "w_bal_start": optimization_opts.get("w_bal_start"),
-        "w_bal_end": optimization_opts.get("w_bal_end")
+        "w_bal_end": optimization_opts.get("w_bal_end"),
+        "formulation": optimization_opts.get("formulation"),
+        "compiled": optimization_opts.get("compiled"),
+        "setup_time": setup_time,
+        "levels": levels
     }
 
-    fig2 = plot_optimization_results(sol, U, X, T, distance, elevation, params, opt_details, False)
-    t_grid = ca.linspace(0, sol.value(T), N+1)
+    stages['setup'] = setup_time
+    start = time.perf_counter()
     power_dict = {
         'power': sol.value(U).tolist(),
-        'time': t_grid.full().flatten().tolist(),
+        'time': sol.value(problem['time']).tolist(),
         'distance': list(np.array(sol.value(X[0,:]).tolist())),
         'w_bal': sol.value(X[2,:]).tolist()
     }
-    with open('pages/src/optimal_power.json', 'w') as file:
-        json.dump(power_dict, file)
-    return jsonify({'result': 'Success'}), 200
+    solution = opt.extract_solution(sol, problem)
+    stages['extract'] = time.perf_counter() - start
+    add_sensitivity(opt_config, solution, sol, problem, stages)
+    return {
+        'plan': power_dict,
+        'solution': solution,
+        'stats': {
+            'iterations': iterations,
+            'opt_time': opt_time,
+            'setup_time': setup_time,
+            'warm_start': warm_start,
+            'start': initial,
+            'levels': levels,
+            'details': opt_details,
+            'stages': stages,
+            'solver': metrics.solver_metrics(sol.stats()),
+            'dimensions': metrics.problem_dimensions(problem, N)
+        }
+    }
 
+def covers(stored, route_name, num_laps, start, end):
+    # Whether a stored solution is for this route and spans start to end
+    return bool(stored is not None and stored['route'] == route_name and stored['num_laps'] == num_laps
+        and stored['solution']['pos'][0] <= start and stored['solution']['pos'][-1] >= end - 1)
 
-@app.route('/reoptimization', methods=['POST'])
-def reoptimize():
-    opt_config = request.get_json()
+def solve_reoptimization(opt_config, previous, race_plan=None):
+    # Reoptimization from the current state, warm started from the previous solution of the session if given.
+    # With a "horizon" in metres and the session's full-route solution race_plan, only the next horizon metres
+    # are optimized and the rest of the race plan is appended. opt_config['start'] can choose a start from
+    # PORTFOLIO instead. Runs in a job worker process
+    stages = {}
+    start = time.perf_counter()
     initial_state = [opt_config['distance'], opt_config['speed'], opt_config['w_bal']]
     route_name = route_names[opt_config['route']]
     num_laps = opt_config['num_laps']
-    routes_dict = {}
-
-    with open('routes.json', 'r') as file:
-        routes_dict = json.load(file)
-
-    distance = routes_dict[route_name]['distance']
-    elevation = routes_dict[route_name]['elevation']
-    friction = routes_dict[route_name]['friction']
-
-    if num_laps != 1:
-        distance, elevation, friction = opt.extend_route(distance, elevation, friction, num_laps)
-
-    # Params
-    params = {
-        'mass_rider': opt_config['weight'],
-        'mass_bike': 8.4,
-        'g': 9.81,
-        'mu': friction,
-        'b0': 0.091,
-        'b1': 0.0087,
-        'Iw': 0.14,
-        'r': 0.33,
-        'Cd': 0.7,
-        'rho': 1.2,
-        'A': 0.4,
-        'eta': 1,
-        'w_prime': opt_config['w_prime'],
-        'cp': opt_config['cp'],
-        'alpha': (opt_config['max_power']-opt_config['cp'])/opt_config['w_prime']
-    }
+    route = route_store.get_route(route_name, num_laps)
+    distance, elevation, friction = route['distance'], route['elevation'], route['friction']
+    stages['route'] = time.perf_counter() - start
 
+    params = opt.model_params(opt_config, friction)
+
+    start = time.perf_counter()
     index = np.argwhere(np.array(distance) > initial_state[0])[0][0]
-    dist = distance[index:]
-    dist = [elem - distance[index] for elem in dist] # Shifting to start from 0
-    elev = elevation[index:]
-    params['mu'] = friction[index:]
-    N = round(dist[-1]/5)
-    timegrid = np.linspace(0,round(dist[-1]/1000*150), N)
-
-    try:
-        sim_X, power, t_grid = create_initialization(timegrid, [dist[0], initial_state[1], initial_state[2]], dist, elev, params)
-    except:
-        print("Something went wrong")
-
-    N = len(power)-1
+    end_index = None
+    horizon = opt_config.get('horizon')
+    if horizon and covers(race_plan, route_name, num_laps, distance[index], distance[-1]) and distance[index] + horizon < distance[-1] - MIN_TAIL:
+        end_index = np.argwhere(np.array(distance) >= distance[index] + horizon)[0][0] + 1
+    dist = distance[index:end_index] - distance[index] # Shifting to start from 0
+    elev = elevation[index:end_index]
+    params['mu'] = friction[index:end_index]
+    end = distance[index] + dist[-1]
+    formulation = opt_config.get('formulation', 'time')
+    w_bal_terminal = None
+    if end_index is not None:
+        # The window ends with the race plan's W'bal, less the deficit the rider has to it now
+        plan = race_plan['solution']
+        deficit = max(0, np.interp(distance[index], plan['pos'], plan['w_bal']) - initial_state[2])
+        w_bal_terminal = max(0, np.interp(end, plan['pos'], plan['w_bal']) - deficit)
+        if not covers(previous, route_name, num_laps, distance[index], end):
+            previous = race_plan
+    initial = initial_start(opt_config, covers(previous, route_name, num_laps, distance[index], end))
+    warm_start = initial == 'previous'
+
+    if warm_start:
+        # Resample the remaining part of the previous solution onto the new grid
+        if end_index is None:
+            N = bucket_N(np.count_nonzero(previous['solution']['pos'] > distance[index]))
+        else:
+            # Windows have a fixed size
+            N = bucket_N(horizon/5)
+        initialization = opt.shift_solution(previous['solution'], distance[index], N, formulation, initial_state, params.get('w_prime'), end)
+        initialization['pos_init'] = initialization['pos_init'] + distance[index]
+    else:
+        N = round(dist[-1]/5)
+        timegrid = np.linspace(0,round(dist[-1]/1000*150), N)
+
+        sim_X, power, t_grid = create_initialization(timegrid, [dist[0], initial_state[1], initial_state[2]], dist, elev, params, START_SLOPE_CONSTS[initial], slope=route['gradient'][2][index:end_index])
+
+        N = bucket_N(len(power)-1)
+        sim_X, power, t_grid = resample_initialization(sim_X, power, t_grid, N)
+        initialization = {
+            'pos_init': sim_X[0] + distance[index],
+            'speed_init': sim_X[1],
+            'w_bal_init': sim_X[2],
+            'power_init': power,
+            'time_init': t_grid[-1],
+            'time_grid': t_grid
+        }
+    stages['initialization'] = time.perf_counter() - start
+
     optimization_opts = {
         "N": N,
-        "time_initial_guess": t_grid[-1],
+        "end_distance": end,
+        "time_initial_guess": initialization.get('time_init'),
         "smooth_power_constraint": True,
         "w_bal_model": "ODE",
         "integration_method": "Euler",
-        "solver": "ipopt"
-    }
-    initialization = {
-        'pos_init': sim_X[0],
-        'speed_init': sim_X[1],
-        'w_bal_init': sim_X[2],
-        'power_init': power,
-        'time_init': t_grid[-1],
-    }            
-    
-    try:
-        reopt_sol, reopt_opti, reopt_T, reopt_U, reopt_X = opt.reoptimize(dist, elev, [0, initial_state[1], initial_state[2]], params, optimization_opts, initialization)
-    except:
-        print("something went wrong")
-    t_grid = ca.linspace(0, reopt_sol.value(reopt_T), N+1)
-    pos = np.array(reopt_sol.value(reopt_X[0,:])) + distance[index] # Shift back to original
+        "solver": "ipopt",
+        "warm_start": warm_start,
+        "formulation": formulation,
+        "compiled": opt_config.get('compiled', False),
+        "w_bal_terminal": w_bal_terminal
+    }
+
+    # A failed solve raises, which fails the job
+    start = time.perf_counter()
+    # The problem of the whole route is shared by all reoptimizations, only the distance formulation has one per window
+    window = (index, end_index) if formulation == "distance" else None
+    problem = get_problem(route_name, num_laps, N, optimization_opts.get("integration_method"), formulation, w_bal_model=optimization_opts.get("w_bal_model"), warm_start=warm_start,
+        terminal_w_bal=end_index is not None, sigma=4, window=window, compiled=optimization_opts.get("compiled"), quiet=opt_config.get('quiet', False), ipopt_options=tuple(sorted(opt_config.get('ipopt_options', {}).items())))
+    setup_time = time.perf_counter() - start
+    start = time.perf_counter()
+    reopt_sol, reopt_opti, reopt_T, reopt_U, reopt_X = solve_cached(opt.reoptimize, problem, dist + distance[index], elev, [distance[index], initial_state[1], initial_state[2]], params, optimization_opts, initialization)
+    stages['solve'] = time.perf_counter() - start
+    stats = reopt_sol.stats()
+    solve_stats = {
+        'warm_start': warm_start,
+        'start': initial,
+        'compiled': optimization_opts.get("compiled"),
+        'iterations': stats['iter_count'],
+        'opt_time': stats['t_wall_total'],
+        'setup_time': setup_time,
+        'N': N,
+        'horizon': None if end_index is None else float(dist[-1])
+    }
+    stages['setup'] = setup_time
+
+    start = time.perf_counter()
+    pos = np.array(reopt_sol.value(reopt_X[0,:]))
     power_dict = {
         'power': reopt_sol.value(reopt_U).tolist(),
-        'time': t_grid.full().flatten().tolist(),
+        'time': reopt_sol.value(problem['time']).tolist(),
         'distance': pos.tolist(),
         'w_bal': reopt_sol.value(reopt_X[2,:]).tolist()
     }
-    with open('pages/src/optimal_power.json', 'w') as file:
-        json.dump(power_dict, file)
+    if end_index is not None:
+        # The race plan after the window, with its times continuing from the end of the window
+        plan = race_plan['solution']
+        tail = plan['pos'] > pos[-1]
+        t_end = np.interp(pos[-1], plan['pos'], plan['time'])
+        power_dict['power'] += plan['power'][tail].tolist()
+        power_dict['time'] += (plan['time'][tail] - t_end + power_dict['time'][-1]).tolist()
+        power_dict['distance'] += plan['pos'][tail].tolist()
+        power_dict['w_bal'] += plan['w_bal'][tail].tolist()
+    solution = opt.extract_solution(reopt_sol, problem)
+    stages['extract'] = time.perf_counter() - start
+    if end_index is None:
+        # A window is followed by the race plan, which its sensitivities do not cover
+        add_sensitivity(opt_config, solution, reopt_sol, problem, stages)
+    solve_stats.update({
+        'stages': stages,
+        'solver': metrics.solver_metrics(stats),
+        'dimensions': metrics.problem_dimensions(problem, N)
+    })
+    return {
+        'plan': power_dict,
+        'solution': solution,
+        'stats': solve_stats
+    }
+
+
+@app.route('/runopt', methods=['POST'])
+def run_opt():
+    start = time.perf_counter()
+    opt_config = request.get_json()
+    params = cache_params(opt_config)
+    cached = get_solution_cache().get(params)
+    lookup_time = time.perf_counter() - start
+    if cached is not None:
+        solution, stats = cached
+        store_solution(get_session(opt_config), params['route'], params['num_laps'], solution)
+        race_plans[get_session(opt_config)] = last_solutions[get_session(opt_config)]
+        write_plan({
+            'power': solution['power'].tolist(),
+            'time': solution['time'].tolist(),
+            'distance': solution['pos'].tolist(),
+            'w_bal': solution['w_bal'].tolist()
+        }, 'runopt', (params['route'], params['num_laps']), [get_session(opt_config)])
+        get_metrics().record('runopt', 'cache_hit', time.perf_counter() - start, {'cache_lookup': lookup_time, 'publish': time.perf_counter() - start - lookup_time})
+        get_plot_executor().submit(publish_plot, solution_cache.solution_key(params))
+        return jsonify({'result': 'Success', 'cached': True, 'stats': stats, 'result_id': solution_cache.solution_key(params)}), 200
+    return submit('runopt', solve_run_opt, opt_config, get_solution_cache().nearest(params), result_id=solution_cache.solution_key(params))
+
+
+@app.route('/reoptimization', methods=['POST'])
+def reoptimize():
+    return start_reoptimization(request.get_json())
+
+
+def start_reoptimization(opt_config):
+    session = get_session(opt_config)
+    table = policy_table.find_table(policy_table.table_params(opt_config, route_names))
+    if table is not None:
+        start = time.perf_counter()
+        plan = policy_table.lookup(table, opt_config['distance'], opt_config['speed'], opt_config['w_bal'])
+        lookup_time = time.perf_counter() - start
+        if plan is not None:
+            # The interpolated plan replaces any reoptimization the session is still waiting for
+            previous = session_jobs.pop(('reoptimization', session), None)
+            if previous is not None:
+                get_job_queue().detach(previous, session)
+            write_plan(plan, 'reoptimization', (route_names[opt_config['route']], opt_config['num_laps']), [session])
+            table_stats['hits'].append(lookup_time)
+            get_metrics().record('reoptimization', 'table_hit', time.perf_counter() - start, {'table_lookup': lookup_time})
+            return jsonify({'result': 'Success', 'table': True, 'lookup_time': lookup_time}), 200
+        # Outside the states covered by the table
+        table_stats['fallbacks'] += 1
+    if opt_config.get('correction'):
+        corrected = correct_plan(opt_config, session)
+        if corrected is not None:
+            return corrected
+    return submit('reoptimization', solve_reoptimization, opt_config, last_solutions.get(session), race_plans.get(session))
+
+
+def correct_plan(opt_config, session):
+    # First-order correction of the session's plan to the rider's state, published if its predicted error is
+    # below CORRECTION_MAX_ERROR. None if the plan has no sensitivities or the correction needs a reoptimization.
+    # A corrected plan is stored for the session with the solution it was corrected from, so later corrections
+    # are taken from that solution's sensitivities as well
+    previous = last_solutions.get(session)
+    route_name = route_names[opt_config['route']]
+    if previous is None or (previous['route'], previous['num_laps']) != (route_name, opt_config['num_laps']):
+        return None
+    base = previous.get('base', previous['solution'])
+    if 'sensitivity' not in base or not base['pos'][0] <= opt_config['distance'] < base['pos'][-1]:
+        return None
+    start = time.perf_counter()
+    route = route_store.get_route(route_name, opt_config['num_laps'])
+    corrected = opt.correct_solution(base, opt_config['distance'], opt_config['w_bal'])
+    correction_time = time.perf_counter() - start
+    start = time.perf_counter()
+    error = opt.correction_error(corrected, base, route['distance'], route['gradient'][2], opt.model_params(opt_config, route['friction']))
+    error_time = time.perf_counter() - start
+    if not error < CORRECTION_MAX_ERROR:
+        correction_stats['rejected'] += 1
+        return None
+    previous = session_jobs.pop(('reoptimization', session), None)
+    if previous is not None:
+        get_job_queue().detach(previous, session)
+    store_solution(session, route_name, opt_config['num_laps'], corrected)
+    last_solutions[session]['base'] = base
+    start = time.perf_counter()
+    write_plan({
+        'power': corrected['power'].tolist(),
+        'time': corrected['time'].tolist(),
+        'distance': corrected['pos'].tolist(),
+        'w_bal': corrected['w_bal'].tolist()
+    }, 'correction', (route_name, opt_config['num_laps']), [session])
+    publish_time = time.perf_counter() - start
+    correction_stats['hits'].append(correction_time + error_time)
+    correction_stats['errors'].append(error)
+    get_metrics().record('reoptimization', 'correction', correction_time + error_time + publish_time, {'correction': correction_time, 'error': error_time, 'publish': publish_time})
+    return jsonify({'result': 'Success', 'correction': True, 'error': error, 'correction_time': correction_time + error_time}), 200
+
+
+@app.route('/telemetry', methods=['POST'])
+def ride_telemetry():
+    # Ride samples with time [s], power, speed [m/s], distance and optionally the game's W'bal, with the
+    # optimization settings as sent to /reoptimization. With "reoptimization": true, a reoptimization is
+    # submitted when the session's tracker finds the rider far enough from the plan. It is deferred while
+    # the session's previous reoptimization runs or REOPT_BACKLOG jobs are queued. With "correction": true in the
+    # settings, smaller deviations correct the plan without a solve, see correct_plan
+    start = time.perf_counter()
+    opt_config = request.get_json()
+    samples = opt_config.pop('samples', [])
+    enabled = opt_config.pop('reoptimization', False)
+    session = get_session(opt_config)
+    tracker = trackers.get(session)
+    if samples and (tracker is None or (tracker.cp, tracker.w_prime) != (opt_config['cp'], opt_config['w_prime'])
+            or tracker.new_ride(samples[0]['time'], samples[0]['distance'])):
+        tracker = trackers[session] = telemetry.RideTracker(opt_config['cp'], opt_config['w_prime'])
+    if tracker is None:
+        return jsonify({'result': 'No samples'}), 400
+    for sample in samples:
+        tracker.add(sample['time'], sample['power'], sample['speed'], sample['distance'], sample.get('w_bal'))
+    plan = last_solutions.get(session)
+    if (plan is not None and (plan['route'], plan['num_laps']) == (route_names[opt_config['route']], opt_config['num_laps'])
+            and tracker.plan is not plan['solution']):
+        tracker.set_plan(plan['solution'])
+
+    outcome = 'tracked'
+    response = {'result': 'Success', **tracker.summary()}
+    reoptimization_due = tracker.reoptimization_due()
+    if enabled and (reoptimization_due or (opt_config.get('correction') and tracker.correction_due())):
+        previous = get_job_queue().get(session_jobs.get(('reoptimization', session)))
+        state = tracker.last
+        state_config = {**opt_config, 'distance': state['distance'], 'speed': state['speed'], 'w_bal': tracker.current_w_bal()}
+        if previous is not None and not previous.done.is_set():
+            # Due again with the next samples
+            outcome = 'deferred'
+        elif not reoptimization_due:
+            # A deviation below REOPT_W_BAL_DEVIATION is only corrected. A rejected correction is tried again
+            # CORRECTION_SPACING m later, until a reoptimization is due
+            correction = correct_plan(state_config, session)
+            tracker.corrected()
+            if correction is not None:
+                outcome = 'corrected'
+                response['correction'] = correction[0].get_json()
+        elif get_job_queue().stats()['pending'] >= REOPT_BACKLOG:
+            outcome = 'deferred'
+        else:
+            reoptimization, status = start_reoptimization(state_config)
+            tracker.reoptimized()
+            response['reoptimization'] = reoptimization.get_json()
+            outcome = 'corrected' if response['reoptimization'].get('correction') else 'reoptimized'
+    response['outcome'] = outcome
+    get_metrics().record('telemetry', outcome, time.perf_counter() - start)
+    return jsonify(response), 200
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({'result': 'Unknown job'}), 404
+    return jsonify(job.summary()), 200
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    if not get_job_queue().cancel(job_id):
+        return jsonify({'result': 'Job is not queued or running'}), 409
+    return jsonify(get_job_queue().get(job_id).summary()), 200
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({'result': 'Unknown job'}), 404
+    if not job.done.is_set():
+        return jsonify(job.summary()), 202
+    if job.status != 'done':
+        return jsonify(job.summary()), 500 if job.status == 'failed' else 409
+    return jsonify({**job.summary(), 'plan': job.result['plan'], 'stats': job.result['stats']}), 200
+
+
+@app.route('/plan', methods=['GET'])
+def plan():
+    # The latest plan of the session, from ?session= or the client's address, or 304 if its ETag is in If-None-Match
+    version, etag, body = get_plan_store(get_session(request.args)).get()
+    if body is None:
+        return jsonify({'result': 'No plan'}), 404
+    response = Response(body, mimetype='application/json', headers={'X-Plan-Version': str(version), 'Cache-Control': 'no-cache'})
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+@app.route('/plan/events', methods=['GET'])
+def plan_events():
+    # Server-sent events for new plans. The first event is the current plan unless Last-Event-ID is its ETag.
+    # With ?diff=suffix a reoptimization is sent as the replaced end of the plan. Sessions are chosen as for /plan
+    store = get_plan_store(get_session(request.args))
+    version = store.parse_etag(request.headers.get('Last-Event-ID'))
+    events = store.events(version, request.args.get('diff') == 'suffix')
+    return Response(events, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/plot/<result_id>', methods=['GET'])
+def plot(result_id):
+    # result_id is returned by /runopt. The plot is rendered now unless the background render has written it
+    path = get_plot_executor().submit(render_plot, result_id).result()
+    if path is None:
+        return jsonify({'result': 'Unknown result'}), 404
+    return send_file(os.path.abspath(path), mimetype='image/png')
+
+
+@app.route('/jobs', methods=['GET'])
+def job_stats():
+    return jsonify(get_job_queue().stats()), 200
+
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(get_solution_cache().stats()), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # Prometheus text by default, JSON summaries with ?format=json or an Accept header that prefers JSON
+    if request.args.get('format') == 'json' or request.accept_mimetypes.best == 'application/json':
+        return jsonify(get_metrics().summary()), 200
+    return get_metrics().prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@app.route('/reoptimization/stats', methods=['GET'])
+def reoptimization_stats():
+    summary = {}
+    for mode, solves in reopt_stats.items():
+        summary[mode] = {
+            'count': len(solves),
+            'mean_iterations': np.mean([s['iterations'] for s in solves]) if solves else None,
+            'mean_opt_time': np.mean([s['opt_time'] for s in solves]) if solves else None,
+            'mean_setup_time': np.mean([s['setup_time'] for s in solves]) if solves else None
+        }
+    summary['table'] = {
+        'count': len(table_stats['hits']),
+        'fallbacks': table_stats['fallbacks'],
+        'mean_lookup_time': np.mean(table_stats['hits']) if table_stats['hits'] else None
+    }
+    summary['correction'] = {
+        'count': len(correction_stats['hits']),
+        'rejected': correction_stats['rejected'],
+        'mean_time': np.mean(correction_stats['hits']) if correction_stats['hits'] else None,
+        'mean_error': np.mean(correction_stats['errors']) if correction_stats['errors'] else None
+    }
+    return jsonify(summary), 200
+
+
+@app.route('/portfolio/stats', methods=['GET'])
+def portfolio_summary():
+    # Latency percentiles and failure rate of portfolio solves per route and over all routes, with the starts that won
+    def summarize(records):
+        latencies = [record['latency'] for record in records if record['outcome'] == 'done']
+        return {
+            'count': len(records),
+            'failure_rate': sum(record['outcome'] == 'failed' for record in records)/len(records),
+            'p50': float(np.percentile(latencies, 50)) if latencies else None,
+            'p99': float(np.percentile(latencies, 99)) if latencies else None,
+            'winners': dict(collections.Counter(record['start'] for record in records if record['start'] is not None))
+        }
 
-    return jsonify({'result': 'Success'}), 200
+    summary = {route: summarize(records) for route, records in portfolio_stats.items()}
+    records = [record for route_records in portfolio_stats.values() for record in route_records]
+    summary['all'] = summarize(records) if records else None
+    return jsonify(summary), 200
 
 
 if __name__ == '__main__':
-    app.run(port=5000)
\ No newline at end of file
+    start = time.perf_counter()
+    route_store.load_store()
+    print(f"Loaded route store in {(time.perf_counter() - start)*1000:.1f} ms")
+    get_job_queue()
+    get_file_store()
+    app.run(port=5000, threaded=True)
\ No newline at end of file
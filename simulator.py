@@ -1,15 +1,20 @@
-import casadi as ca
 from scipy.ndimage import gaussian_filter1d
-from optimal_pacing import calculate_gradient, smooth_w_balance_ode_derivative
+from optimal_pacing import calculate_gradient
 import numpy as np
 
-def create_initialization(time, x0, distance, elevation, params):
-    # Mechanical model params
-    mass_rider = params.get("mass_rider")
-    mass_bike = params.get("mass_bike")
-    m = mass_bike + mass_rider
+def smooth_w_balance_derivative(u, cp, w_bal, w_prime, smoothness=10):
+    # NumPy version of smooth_w_balance_ode_derivative
+    transition = 0.5 + 0.5*np.tanh((u - cp)/smoothness)
+
+    return (1-transition)*(1-w_bal/w_prime)*(cp-u) + transition*(cp-u)
+
+def simulate(time, x0, distance, slope, friction, params, power_fn, substeps=4, stop_distance=None, min_speed=None):
+    # Forward simulate the model with RK4 for a batch of K power policies.
+    # x0 has shape (3, K) and power_fn maps positions of shape (K,) to powers of shape (K,).
+    # The simulation is cut short once every policy has passed stop_distance. With min_speed the
+    # speed is kept above it, as the speed bound of the optimization does
+    m = params.get("mass_bike") + params.get("mass_rider")
     g = params.get("g")
-    mu = params.get("mu")
     b0 = params.get("b0")
     b1 = params.get("b1")
     Iw = params.get("Iw")
@@ -18,55 +23,77 @@ def create_initialization(time, x0, distance, elevation, params):
     rho = params.get("rho")
     A = params.get("A")
     eta = params.get("eta")
-
-    # Physiological model params
     w_prime = params.get("w_prime")
     cp = params.get("cp")
 
-    sigma = 2
-    smoothed_elev = gaussian_filter1d(elevation, sigma)
+    distance = np.asarray(distance, dtype=float)
+    slope = np.asarray(slope, dtype=float)
+    friction = np.asarray(friction, dtype=float)
 
-    slope = calculate_gradient(distance, smoothed_elev)
+    def dynamics(x, u):
+        mu = np.interp(x[0], distance, friction)
+        grad = np.interp(x[0], distance, slope)
+        return np.array([x[1],
+                (1/x[1] * 1/(m + Iw/r**2)) * (eta*u - mu*m*g*x[1] - m*g*grad*x[1] - b0*x[1] - b1*x[1]**2 - 0.5*Cd*rho*A*x[1]**3),
+                smooth_w_balance_derivative(u, cp, x[2], w_prime)])
+
+    K = np.shape(x0)[1]
+    N = len(time)
+    h = time[-1]/N/substeps
 
-    interpolated_slope = ca.interpolant('Slope', 'bspline', [distance], slope)
-    interpolated_friction = ca.interpolant('Friction', 'bspline', [distance], mu)
-    def system_dynamics(x, u):
-        return ca.vertcat(x[1], 
-                (1/x[1] * 1/(m + Iw/r**2)) * (eta*u - interpolated_friction(x[0])*m*g*x[1] - m*g*interpolated_slope(x[0])*x[1] - b0*x[1] - b1*x[1]**2 - 0.5*Cd*rho*A*x[1]**3),
-                smooth_w_balance_ode_derivative(u, cp, x, w_prime)) 
+    X = np.zeros((3, K, N))
+    power = np.zeros((K, N))
+    X[:,:,0] = x0
+    x = X[:,:,0]
+    for k in range(N):
+        # Power is held constant over a sample as in the CasADi integrator
+        u = power_fn(x[0])
+        power[:,k] = u
+        if k == N-1:
+            break
+        if stop_distance is not None and (x[0] >= stop_distance).all():
+            return X[:,:,:k+1], power[:,:k+1]
+        for _ in range(substeps):
+            k1 = dynamics(x, u)
+            k2 = dynamics(x + h/2*k1, u)
+            k3 = dynamics(x + h/2*k2, u)
+            k4 = dynamics(x + h*k3, u)
+            x = x + h/6*(k1 + 2*k2 + 2*k3 + k4)
+            if min_speed is not None:
+                x[1] = np.maximum(x[1], min_speed)
+        X[:,:,k+1] = x
+    return X, power
+
+def create_initialization(time, x0, distance, elevation, params, slope_consts=np.linspace(0, 2500, 51), slope=None):
+    # Simulates all slope_const candidates as one batch and keeps the most aggressive one
+    # that never takes W'bal below 1000 J, the same criterion as the bisection
+    cp = params.get("cp")
+
+    if slope is None:
+        sigma = 2
+        smoothed_elev = gaussian_filter1d(elevation, sigma)
+        slope = calculate_gradient(distance, smoothed_elev)
+    distance = np.asarray(distance, dtype=float)
 
     tf = time[-1]
     N = len(time)
     t_grid = np.linspace(0,tf,N)
 
-    dt = tf/N  
-    t0 = 0
-    x = ca.MX.sym('x', 3) 
-    u = ca.MX.sym('u', 1)  
-    f = system_dynamics(x, u)  
-    ode = {'x': x, 'p': u, 'ode': f}  
-    F = ca.integrator('F', 'rk', ode, t0, dt)   
-
-    lower_bound = 0
-    upper_bound = 2500
-    while upper_bound - lower_bound > 50:  
-        slope_const = (upper_bound + lower_bound) / 2
-        X = np.zeros((3, N))
-        U = lambda pos: cp + slope_const*interpolated_slope(pos)
-        power = []
+    power_fn = lambda pos: cp + slope_consts*np.interp(pos, distance, slope)
+    x0 = np.repeat(np.reshape(x0, (3, 1)), len(slope_consts), axis=1)
+    X, power = simulate(t_grid, x0, distance, slope, params.get("mu"), params, power_fn, stop_distance=distance[-1])
 
-        X[:,0] = x0
-        for k in range(N-1):
-            res = F(x0=X[:,k], p=U(X[0,k]))  
-            X[:,k+1] = res['xf'].full().flatten()
-            power.append(U(X[0,k]))  
-        
-        power = np.array(power).flatten()
+    feasible = np.flatnonzero(~(X[2] < 1000).any(axis=1))
+    best = feasible[-1] if len(feasible) else 0
+    X = X[:,best,:]
+    power = power[best]
 
-        if (X[2] < 1000).any():
-            upper_bound = slope_const
-        else:
-            lower_bound = slope_const
+    end_index = np.argwhere(np.array(X[0,:]) >= distance[-1])[0][0]
+    return X[:,:end_index], power[:end_index], t_grid[:end_index]
 
-        end_index = np.argwhere(np.array(X[0,:]) >= distance[-1])[0][0]
-    return X[:,:end_index], power[:end_index], t_grid[:end_index]
\ No newline at end of file
+def resample_initialization(X, power, t_grid, N):
+    # Linearly resample a simulated initialization onto N+1 evenly spaced points in time
+    t_new = np.linspace(t_grid[0], t_grid[-1], N+1)
+    X_new = np.array([np.interp(t_new, t_grid, X[i]) for i in range(X.shape[0])])
+    power_new = np.interp(t_new, t_grid, power)
+    return X_new, power_new, t_new
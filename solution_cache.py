@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+
+SOLUTIONS_DIR = 'solutions'
+# Least recently used solutions are removed above this total size
+MAX_BYTES = 256*2**20
+# Athlete params that are compared for a warm start, and the largest relative distance that is used
+NEAREST_PARAMS = ('weight', 'cp', 'w_prime', 'max_power')
+NEAREST_MAX_DISTANCE = 0.3
+
+def solution_key(params):
+    # Canonical hash of the params that define a solve
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def param_distance(a, b, names=NEAREST_PARAMS):
+    # Euclidean distance of the relative differences of the athlete params
+    return np.sqrt(sum(((a[name] - b[name])/b[name])**2 for name in names))
+
+class SolutionCache:
+    # Solutions stored as one npz file per key. The file mtime is the last use, and the params
+    # of all stored solutions are kept in memory for the nearest neighbour search
+    def __init__(self, directory=SOLUTIONS_DIR, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.index = {}
+        self.counts = {'hits': 0, 'misses': 0, 'warm_starts': 0}
+        os.makedirs(directory, exist_ok=True)
+        for file_name in os.listdir(directory):
+            if file_name.endswith('.npz'):
+                with np.load(os.path.join(directory, file_name)) as data:
+                    self.index[file_name[:-4]] = json.loads(str(data['params']))
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        solution = {'lam_g': {}}
+        with np.load(self.path(key)) as data:
+            for name in data.files:
+                if name.startswith('lam_g__'):
+                    solution['lam_g'][name[len('lam_g__'):]] = data[name]
+                elif name not in ('params', 'stats'):
+                    solution[name] = data[name]
+            stats = json.loads(str(data['stats']))
+        solution['T'] = float(solution['T'])
+        return solution, stats
+
+    def get(self, params):
+        # Exact hit as (solution, stats), or None
+        key = solution_key(params)
+        with self.lock:
+            if key not in self.index:
+                self.counts['misses'] += 1
+                return None
+            self.counts['hits'] += 1
+            os.utime(self.path(key))
+            return self.load(key)
+
+    def get_key(self, key):
+        # Params, solution and stats stored under key, or None. Not counted as a lookup
+        with self.lock:
+            if key not in self.index:
+                return None
+            solution, stats = self.load(key)
+            return self.index[key], solution, stats
+
+    def nearest(self, params, match=('route', 'num_laps', 'formulation')):
+        # Closest stored solution for the same route, or None if none is within NEAREST_MAX_DISTANCE
+        with self.lock:
+            candidates = [(param_distance(stored, params), key) for key, stored in self.index.items()
+                if all(stored.get(name) == params.get(name) for name in match)]
+            if not candidates:
+                return None
+            distance, key = min(candidates)
+            if distance > NEAREST_MAX_DISTANCE:
+                return None
+            self.counts['warm_starts'] += 1
+            os.utime(self.path(key))
+            return self.load(key)[0]
+
+    def put(self, params, solution, stats):
+        key = solution_key(params)
+        arrays = {name: value for name, value in solution.items() if name != 'lam_g'}
+        arrays.update({f'lam_g__{name}': values for name, values in solution['lam_g'].items()})
+        with self.lock:
+            # Written under a temporary name so a half-written file is never loaded
+            with open(self.path(key) + '.tmp', 'wb') as file:
+                np.savez(file, params=json.dumps(params), stats=json.dumps(stats), **arrays)
+            os.replace(self.path(key) + '.tmp', self.path(key))
+            self.index[key] = params
+            self.evict()
+
+    def evict(self):
+        # Called with the lock held
+        files = sorted((os.path.getmtime(self.path(key)), os.path.getsize(self.path(key)), key) for key in self.index)
+        total = sum(size for _, size, _ in files)
+        for _, size, key in files[:-1]:
+            if total <= self.max_bytes:
+                break
+            os.remove(self.path(key))
+            del self.index[key]
+            total -= size
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counts['hits'] + self.counts['misses']
+            return {
+                **self.counts,
+                'hit_rate': self.counts['hits']/lookups if lookups else None,
+                'solutions': len(self.index),
+                'bytes': sum(os.path.getsize(self.path(key)) for key in self.index)
+            }
@@ -0,0 +1,169 @@
+import argparse
+import csv
+import glob
+import multiprocessing
+import os
+import signal
+import time
+import traceback
+import numpy as np
+from solution_cache import solution_key
+
+# Athlete columns read from the profiles table
+ATHLETE_COLUMNS = ('name', 'weight', 'cp', 'w_prime', 'max_power')
+# Scalar result columns, plans are stored as flat arrays with per-row offsets
+STAT_COLUMNS = ('T', 'N', 'iterations', 'opt_time', 'setup_time', 'wall_time')
+PLAN_COLUMNS = ('power', 'time', 'distance', 'w_bal')
+
+def read_athletes(path):
+    with open(path, 'r', newline='') as file:
+        rows = list(csv.DictReader(file))
+    missing = [name for name in ATHLETE_COLUMNS if rows and name not in rows[0]]
+    if missing:
+        raise SystemExit(f"{path} is missing the columns {', '.join(missing)}")
+    return [{'name': row['name'], **{name: float(row[name]) for name in ATHLETE_COLUMNS[1:]}} for row in rows]
+
+def sweep_tasks(athletes, routes, args, route_names):
+    # One opt_config per athlete and route, keyed by what the solve depends on. Route keys that map
+    # to the same route give the same key and are solved once
+    tasks = {}
+    for athlete in athletes:
+        for route in routes:
+            opt_config = {
+                'route': route,
+                'num_laps': args.num_laps,
+                'weight': athlete['weight'],
+                'cp': athlete['cp'],
+                'w_prime': athlete['w_prime'],
+                'max_power': athlete['max_power'],
+                'integration_method': args.integration_method,
+                'negative_split': False,
+                'formulation': args.formulation,
+                'quiet': True
+            }
+            params = {**{name: value for name, value in opt_config.items() if name not in ('route', 'quiet')}, 'route': route_names[route]}
+            tasks.setdefault(solution_key(params), (athlete['name'], opt_config))
+    return tasks
+
+def init_worker():
+    # Ctrl-C is handled in the main process, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def solve_task(task):
+    # Runs in a pool process
+    import server
+    key, (athlete, opt_config) = task
+    start = time.perf_counter()
+    try:
+        result = server.solve_run_opt(opt_config)
+    except Exception:
+        return key, athlete, opt_config, None, traceback.format_exc()
+    result['stats']['wall_time'] = time.perf_counter() - start
+    return key, athlete, opt_config, result, None
+
+def part_path(output, key):
+    return os.path.join(output + '.parts', key + '.npz')
+
+def write_part(output, key, athlete, opt_config, result, error):
+    # One finished solve, written under a temporary name so an interrupted write is never read back
+    row = {'key': key, 'athlete': athlete, 'route': opt_config['route'], 'num_laps': opt_config['num_laps'],
+        **{name: opt_config[name] for name in ATHLETE_COLUMNS[1:]}, 'status': 'failed' if result is None else 'done', 'error': error or ''}
+    if result is None:
+        row.update({name: np.nan for name in STAT_COLUMNS})
+        row.update({name: np.zeros(0) for name in PLAN_COLUMNS})
+    else:
+        row.update({
+            'T': result['plan']['time'][-1],
+            'N': len(result['plan']['power']) - 1,
+            'wall_time': result['stats']['wall_time'],
+            **{name: result['stats'][name] for name in ('iterations', 'opt_time', 'setup_time')},
+            **{name: np.asarray(result['plan'][name], dtype=float) for name in PLAN_COLUMNS}
+        })
+    path = part_path(output, key)
+    with open(path + '.tmp', 'wb') as file:
+        np.savez(file, **row)
+    os.replace(path + '.tmp', path)
+
+def load_results(path):
+    # Columns of a results file as a dict of arrays, the plan of row i is
+    # results[name][results['offsets'][i]:results['offsets'][i+1]]
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+def result_rows(results):
+    rows = []
+    for i in range(len(results['key'])):
+        row = {name: values[i] for name, values in results.items() if name not in PLAN_COLUMNS + ('offsets',)}
+        row.update({name: results[name][results['offsets'][i]:results['offsets'][i+1]] for name in PLAN_COLUMNS})
+        rows.append(row)
+    return rows
+
+def consolidate(output):
+    # Merge the finished parts into the results file. A part replaces an earlier row with the same key
+    rows = {}
+    if os.path.exists(output):
+        rows.update((str(row['key']), row) for row in result_rows(load_results(output)))
+    parts = sorted(glob.glob(os.path.join(output + '.parts', '*.npz')))
+    for path in parts:
+        with np.load(path) as data:
+            rows[str(data['key'])] = {name: data[name] for name in data.files}
+    if not parts:
+        return rows
+    rows_list = list(rows.values())
+    lengths = [len(row['power']) for row in rows_list]
+    columns = {name: np.array([row[name] for row in rows_list]) for name in rows_list[0] if name not in PLAN_COLUMNS}
+    columns.update({name: np.concatenate([row[name] for row in rows_list]) for name in PLAN_COLUMNS})
+    columns['offsets'] = np.concatenate([[0], np.cumsum(lengths)])
+    with open(output + '.tmp', 'wb') as file:
+        np.savez_compressed(file, **columns)
+    os.replace(output + '.tmp', output)
+    for path in parts:
+        os.remove(path)
+    return rows
+
+def run(args):
+    import server
+    athletes = read_athletes(args.athletes)
+    routes = args.routes or list(server.route_names)
+    unknown = [route for route in routes if route not in server.route_names]
+    if unknown:
+        raise SystemExit(f"Unknown routes {', '.join(unknown)}, the routes are {', '.join(server.route_names)}")
+    tasks = sweep_tasks(athletes, routes, args, server.route_names)
+    os.makedirs(args.output + '.parts', exist_ok=True)
+    # Finished solves from an earlier run are skipped, failed ones are tried again
+    done = {key for key, row in consolidate(args.output).items() if row['status'] == 'done'}
+    todo = [(key, task) for key, task in tasks.items() if key not in done]
+    print(f"{len(tasks)} solves, {len(tasks) - len(todo)} already in {args.output}, running {len(todo)} on {args.workers} workers")
+
+    start = time.perf_counter()
+    finished = failed = 0
+    pool = multiprocessing.get_context('spawn').Pool(args.workers, init_worker)
+    try:
+        for key, athlete, opt_config, result, error in pool.imap_unordered(solve_task, todo):
+            write_part(args.output, key, athlete, opt_config, result, error)
+            finished += 1
+            failed += result is None
+            rate = finished/(time.perf_counter() - start)*60
+            outcome = f"failed: {error.strip().splitlines()[-1]}" if result is None else f"T {result['plan']['time'][-1]:.1f} s in {result['stats']['wall_time']:.1f} s"
+            print(f"[{finished}/{len(todo)}] {athlete} on {opt_config['route']}: {outcome}, {rate:.2f} solves/min")
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        print("Interrupted, run the same command again to resume")
+    finally:
+        pool.join()
+        consolidate(args.output)
+    elapsed = time.perf_counter() - start
+    if finished:
+        print(f"Solved {finished - failed} and failed {failed} in {elapsed:.0f} s, {finished/elapsed*60:.2f} solves/min. Wrote {args.output}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pacing plans for every athlete profile on every route, solved in parallel")
+    parser.add_argument('athletes', help="CSV file with the columns " + ', '.join(ATHLETE_COLUMNS))
+    parser.add_argument('--routes', nargs='*', help="Route keys as sent by the mod, all routes by default")
+    parser.add_argument('--num-laps', type=int, default=1)
+    parser.add_argument('--integration-method', default='RK4', choices=['Euler', 'Midpoint', 'RK4'])
+    parser.add_argument('--formulation', default='time', choices=['time', 'distance'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--output', default='sweep_results.npz')
+    run(parser.parse_args())
@@ -0,0 +1,163 @@
+import collections
+import math
+from simulator import smooth_w_balance_derivative
+
+# Window of the rolling average power and of normalized power, in seconds
+ROLLING_WINDOW = 30
+# Power is held from one sample to the next for at most this many seconds, longer gaps are pauses in which
+# the rider recovers at zero power
+MAX_GAP = 5
+# A reoptimization is due when W'bal is REOPT_W_BAL_DEVIATION J from the plan, at least REOPT_MIN_DISTANCE m
+# into the route, REOPT_SPACING m after the previous one and above REOPT_MIN_SPEED m/s, as the mod decided before
+REOPT_W_BAL_DEVIATION = 3000
+REOPT_MIN_DISTANCE = 1000
+REOPT_SPACING = 1000
+REOPT_MIN_SPEED = 10/3.6
+# With plan corrections, a correction is tried when W'bal is CORRECTION_W_BAL_DEVIATION J from the plan and
+# CORRECTION_SPACING m after the previous correction or reoptimization
+CORRECTION_W_BAL_DEVIATION = 250
+CORRECTION_SPACING = 200
+# A sample this far behind the previous one, or this many seconds after it, starts a new ride
+RESTART_DISTANCE = 100
+MAX_PAUSE = 3600
+
+class RideTracker:
+    # Rolling 30 s power, normalized power and modeled W'bal of one ride, updated in constant time per sample.
+    # Power is held from a sample to the next and averaged over whole seconds, the samples normalized_power takes
+    def __init__(self, cp, w_prime):
+        self.cp = cp
+        self.w_prime = w_prime
+        self.window = collections.deque(maxlen=ROLLING_WINDOW)
+        self.window_sum = 0.0
+        # Start of the second being filled and the energy in it so far
+        self.second = None
+        self.second_energy = 0.0
+        # Sum of the 4th powers of the rolling averages and their count
+        self.np_sum = 0.0
+        self.np_count = 0
+        self.w_bal = w_prime
+        self.last = None
+        self.samples = 0
+        self.plan = None
+        self.cursor = 0
+        self.last_reoptimization = None
+        self.last_correction = None
+
+    def add(self, time, power, speed, distance, w_bal=None):
+        # w_bal is the W'bal reported by the game, if any. It is used for the reoptimization decision
+        # and as the start state of a reoptimization, the modeled W'bal is only reported
+        if self.last is not None and time > self.last['time']:
+            gap = time - self.last['time']
+            held = min(gap, MAX_GAP)
+            self.hold(self.last['time'], held, self.last['power'])
+            if held < gap:
+                # W'bal recovers for the rest of the pause, which is left out of the averages
+                self.integrate_w_bal(gap - held, 0)
+                self.second, self.second_energy = math.floor(time), 0.0
+        elif self.last is None:
+            self.second = math.floor(time)
+        self.last = {'time': time, 'power': power, 'speed': speed, 'distance': distance, 'w_bal': w_bal}
+        self.samples += 1
+
+    def new_ride(self, time, distance):
+        # Whether a sample at time and distance starts a new ride rather than continuing this one
+        return self.last is not None and (distance < self.last['distance'] - RESTART_DISTANCE or time > self.last['time'] + MAX_PAUSE)
+
+    def integrate_w_bal(self, duration, power):
+        # At a constant power the derivative is rate - decay*w_bal, so W'bal approaches rate/decay exponentially,
+        # or changes linearly at the rate when decay is 0. Constant time for any duration
+        rate = smooth_w_balance_derivative(power, self.cp, 0, self.w_prime)
+        decay = (rate - smooth_w_balance_derivative(power, self.cp, self.w_prime, self.w_prime))/self.w_prime
+        growth = duration if decay == 0 else -math.expm1(-decay*duration)/decay
+        self.w_bal = min(self.w_bal*math.exp(-decay*duration) + rate*growth, self.w_prime)
+
+    def hold(self, start, duration, power):
+        # W'bal, and the whole seconds completed in start to start + duration
+        self.integrate_w_bal(duration, power)
+        end = start + duration
+        while end >= self.second + 1:
+            self.second_energy += power*(self.second + 1 - max(start, self.second))
+            self.push_second(self.second_energy)
+            self.second, self.second_energy = self.second + 1, 0.0
+        self.second_energy += power*(end - max(start, self.second))
+
+    def push_second(self, power):
+        if len(self.window) == ROLLING_WINDOW:
+            self.window_sum -= self.window[0]
+        self.window.append(power)
+        self.window_sum += power
+        if len(self.window) == ROLLING_WINDOW:
+            self.np_sum += (self.window_sum/ROLLING_WINDOW)**4
+            self.np_count += 1
+
+    def rolling_power(self):
+        return self.window_sum/len(self.window) if self.window else None
+
+    def normalized_power(self):
+        return (self.np_sum/self.np_count)**0.25 if self.np_count else None
+
+    def set_plan(self, plan):
+        # plan is a solution with 'pos' and 'w_bal', as stored for the session
+        self.plan = plan
+        self.cursor = 0
+
+    def target_w_bal(self, distance):
+        # The plan's W'bal at distance. The cursor follows the rider along the plan, so this is constant time
+        pos = self.plan['pos']
+        if distance < pos[self.cursor]:
+            self.cursor = 0
+        while self.cursor < len(pos) - 2 and pos[self.cursor + 1] <= distance:
+            self.cursor += 1
+        i = self.cursor
+        if distance <= pos[0] or distance >= pos[-1]:
+            return float(self.plan['w_bal'][0 if distance <= pos[0] else -1])
+        frac = (distance - pos[i])/(pos[i+1] - pos[i])
+        return float(self.plan['w_bal'][i] + frac*(self.plan['w_bal'][i+1] - self.plan['w_bal'][i]))
+
+    def current_w_bal(self):
+        return self.last['w_bal'] if self.last['w_bal'] is not None else self.w_bal
+
+    def deviation(self):
+        if self.plan is None or self.last is None:
+            return None
+        return self.current_w_bal() - self.target_w_bal(self.last['distance'])
+
+    def reoptimization_due(self):
+        deviation = self.deviation()
+        if deviation is None:
+            return False
+        distance = self.last['distance']
+        return (abs(deviation) > REOPT_W_BAL_DEVIATION and distance > REOPT_MIN_DISTANCE
+            and distance < self.plan['pos'][-1] and self.last['speed'] > REOPT_MIN_SPEED
+            and (self.last_reoptimization is None or distance - self.last_reoptimization > REOPT_SPACING))
+
+    def reoptimized(self):
+        self.last_reoptimization = self.last['distance']
+
+    def correction_due(self):
+        deviation = self.deviation()
+        if deviation is None:
+            return False
+        distance = self.last['distance']
+        previous = max([d for d in (self.last_reoptimization, self.last_correction) if d is not None], default=None)
+        return (abs(deviation) > CORRECTION_W_BAL_DEVIATION and distance > REOPT_MIN_DISTANCE
+            and distance < self.plan['pos'][-1] and self.last['speed'] > REOPT_MIN_SPEED
+            and (previous is None or distance - previous > CORRECTION_SPACING))
+
+    def corrected(self):
+        self.last_correction = self.last['distance']
+
+    def summary(self):
+        deviation = self.deviation()
+        return {
+            'samples': self.samples,
+            'distance': None if self.last is None else self.last['distance'],
+            'rolling_power': self.rolling_power(),
+            'normalized_power': self.normalized_power(),
+            'w_bal': self.w_bal,
+            'reported_w_bal': None if self.last is None else self.last['w_bal'],
+            'target_w_bal': None if deviation is None else self.current_w_bal() - deviation,
+            'deviation': deviation,
+            'last_reoptimization': self.last_reoptimization,
+            'last_correction': self.last_correction
+        }
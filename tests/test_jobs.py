@@ -0,0 +1,100 @@
+import time
+import pytest
+import jobs
+
+def work(action, value=None):
+    # Job function, run in the worker processes
+    if action == 'sleep':
+        time.sleep(value)
+    elif action == 'fail':
+        raise ValueError(value)
+    return value
+
+@pytest.fixture
+def make_queue():
+    queues = []
+    def make(workers, **kwargs):
+        queue = jobs.JobQueue(workers, **kwargs)
+        queues.append(queue)
+        return queue
+    yield make
+    for queue in queues:
+        for worker in queue.workers:
+            worker.process.terminate()
+
+def wait(job, timeout=30):
+    assert job.done.wait(timeout)
+    return job
+
+def test_same_key_shares_a_job(make_queue):
+    queue = make_queue(1)
+    callbacks = []
+    job, shared = queue.submit('runopt', 'key', work, ('sleep', 0.5), session='a', callback=callbacks.append)
+    other, other_shared = queue.submit('runopt', 'key', work, ('sleep', 0.5), session='b', callback=callbacks.append)
+    assert other is job and not shared and other_shared
+    assert job.sessions == {'a', 'b'}
+    assert wait(job).status == 'done' and job.result == 0.5
+    # The job is published once for both sessions
+    time.sleep(0.1)
+    assert callbacks == [job]
+    # A finished job is not shared any more
+    again, shared = queue.submit('runopt', 'key', work, ('sleep', 0.5), session='a')
+    assert again is not job and not shared
+    wait(again)
+
+def test_cancelled_when_last_session_detaches(make_queue):
+    queue = make_queue(1)
+    job, _ = queue.submit('reoptimization', 'key', work, ('sleep', 30), session='a')
+    queue.submit('reoptimization', 'key', work, ('sleep', 30), session='b')
+    while job.status == 'queued':
+        time.sleep(0.01)
+    queue.detach(job.id, 'a')
+    assert job.status == 'running' and job.sessions == {'b'}
+    queue.detach(job.id, 'b')
+    assert wait(job, 10).status == 'cancelled'
+    # The worker is restarted and takes the next job
+    assert wait(queue.submit('runopt', 'next', work, ('value', 1))[0]).result == 1
+
+def test_cancel_queued_job(make_queue):
+    queue = make_queue(1)
+    running, _ = queue.submit('runopt', 'running', work, ('sleep', 1))
+    queued, _ = queue.submit('runopt', 'queued', work, ('value', 1))
+    assert queue.cancel(queued.id)
+    assert queued.status == 'cancelled' and queued.done.is_set()
+    assert not queue.cancel(queued.id)
+    assert wait(running).status == 'done'
+
+def test_unpicklable_job_fails(make_queue):
+    queue = make_queue(1)
+    job, _ = queue.submit('runopt', 'key', work, ('value', lambda: None))
+    assert wait(job).status == 'failed' and 'pickle' in job.error.lower()
+    # The worker is restarted and takes the next job
+    assert wait(queue.submit('runopt', 'next', work, ('value', 1))[0]).result == 1
+
+def test_first_success_wins(make_queue):
+    completed = []
+    queue = make_queue(3, on_complete=completed.append)
+    alternatives = [('fail', 'first'), ('sleep', 20), ('value', 'fast')]
+    callbacks = []
+    start = time.perf_counter()
+    job, _ = queue.submit('runopt', 'key', work, alternatives[0], callback=callbacks.append, alternatives=alternatives, deadline=30)
+    assert wait(job).status == 'done'
+    assert time.perf_counter() - start < 20
+    assert job.winner == 2 and job.args == alternatives[2] and job.result == 'fast'
+    assert callbacks == [job] and completed == [job]
+    # The slow alternative's worker is stopped and the queue keeps working
+    assert wait(queue.submit('runopt', 'next', work, ('value', 1))[0]).result == 1
+
+def test_fails_when_every_alternative_fails(make_queue):
+    queue = make_queue(2)
+    alternatives = [('fail', 'first'), ('fail', 'second')]
+    job, _ = queue.submit('runopt', 'key', work, alternatives[0], alternatives=alternatives)
+    assert wait(job).status == 'failed'
+    assert 'first' in job.error and 'second' in job.error
+
+def test_deadline_expires(make_queue):
+    completed = []
+    queue = make_queue(1, on_complete=completed.append)
+    job, _ = queue.submit('reoptimization', 'key', work, ('sleep', 30), deadline=0.5)
+    assert wait(job, 10).status == 'failed'
+    assert 'deadline' in job.error and completed == [job]
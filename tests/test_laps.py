@@ -0,0 +1,54 @@
+import numpy as np
+import laps
+import server
+
+ATHLETE = {'weight': 75, 'cp': 250, 'w_prime': 20000, 'max_power': 700}
+
+def fake_map(fn, tasks):
+    # Every lap takes 300 s and ends at 10 m/s with 15000 J, whatever its start state and prices
+    results = []
+    for task in tasks:
+        pos = np.linspace(0, 1000, 11)
+        results.append({
+            'lap': task['lap'],
+            'solution': {
+                'time': np.linspace(0, 300, 11),
+                'pos': pos,
+                'speed': np.full(11, 10.0),
+                'w_bal': np.full(11, 15000.0),
+                'power': np.full(11, 250.0),
+                'T': 300.0,
+                'lam_g': {}
+            },
+            'start_price': np.array([-1.0, -0.001]),
+            'iterations': 10,
+            'wall': 0.0
+        })
+    return results
+
+def test_converges_when_laps_join_up():
+    race, steps = laps.solve_laps('Mech Isle Loop', 2, ATHLETE, map_fn=fake_map)
+    # The second step moves the start states to the end states, which the third step finds unchanged
+    assert [step['converged'] for step in steps] == [False, False, True]
+    assert race['T'] == 600
+
+def test_flags_no_convergence(monkeypatch):
+    monkeypatch.setattr(laps, 'MAX_ITERATIONS', 2)
+    race, steps = laps.solve_laps('Mech Isle Loop', 2, ATHLETE, map_fn=fake_map)
+    assert len(steps) == 2 and not steps[-1]['converged']
+
+def test_server_falls_back_without_convergence(monkeypatch):
+    # The server's solve of the laps, one after another, with the fake laps
+    solve_laps = laps.solve_laps
+    monkeypatch.setattr(laps, 'MAX_ITERATIONS', 2)
+    monkeypatch.setattr(laps, 'solve_laps', lambda *args: solve_laps(*args, map_fn=fake_map))
+    opt_config = {
+        'route': next(key for key, name in server.route_names.items() if name == 'Mech Isle Loop'),
+        'num_laps': 2,
+        'integration_method': 'RK4',
+        'negative_split': False,
+        **ATHLETE
+    }
+    stages = {}
+    assert server.solve_decomposed(opt_config, stages) is None
+    assert 'decomposition' in stages and 'solve' not in stages
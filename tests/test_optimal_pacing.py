@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+import optimal_pacing as opt
+import route_store
+
+def extend_route_loop(distance, elevation, friction, num_laps):
+    # extend_route before it was vectorized, without its IndexError when more than 9 points are dropped
+    new_elevation = []
+    new_distance = []
+    new_friction = []
+    for i in range(num_laps):
+        new_elevation.extend(elevation)
+        new_friction.extend(friction)
+        new_distance.extend([elem + i*max(distance) for elem in distance])
+    for i in range(len(new_distance)-10):
+        if i+1 < len(new_distance) and new_distance[i+1] - new_distance[i] < 0.6:
+            new_distance.pop(i+1)
+            new_elevation.pop(i+1)
+            new_friction.pop(i+1)
+    return new_distance, new_elevation, new_friction
+
+@pytest.mark.parametrize('route_name', ['Mech Isle Loop', 'Park Perimeter Loop'])
+@pytest.mark.parametrize('num_laps', [2, 3])
+def test_extend_route_matches_loop(route_name, num_laps):
+    # Park Perimeter Loop has a run of points less than 0.6 m apart, which both thin the same way
+    route = route_store.load_store()[route_name]
+    args = [route[name].tolist() for name in ('distance', 'elevation', 'friction')]
+    extended = opt.extend_route(*args, num_laps)
+    for values, expected in zip(extended, extend_route_loop(*args, num_laps)):
+        np.testing.assert_array_equal(values, expected)
+
+def test_extend_route_thins_runs_of_close_points():
+    # Every other point of a run is dropped, counting from the first point of the run
+    distance = [0, 10, 10.1, 10.2, 10.3, 10.4, 20, 30]
+    extended_distance, elevation, friction = opt.extend_route(distance, np.arange(8), np.zeros(8), 1)
+    np.testing.assert_array_equal(extended_distance, [0, 10, 10.2, 10.4, 20, 30])
+    np.testing.assert_array_equal(elevation, [0, 1, 3, 5, 6, 7])
+
+def test_extend_route_lap_offsets():
+    distance, _, _ = opt.extend_route([5, 50, 100], [0, 1, 2], [0, 0, 0], 3)
+    np.testing.assert_array_equal(distance, [5, 50, 100, 105, 150, 200, 205, 250, 300])
@@ -0,0 +1,97 @@
+import json
+import pytest
+import plan_store
+import server
+
+ROUTE = ('Mech Isle Loop', 1)
+
+def plan(distance, time=None, power=200):
+    time = time or [10*i for i in range(len(distance))]
+    return {'power': [power]*len(distance), 'time': time, 'distance': distance, 'w_bal': [20000 - i for i in range(len(distance))]}
+
+def event_data(event):
+    lines = dict(line.split(': ', 1) for line in event.strip().split('\n'))
+    return lines['id'], json.loads(lines['data'])
+
+def test_etag_versions():
+    store = plan_store.PlanStore()
+    assert store.get() == (0, store.etag(0), None)
+    assert store.publish(plan([0, 100, 200]), 'runopt', ROUTE) == 1
+    version, etag, body = store.get()
+    assert version == 1 and store.parse_etag(etag) == 1
+    assert json.loads(body) == plan([0, 100, 200])
+    # ETags of another run of the server are not versions of this one
+    assert plan_store.PlanStore().parse_etag(etag) == 0
+    assert store.parse_etag(None) == 0 and store.parse_etag('garbage') == 0
+
+def test_file_mirror(tmp_path):
+    path = str(tmp_path / 'plan.json')
+    store = plan_store.PlanStore(path)
+    store.publish(plan([0, 100]), 'runopt', ROUTE)
+    with open(path) as file:
+        assert json.load(file) == plan([0, 100])
+
+def test_suffix_merge_continues_time():
+    store = plan_store.PlanStore()
+    store.publish(plan([0, 100, 200, 300, 400]), 'runopt', ROUTE)
+    store.publish(plan([250, 300, 400], [0, 4, 12], power=300), 'reoptimization', ROUTE)
+    merged = json.loads(store.get()[2])
+    assert merged['distance'] == [0, 100, 200, 250, 300, 400]
+    assert merged['power'] == [200, 200, 200, 300, 300, 300]
+    # The reoptimization starts at the time the current plan reaches 250 m
+    assert merged['time'] == [0, 10, 20, 25, 29, 37]
+
+def test_replaces_plan_of_other_route_or_kind():
+    store = plan_store.PlanStore()
+    store.publish(plan([0, 100, 200]), 'runopt', ROUTE)
+    store.publish(plan([150, 200]), 'reoptimization', ('Hilly Route', 1))
+    assert json.loads(store.get()[2])['distance'] == [150, 200]
+    store.publish(plan([0, 100, 200]), 'runopt', ROUTE)
+    store.publish(plan([50, 200]), 'runopt', ROUTE)
+    assert json.loads(store.get()[2])['distance'] == [50, 200]
+
+def test_events_send_diff_to_clients_on_base_version():
+    store = plan_store.PlanStore()
+    store.publish(plan([0, 100, 200, 300]), 'runopt', ROUTE)
+    store.publish(plan([150, 300], [0, 10]), 'reoptimization', ROUTE)
+    event_id, data = event_data(next(store.events(1, diff=True)))
+    assert store.parse_etag(event_id) == 2
+    assert data['base'] == 1 and data['start'] == 2 and data['kind'] == 'reoptimization'
+    assert data['plan']['distance'] == [150, 300] and data['plan']['time'] == [15, 25]
+    # A client more than one version behind, or without diffs, only gets the notice
+    _, data = event_data(next(store.events(0, diff=True)))
+    assert 'plan' not in data and data['version'] == 2
+    _, data = event_data(next(store.events(1)))
+    assert 'plan' not in data
+
+def test_events_heartbeat():
+    store = plan_store.PlanStore()
+    assert next(store.events(0, heartbeat=0.01)) == ': heartbeat\n\n'
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'PLAN_FILE', str(tmp_path / 'plan.json'))
+    monkeypatch.setattr(server, 'plan_stores', {})
+    server.get_file_store.cache_clear()
+    yield server.app.test_client()
+    server.get_file_store.cache_clear()
+
+def test_plan_not_modified(client):
+    assert client.get('/plan?session=a').status_code == 404
+    server.write_plan(plan([0, 100]), 'runopt', ROUTE, ['a'])
+    response = client.get('/plan?session=a')
+    assert response.status_code == 200 and response.headers['X-Plan-Version'] == '1'
+    assert client.get('/plan?session=a', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    server.write_plan(plan([0, 200]), 'runopt', ROUTE, ['a'])
+    assert client.get('/plan?session=a', headers={'If-None-Match': response.headers['ETag']}).status_code == 200
+
+def test_plans_per_session(client):
+    server.write_plan(plan([0, 100, 200, 300]), 'runopt', ROUTE, ['a'])
+    server.write_plan(plan([0, 100, 200, 300], power=250), 'runopt', ROUTE, ['b'])
+    # A reoptimization of one session is not merged into the plan of another
+    server.write_plan(plan([150, 300], power=400), 'reoptimization', ROUTE, ['b'])
+    assert client.get('/plan?session=a').get_json() == plan([0, 100, 200, 300])
+    assert client.get('/plan?session=b').get_json()['power'] == [250, 250, 400, 400]
+    # The plan file has the latest plan of any session
+    with open(server.PLAN_FILE) as file:
+        assert json.load(file)['power'] == [250, 250, 400, 400]
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import policy_table
+
+def make_table():
+    # Plans on a grid of start distances, speeds and W'bals. The plan from distances[i] is NaN before it, and its
+    # power is linear in the start state, so interpolating between grid states is exact
+    distances = np.array([0.0, 500, 1000])
+    speeds = np.array([5.0, 10])
+    w_bals = np.array([10000.0, 15000, 20000])
+    pos = np.linspace(0, 1000, 11)
+    shape = (len(distances), len(speeds), len(w_bals), len(pos))
+    power = np.empty(shape)
+    w_bal = np.empty(shape)
+    time = np.empty(shape)
+    for i, d in enumerate(distances):
+        for j, s in enumerate(speeds):
+            for k, w in enumerate(w_bals):
+                power[i,j,k] = 100 + 10*s + 0.01*w + i + pos/100
+                w_bal[i,j,k] = w - 2*pos
+                time[i,j,k] = (1 + i)*pos/10
+    before = pos[None,:] < distances[:,None]
+    for array in (power, w_bal, time):
+        array[np.broadcast_to(before[:,None,None,:], shape)] = np.nan
+    return {'distances': distances, 'speeds': speeds, 'w_bals': w_bals, 'pos': pos, 'power': power, 'w_bal': w_bal, 'time': time}
+
+def test_lookup_at_grid_node():
+    table = make_table()
+    plan = policy_table.lookup(table, 500, 10, 15000)
+    keep = table['pos'] >= 500
+    np.testing.assert_allclose(plan['power'], table['power'][1,1,1,keep])
+    np.testing.assert_allclose(plan['w_bal'], table['w_bal'][1,1,1,keep])
+    np.testing.assert_allclose(plan['time'], table['time'][1,1,1,keep] - table['time'][1,1,1,keep][0])
+    assert plan['distance'] == table['pos'][keep].tolist()
+
+def test_lookup_between_grid_nodes():
+    table = make_table()
+    plan = policy_table.lookup(table, 250, 7.5, 12500)
+    pos = np.array(plan['distance'])
+    assert pos[0] == 300
+    # Before 500 m only the plans from 0 m cover the route, after it both distances are weighted by a half
+    distance_term = np.where(pos >= 500, 0.5, 0)
+    np.testing.assert_allclose(plan['power'], 100 + 75 + 125 + distance_term + pos/100)
+    np.testing.assert_allclose(plan['w_bal'], 12500 - 2*pos)
+    dt = np.where(pos[1:] > 500, 15, 10)
+    np.testing.assert_allclose(plan['time'], np.concatenate([[0], np.cumsum(dt)]))
+
+def test_lookup_at_and_beyond_edges():
+    table = make_table()
+    # The last grid node is the end of the last interval
+    assert policy_table.axis_weights(table['w_bals'], 20000) == [(1, 0.0), (2, 1.0)]
+    plan = policy_table.lookup(table, 1000, 10, 20000)
+    assert plan['power'] == pytest.approx([100 + 100 + 200 + 2 + 10])
+    assert plan['time'] == [0]
+    # States outside the table are left to a solve
+    assert policy_table.lookup(table, 1001, 10, 20000) is None
+    assert policy_table.lookup(table, 500, 4.9, 15000) is None
+    assert policy_table.lookup(table, 500, 10, 20001) is None
+
+def test_lookup_skips_failed_plans():
+    table = make_table()
+    table['power'][1,1,1] = np.nan
+    table['w_bal'][1,1,1] = np.nan
+    table['time'][1,1,1] = np.nan
+    assert policy_table.lookup(table, 500, 10, 15000) is None
+    # Between grid states the other plans make up for it
+    plan = policy_table.lookup(table, 500, 10, 17500)
+    keep = table['pos'] >= 500
+    np.testing.assert_allclose(plan['power'], table['power'][1,1,2,keep])
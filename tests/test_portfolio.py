@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+import route_store
+import server
+
+ROUTE = 'Mech Isle Loop'
+OPT_CONFIG = {
+    'route': 'mech_isle_loop',
+    'num_laps': 1,
+    'weight': 75,
+    'cp': 250,
+    'w_prime': 20000,
+    'max_power': 700,
+    'integration_method': 'Euler',
+    'negative_split': False,
+    'quiet': True
+}
+
+@pytest.fixture(scope='module')
+def race_plan():
+    solution = server.solve_run_opt(OPT_CONFIG)['solution']
+    return {'route': ROUTE, 'num_laps': 1, 'solution': solution}
+
+def test_portfolio_members_in_horizon_mode(race_plan):
+    # Every member solves a window that ends before the finish, and the race plan is appended after it
+    plan = race_plan['solution']
+    distance = 500
+    state = {
+        **OPT_CONFIG,
+        'distance': distance,
+        'speed': np.interp(distance, plan['pos'], plan['speed']),
+        'w_bal': np.interp(distance, plan['pos'], plan['w_bal']) - 2000,
+        'horizon': 1500
+    }
+    members, _ = server.portfolio('reoptimization', state, (None, race_plan))
+    assert [config['start'] for config, *_ in members] == [start for start, _ in server.PORTFOLIO]
+    route_end = route_store.get_route(ROUTE, 1)['distance'][-1]
+    for config, *args in members:
+        result = server.solve_reoptimization(config, *args)
+        assert result['stats']['horizon'] is not None
+        assert result['stats']['start'] == config['start']
+        assert result['plan']['distance'][-1] == pytest.approx(plan['pos'][-1])
+        assert result['solution']['pos'][-1] < route_end
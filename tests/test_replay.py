@@ -0,0 +1,78 @@
+import glob
+import os
+import xml.etree.ElementTree as ET
+import numpy as np
+import pytest
+import replay
+
+TCX = '''<?xml version="1.0" encoding="UTF-8"?>
+<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2" xmlns:ns3="http://www.garmin.com/xmlschemas/ActivityExtension/v2">
+  <Activities>
+    <Activity Sport="Biking">
+      <Id>2024-03-01T10:00:00Z</Id>
+      <Lap StartTime="2024-03-01T10:00:00Z">
+        <Track>
+          <Trackpoint>
+            <Time>2024-03-01T10:00:00Z</Time>
+            <DistanceMeters>0.0</DistanceMeters>
+            <AltitudeMeters>12.5</AltitudeMeters>
+            <HeartRateBpm><Value>120</Value></HeartRateBpm>
+            <Cadence>85</Cadence>
+            <Extensions><ns3:TPX><ns3:Speed>8.5</ns3:Speed><ns3:Watts>250</ns3:Watts></ns3:TPX></Extensions>
+          </Trackpoint>
+          <Trackpoint>
+            <Time>2024-03-01T10:00:01.500Z</Time>
+            <DistanceMeters>12.0</DistanceMeters>
+            <Extensions><ns3:TPX><ns3:Watts>260</ns3:Watts></ns3:TPX></Extensions>
+          </Trackpoint>
+        </Track>
+      </Lap>
+      <Lap StartTime="2024-03-01T10:00:03Z">
+        <Track>
+          <Trackpoint>
+            <DistanceMeters>20.0</DistanceMeters>
+          </Trackpoint>
+          <Trackpoint>
+            <Time>2024-03-01T10:00:03Z</Time>
+            <DistanceMeters>25.0</DistanceMeters>
+            <AltitudeMeters>13.0</AltitudeMeters>
+            <Extensions><ns3:TPX><ns3:Watts>300</ns3:Watts></ns3:TPX></Extensions>
+          </Trackpoint>
+        </Track>
+      </Lap>
+    </Activity>
+  </Activities>
+</TrainingCenterDatabase>
+'''
+
+@pytest.fixture
+def tcx_path(tmp_path):
+    path = tmp_path / 'ride.tcx'
+    path.write_text(TCX)
+    return str(path)
+
+def test_read_tcx(tcx_path):
+    ride = replay.read_tcx(tcx_path)
+    # The trackpoint without a time is skipped
+    np.testing.assert_array_equal(ride['time'], [0, 1.5, 3])
+    np.testing.assert_array_equal(ride['lap'], [0, 0, 1])
+    np.testing.assert_array_equal(ride['distance'], [0, 12, 25])
+    np.testing.assert_array_equal(ride['power'], [250, 260, 300])
+    np.testing.assert_array_equal(ride['altitude'], [12.5, np.nan, 13])
+    np.testing.assert_array_equal(ride['heart_rate'], [120, np.nan, np.nan])
+    np.testing.assert_array_equal(ride['cadence'], [85, np.nan, np.nan])
+    np.testing.assert_array_equal(ride['speed'], [8.5, np.nan, np.nan])
+    np.testing.assert_array_equal(ride['latitude'], [np.nan]*3)
+
+def test_read_tcx_matches_tree_parse():
+    # The incremental parse reads the same trackpoints as parsing the whole tree of a recorded ride
+    path = sorted(glob.glob(os.path.join(replay.TIME_TRIALS_DIR, '*.tcx')))[0]
+    ride = replay.read_tcx(path)
+    trackpoints = [element for element in ET.parse(path).iter() if replay.local_name(element.tag) == 'Trackpoint']
+    def values(field):
+        found = [[child.text for child in point.iter() if replay.local_name(child.tag) == field] for point in trackpoints]
+        return np.array([float(value[0]) if value else np.nan for value in found])
+    assert len(ride['time']) == len(trackpoints)
+    np.testing.assert_array_equal(ride['distance'], values('DistanceMeters'))
+    np.testing.assert_array_equal(ride['power'], values('Watts'))
+    assert (np.diff(ride['time']) >= 0).all()
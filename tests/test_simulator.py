@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+import optimal_pacing as opt
+import route_store
+from benchmark import create_initialization_casadi
+from simulator import create_initialization
+
+ATHLETE = {'weight': 75, 'cp': 250, 'w_prime': 20000, 'max_power': 700}
+
+@pytest.mark.parametrize('route_name', ['Mech Isle Loop', 'Cobbled Climbs'])
+def test_create_initialization_matches_casadi(route_name):
+    # The batched simulation takes the grid of slope constants instead of the bisection, and linear instead of
+    # spline interpolation of the gradient, so it matches the CasADi version to the bisection's resolution
+    route = route_store.get_route(route_name, 1)
+    distance = route['distance']
+    params = opt.model_params(ATHLETE, route['friction'])
+    timegrid = np.linspace(0, round(distance[-1]/1000*150), round(distance[-1]/5))
+    x0 = [distance[0], 1, ATHLETE['w_prime']]
+    X_casadi, power_casadi, t_casadi = create_initialization_casadi(timegrid, x0, distance, route['elevation'], params)
+    X, power, t_grid = create_initialization(timegrid, x0, distance, route['elevation'], params)
+    assert t_grid[-1] == pytest.approx(t_casadi[-1], rel=5e-3)
+    assert np.abs(np.interp(t_grid, t_casadi, X_casadi[0]) - X[0]).max() < 0.01*distance[-1]
+    assert np.median(np.abs(np.interp(t_grid, t_casadi, power_casadi) - power)) < 5
+    assert X[2].min() >= 1000
+    # Both stop before the first point past the finish
+    assert X[0, -1] < distance[-1] and X_casadi[0, -1] < distance[-1]
@@ -0,0 +1,76 @@
+import os
+import numpy as np
+import pytest
+import solution_cache
+
+def athlete(cp, route='Mech Isle Loop', **fields):
+    return {'route': route, 'num_laps': 1, 'formulation': 'time', 'weight': 75, 'cp': cp, 'w_prime': 20000, 'max_power': 700, **fields}
+
+def solution(T, N=100):
+    return {
+        'time': np.linspace(0, T, N+1),
+        'pos': np.linspace(0, 4000, N+1),
+        'speed': np.full(N+1, 10.0),
+        'w_bal': np.full(N+1, 20000.0),
+        'power': np.full(N+1, 250.0),
+        'T': T,
+        'lam_g': {'dynamics': np.ones((3, N))}
+    }
+
+def age(cache, params, seconds):
+    # Sets the last use of a stored solution to seconds ago
+    path = cache.path(solution_cache.solution_key(params))
+    mtime = os.path.getmtime(path) - seconds
+    os.utime(path, (mtime, mtime))
+
+def test_default_size_limit():
+    assert solution_cache.MAX_BYTES == 256*2**20
+
+def test_get_returns_stored_solution(tmp_path):
+    cache = solution_cache.SolutionCache(str(tmp_path))
+    params = athlete(250)
+    assert cache.get(params) is None
+    cache.put(params, solution(400), {'iterations': 10})
+    stored, stats = cache.get(params)
+    assert stored['T'] == 400 and stats == {'iterations': 10}
+    np.testing.assert_array_equal(stored['time'], solution(400)['time'])
+    np.testing.assert_array_equal(stored['lam_g']['dynamics'], np.ones((3, 100)))
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+    # The index is read back from the files
+    assert solution_cache.SolutionCache(str(tmp_path)).get(params)[0]['T'] == 400
+
+def test_nearest_matches_route_and_athlete(tmp_path):
+    cache = solution_cache.SolutionCache(str(tmp_path))
+    cache.put(athlete(250), solution(400), {})
+    cache.put(athlete(300), solution(380), {})
+    cache.put(athlete(290, route='Hilly Route'), solution(900), {})
+    assert cache.nearest(athlete(285))['T'] == 380
+    assert cache.nearest(athlete(260))['T'] == 400
+    assert cache.nearest(athlete(285, route='Hilly Route'))['T'] == 900
+    assert cache.nearest(athlete(285, formulation='distance')) is None
+    # Too far from every stored athlete
+    assert cache.nearest(athlete(500)) is None
+    assert cache.stats()['warm_starts'] == 3
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = solution_cache.SolutionCache(str(tmp_path))
+    cache.put(athlete(250), solution(400), {})
+    size = os.path.getsize(cache.path(solution_cache.solution_key(athlete(250))))
+    cache.max_bytes = int(2.5*size)
+    cache.put(athlete(260), solution(400), {})
+    age(cache, athlete(250), 30)
+    age(cache, athlete(260), 20)
+    # A lookup makes the oldest solution the most recently used
+    assert cache.get(athlete(250)) is not None
+    cache.put(athlete(270), solution(400), {})
+    assert cache.get(athlete(260)) is None
+    assert cache.get(athlete(250)) is not None and cache.get(athlete(270)) is not None
+    assert cache.stats()['solutions'] == 2 and cache.stats()['bytes'] <= cache.max_bytes
+
+def test_keeps_newest_solution_above_limit(tmp_path):
+    cache = solution_cache.SolutionCache(str(tmp_path), max_bytes=1)
+    cache.put(athlete(250), solution(400), {})
+    age(cache, athlete(250), 10)
+    cache.put(athlete(260), solution(390), {})
+    assert cache.stats()['solutions'] == 1
+    assert cache.get(athlete(260))[0]['T'] == 390
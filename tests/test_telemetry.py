@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+import optimal_pacing as opt
+import telemetry
+from simulator import smooth_w_balance_derivative
+
+CP = 250
+W_PRIME = 20000
+
+def batch_w_bal(power, w_bal=W_PRIME, substeps=100):
+    # W'bal after riding each power for a second, in Euler steps much shorter than a second
+    for p in power:
+        for _ in range(substeps):
+            w_bal = min(w_bal + smooth_w_balance_derivative(p, CP, w_bal, W_PRIME)/substeps, W_PRIME)
+    return w_bal
+
+def ride(tracker, power, start=0, distance=0, speed=10):
+    for i, p in enumerate(power):
+        tracker.add(start + i, p, speed, distance + i*speed)
+
+def test_averages_match_batch():
+    # Samples at 1 Hz: every sample but the last has completed its second
+    power = np.random.default_rng(0).uniform(100, 450, 300)
+    tracker = telemetry.RideTracker(CP, W_PRIME)
+    ride(tracker, power)
+    assert tracker.rolling_power() == pytest.approx(power[-31:-1].mean())
+    assert tracker.normalized_power() == pytest.approx(opt.normalized_power(power[:-1]))
+    assert tracker.w_bal == pytest.approx(batch_w_bal(power[:-1]), abs=1)
+
+def test_held_power_between_sparse_samples():
+    # A sample every 2 s holds its power for both seconds
+    tracker = telemetry.RideTracker(CP, W_PRIME)
+    for i in range(40):
+        tracker.add(2*i, 200 + i, 10, 20*i)
+    assert tracker.rolling_power() == pytest.approx(np.repeat(200 + np.arange(39), 2)[-30:].mean())
+
+def test_pause_recovers_w_bal():
+    # A minute without samples holds the last power for MAX_GAP seconds and recovers at zero power after it
+    tracker = telemetry.RideTracker(CP, W_PRIME)
+    ride(tracker, np.full(60, 400))
+    before_pause = list(tracker.window)
+    tracker.add(119, 400, 10, 600)
+    expected = batch_w_bal([400]*(59 + telemetry.MAX_GAP) + [0]*(60 - telemetry.MAX_GAP))
+    assert tracker.w_bal == pytest.approx(expected, abs=1)
+    assert tracker.w_bal > batch_w_bal([400]*(59 + telemetry.MAX_GAP))
+    # The pause is not in the averages, only the held seconds before it
+    assert list(tracker.window) == (before_pause + [400]*telemetry.MAX_GAP)[-telemetry.ROLLING_WINDOW:]
+
+@pytest.mark.parametrize('power', [0, 240, CP, 260, 400, 1000])
+def test_w_bal_closed_form(power):
+    # W'bal over a long interval at one power, from a partly depleted W'bal, matches a fine integration
+    tracker = telemetry.RideTracker(CP, W_PRIME)
+    tracker.w_bal = 12000
+    tracker.integrate_w_bal(10, power)
+    assert tracker.w_bal == pytest.approx(batch_w_bal([power]*10, 12000), abs=1)
+
+def test_long_gap_starts_new_ride():
+    tracker = telemetry.RideTracker(CP, W_PRIME)
+    assert not tracker.new_ride(0, 0)
+    ride(tracker, [300]*10)
+    assert not tracker.new_ride(9 + telemetry.MAX_PAUSE, 90)
+    assert tracker.new_ride(10 + telemetry.MAX_PAUSE, 90)
+    assert tracker.new_ride(10, 90 - telemetry.RESTART_DISTANCE - 1)
+
+def test_reoptimization_trigger_and_spacing():
+    tracker = telemetry.RideTracker(CP, W_PRIME)
+    tracker.set_plan({'pos': np.array([0, 10000]), 'w_bal': np.array([W_PRIME, 10000])})
+    # The plan's W'bal is 15000 J at 5000 m
+    tracker.add(0, 300, 10, 5000, w_bal=15000 - telemetry.REOPT_W_BAL_DEVIATION + 100)
+    assert not tracker.reoptimization_due()
+    tracker.add(1, 300, 10, 5010, w_bal=10000)
+    assert tracker.target_w_bal(5010) == pytest.approx(14990)
+    assert tracker.reoptimization_due()
+    tracker.reoptimized()
+    tracker.add(2, 300, 10, 5010 + telemetry.REOPT_SPACING, w_bal=8000)
+    assert not tracker.reoptimization_due()
+    tracker.add(3, 300, 10, 5020 + telemetry.REOPT_SPACING, w_bal=8000)
+    assert tracker.reoptimization_due()
+    # Not while the rider is nearly stopped, nor at the start of the route
+    tracker.add(4, 0, 1, 5030 + telemetry.REOPT_SPACING, w_bal=8000)
+    assert not tracker.reoptimization_due()
+    tracker.set_plan({'pos': np.array([0, 10000]), 'w_bal': np.array([W_PRIME, W_PRIME])})
+    tracker.add(5, 300, 10, telemetry.REOPT_MIN_DISTANCE - 10, w_bal=1000)
+    assert not tracker.reoptimization_due()
+
+def test_correction_before_reoptimization():
+    # A smaller deviation only asks for a correction, which is spaced from the last correction
+    tracker = telemetry.RideTracker(CP, W_PRIME)
+    tracker.set_plan({'pos': np.array([0, 10000]), 'w_bal': np.array([W_PRIME, W_PRIME])})
+    tracker.add(0, 300, 10, 2000, w_bal=W_PRIME - telemetry.CORRECTION_W_BAL_DEVIATION - 100)
+    assert tracker.correction_due() and not tracker.reoptimization_due()
+    tracker.corrected()
+    tracker.add(1, 300, 10, 2000 + telemetry.CORRECTION_SPACING, w_bal=W_PRIME - 1000)
+    assert not tracker.correction_due()
+    tracker.add(2, 300, 10, 2010 + telemetry.CORRECTION_SPACING, w_bal=W_PRIME - 1000)
+    assert tracker.correction_due()